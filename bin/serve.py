@@ -0,0 +1,12 @@
+# Patch the standard library for gevent before anything else is imported.
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from cli.serve import ServeCli
+ServeCli().run()
@@ -0,0 +1,9 @@
+# Patch the standard library for gevent before anything else is imported.
+from gevent import monkey
+monkey.patch_all()
+
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from cli.sse_load_test import SseLoadTestCli
+SseLoadTestCli().run()
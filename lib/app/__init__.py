@@ -7,20 +7,38 @@ import logging
 import sys
 import time
 
-from flask import Flask, g, jsonify, make_response, request
+from flask import Flask, g, has_request_context, jsonify, make_response, \
+                  request
 from flask_assets import Environment, Bundle
 from flask_failsafe import failsafe
 from itsdangerous import Signer
-from scorched import SolrInterface
-from werkzeug.exceptions import HTTPException, default_exceptions
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import Forbidden, HTTPException, \
+                                ServiceUnavailable, TooManyRequests, \
+                                default_exceptions
 
 import app.config
 import app.database
-from app.queue import init_queues, remove_unused_queues
+import app.metrics
+import app.profiling
 
 
 flask_app = None
 
+REQUEST_LATENCY = app.metrics.REGISTRY.histogram(
+    'quickpin_http_request_duration_seconds',
+    'Time to handle HTTP requests, by view.',
+    labels=('view', 'method', 'status')
+)
+
+REPEATED_QUERIES = app.metrics.REGISTRY.counter(
+    'quickpin_repeated_queries',
+    'Requests that ran one statement shape more times than the configured'
+    ' threshold, by view.',
+    labels=('view',)
+)
+
 
 class MyFlask(Flask):
     """
@@ -148,12 +166,22 @@ def init_flask(flask_app, config):
     if flask_app.debug:
         flask_app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
 
-    db_engine = app.database.get_engine(dict(config.items('database')))
+    db_config = dict(config.items('database'))
+    db_engine = app.database.get_engine(db_config)
+    app.database.get_replica_engine(db_config)
+    replica_lag = config.getint('database', 'replica_lag')
     redis = app.database.get_redis(dict(config.items('redis')))
-    remove_unused_queues(redis)
-    init_queues(redis)
     solr = app.database.get_solr(dict(config.items('solr')))
 
+    profile_rate_limit = config.getint('profiling', 'rate_limit')
+    profile_ttl = config.getint('profiling', 'ttl')
+    repeated_query_threshold = config.getint('database',
+                                             'repeated_query_threshold')
+    metrics_interval = config.getint('metrics', 'publish_interval')
+    app.metrics.REGISTRY.add_collector(
+        solr.conn.http_connection.collect_metrics
+    )
+
     signer = Signer(config.get('flask', 'SECRET_KEY'))
     sign_fn = lambda s: signer.sign(str(s).encode('utf8')).decode('utf-8')
     unsign_fn = signer.unsign
@@ -162,27 +190,149 @@ def init_flask(flask_app, config):
     def after_request(response):
         ''' Clean up request context. '''
 
+        if g.profiler is not None:
+            response.headers['X-Profile-ID'] = finish_profile()
+
         g.db.close()
 
+        # Send this user's reads to the primary for a while after a write.
+        user = getattr(g, 'user', None)
+
+        if request.method not in ('GET', 'HEAD') and user is not None and \
+           response.status_code < 400 and app.database.has_replicas():
+            app.database.mark_write(redis, user.id, replica_lag)
+
+        # Report this request's SQL statements, and flag statements that ran
+        # many times, which usually means that something is loaded lazily in
+        # a loop.
+        query_stats = g.query_stats
+        db_time = '{:.1f}'.format(query_stats.time * 1000)
+        response.headers['X-DB-Queries'] = str(query_stats.count)
+        response.headers['X-DB-Time'] = db_time
+
+        if repeated_query_threshold > 0 and \
+           query_stats.count > repeated_query_threshold:
+            repeated = query_stats.repeated(repeated_query_threshold)
+
+            for shape, count in repeated:
+                flask_app.logger.warning(
+                    'Possible N+1 query: %s %s ran this statement %d times:'
+                    ' %s', request.method, request.path, count, shape
+                )
+
+            if len(repeated) > 0:
+                REPEATED_QUERIES.inc(view=request.endpoint or 'none')
+                response.headers['X-DB-Repeated-Queries'] = \
+                    str(repeated[0][1])
+
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - g.request_start,
+            view=request.endpoint or 'none',
+            method=request.method,
+            status=response.status_code
+        )
+
         return response
 
+    # Count SQL statements and their time for each request, so that slow or
+    # N+1 query patterns are easy to spot. This is cheap enough to leave on.
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_db_query(conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('request_query_start', []) \
+                 .append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_db_query(conn, cursor, statement, parameters, context,
+                        executemany):
+        start = conn.info['request_query_start'].pop()
+
+        if has_request_context() and 'query_stats' in g:
+            g.query_stats.add(statement, time.perf_counter() - start)
+
     if flask_app.latency is not None:
         @flask_app.before_request
         def api_latency():
             if request.path[:5] == '/api/':
                 time.sleep(flask_app.latency)
 
+    def choose_engine():
+        '''
+        Choose the engine for this request's session.
+
+        GET requests are read-only, so they use a replica (if any are
+        configured), unless the user wrote something recently or the view
+        requires the primary (see ``app.etag.profile_etag()``). This is called
+        when a view first uses the session, which is after authentication.
+        '''
+
+        if request.method not in ('GET', 'HEAD') or g.get('db_primary', False):
+            return db_engine
+
+        user = getattr(g, 'user', None)
+
+        if user is not None and app.database.recently_wrote(redis, user.id):
+            return db_engine
+
+        return app.database.get_replica_engine(db_config)
+
     @flask_app.before_request
     def before_request():
         ''' Initialize request context. '''
 
+        g.request_start = time.perf_counter()
+        app.metrics.start_publisher(redis, metrics_interval)
+
         g.config = config
         g.debug = flask_app.debug
-        g.db = app.database.get_session(db_engine)
+        g.db = app.database.get_lazy_session(choose_engine)
+        g.query_stats = app.database.QueryStats()
         g.redis = redis
         g.solr = solr
         g.sign = sign_fn
         g.unsign = unsign_fn
+        g.profiler = None
+
+        if request.headers.get('X-Profile') == '1' or \
+           request.args.get('xprofile') == '1':
+            start_profile()
+
+    def start_profile():
+        '''
+        Profile this request, if the user is an administrator and has not
+        exceeded the rate limit.
+        '''
+
+        from app.authorization import get_request_user
+        user = get_request_user()
+
+        if user is None or not user.is_admin:
+            raise Forbidden('Profiling requires administrator privileges.')
+
+        if not app.profiling.allow(redis, user.id, profile_rate_limit):
+            raise TooManyRequests('Profiling rate limit exceeded. Try again'
+                                  ' later.')
+
+        g.profile_user = user
+        g.profile_start = time.perf_counter()
+        g.profiler = app.profiling.start()
+
+        if g.profiler is None:
+            raise ServiceUnavailable('Another request is being profiled.')
+
+    def finish_profile():
+        ''' Stop profiling this request and return the profile's ID. '''
+
+        g.profiler.disable()
+        meta = {
+            'duration': time.perf_counter() - g.profile_start,
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'user_id': g.profile_user.id,
+        }
+
+        return app.profiling.save(redis, g.profiler, meta, profile_ttl)
 
     @flask_app.url_defaults
     def static_asset_cache_busting(endpoint, values):
@@ -251,6 +401,10 @@ def init_views(flask_app, config):
     from app.views.notification import NotificationView
     NotificationView.register(flask_app, route_base='/api/notification/')
     flask_app.atexit(NotificationView.quit_notifications)
+    app.metrics.REGISTRY.add_collector(NotificationView.collect_metrics)
+
+    from app.views.profiling import ProfilingView
+    ProfilingView.register(flask_app, route_base='/api/profiling/')
 
     from app.views.profile import ProfileView
     ProfileView.register(flask_app, route_base='/api/profile/')
@@ -258,12 +412,19 @@ def init_views(flask_app, config):
     from app.views.search import SearchView
     SearchView.register(flask_app, route_base='/api/search/')
 
+    from app.views.status import StatusView
+    StatusView.register(flask_app, route_base='/api/status/')
+
     from app.views.tasks import TasksView
     TasksView.register(flask_app, route_base='/api/tasks/')
 
     from app.views.user import UserView
     UserView.register(flask_app, route_base='/api/user/')
 
+    from app.views.metrics import MetricsView
+    MetricsView.register(flask_app, route_base='/metrics',
+                         trailing_slash=False)
+
     from app.views.label import LabelView
     LabelView.register(flask_app, route_base='/api/label/')
 
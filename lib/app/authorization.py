@@ -1,13 +1,63 @@
 from datetime import datetime
 from functools import wraps
+import time
 import urllib.parse
 
-import dateutil.parser
 from flask import g, request
 from werkzeug.exceptions import BadRequest, Forbidden, Unauthorized
 
 from model import User
 
+
+USER_CACHE_KEY = 'auth:user:{}'
+
+
+class UserSnapshot:
+    '''
+    The fields of a User that are needed to authorize a request.
+
+    Authorization returns one of these instead of a User so that it can be
+    cached without a database session.
+    '''
+
+    def __init__(self, id_, email, is_admin):
+        ''' Constructor. '''
+
+        self.id = id_
+        self.email = email
+        self.is_admin = is_admin
+
+
+def get_request_user():
+    '''
+    Return the user who made the current request, or None if the request is
+    not authenticated.
+
+    Views should use the decorators below instead. This is for code that runs
+    before a view's decorators, such as ``before_request`` hooks.
+    '''
+
+    return _get_user_from_request(required=False)
+
+
+def invalidate_user(redis, user_id):
+    ''' Remove a user from the authorization cache. '''
+
+    redis.delete(USER_CACHE_KEY.format(user_id))
+
+
+def make_token(sign, user_id, lifetime):
+    '''
+    Make a signed auth token that is valid for ``lifetime`` seconds.
+
+    The expiry is encoded as a Unix timestamp so that verifying a token is
+    cheap.
+    '''
+
+    expires = int(time.time() + lifetime)
+    return sign('%d|%d' % (user_id, expires))
+
+
 def login_optional(original_function):
     '''
     A decorator that checks if a user is logged in.
@@ -89,12 +139,11 @@ def _get_user_from_request(required=True):
     try:
         token = g.unsign(xauth).decode('ascii').split('|')
         user_id = int(token[0])
-        expires = dateutil.parser.parse(token[1])
 
-        if expires < datetime.now():
+        if _token_expired(token[1]):
             raise ValueError()
 
-        user = g.db.query(User).filter(User.id==user_id).one()
+        user = _get_user(user_id)
 
     except:
         if required:
@@ -103,3 +152,47 @@ def _get_user_from_request(required=True):
             user = None
 
     return user
+
+def _get_user(user_id):
+    '''
+    Get a snapshot of the user identified by ``user_id``.
+
+    Raises NoResultFound if the user does not exist.
+    '''
+
+    ttl = g.config.getint('authorization', 'cache_ttl')
+    key = USER_CACHE_KEY.format(user_id)
+
+    if ttl > 0:
+        cached = g.redis.hmget(key, 'email', 'is_admin')
+
+        if cached[0] is not None:
+            return UserSnapshot(user_id, cached[0].decode('utf8'),
+                                cached[1] == b'1')
+
+    user = g.db.query(User).filter(User.id==user_id).one()
+    snapshot = UserSnapshot(user.id, user.email, user.is_admin)
+
+    if ttl > 0:
+        pipeline = g.redis.pipeline()
+        pipeline.hmset(key, {
+            'email': user.email,
+            'is_admin': '1' if user.is_admin else '0',
+        })
+        pipeline.expire(key, ttl)
+        pipeline.execute()
+
+    return snapshot
+
+def _token_expired(expires):
+    '''
+    Return True if a token's expiry time has passed.
+
+    Tokens issued before expiry times were encoded as Unix timestamps contain
+    an ISO-8601 date instead.
+    '''
+
+    try:
+        return int(expires) < time.time()
+    except ValueError:
+        return datetime.fromisoformat(expires) < datetime.now()
@@ -1,15 +1,83 @@
+from collections import Counter
+import random
+import re
+import threading
+import time
+
 import redis
 import scorched
 import sqlalchemy
-from sqlalchemy import case, func
+from sqlalchemy import and_, case, false, func, or_
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import TypeDecorator, UnicodeText
 from sqlalchemy.util import KeyedTuple
 
+import app.metrics
+from app.solr import SolrSession
+
 
 _engine = None
+_replica_engines = None
 _sessionmaker = None
 
+# Connection string templates.
+CONNECT_STRING = 'postgresql+psycopg2://%(username)s:%(password)s' \
+                 '@%(host)s/%(database)s?client_encoding=utf8'
+SUPER_CONNECT_STRING = 'postgresql+psycopg2://%(super_username)s' \
+                       ':%(super_password)s@%(host)s/%(database)s?' \
+                       'client_encoding=utf8'
+
+# Marks users who have written to the primary recently; see mark_write().
+RECENT_WRITE_KEY = 'db:recent_write:{}'
+
+# If the query planner estimates fewer rows than this, then count_query() runs
+# an exact count instead, since counting a small result set is cheap.
+EXACT_COUNT_THRESHOLD = 10000
+
+# Bind parameters, or comma-separated runs of them (e.g. an IN list), are
+# replaced by a single placeholder to find a statement's shape.
+_PARAMS_PATTERN = re.compile(r'%\(\w+\)s(?:\s*,\s*%\(\w+\)s)*'
+                             r'|%s(?:\s*,\s*%s)*')
+_SPACE_PATTERN = re.compile(r'\s+')
+
+REDIS_ROUND_TRIPS = app.metrics.REGISTRY.counter(
+    'quickpin_redis_round_trips',
+    'Commands or pipelines sent to Redis.'
+)
+
+
+def count_query(query, exact=False):
+    '''
+    Count the rows in a query.
+
+    Unless ``exact`` is True, this uses the query planner's estimate of the
+    row count, which avoids scanning the entire result set. Small result sets
+    are always counted exactly; see ``EXACT_COUNT_THRESHOLD``.
+
+    Returns a tuple: the count and a boolean that is True if the count is
+    exact.
+    '''
+
+    if not exact:
+        estimate = estimate_count(query)
+
+        if estimate >= EXACT_COUNT_THRESHOLD:
+            return estimate, False
+
+    return query.count(), True
+
+
+def estimate_count(query):
+    ''' Return the query planner's estimate of a query's row count. '''
+
+    session = query.session
+    compiled = query.statement.compile(dialect=session.bind.dialect)
+    explain = 'EXPLAIN (FORMAT JSON) {}'.format(compiled)
+    plan = session.connection().execute(explain, compiled.params).scalar()
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
 
 def get_engine(config, super_user=False):
     '''
@@ -23,25 +91,109 @@ def get_engine(config, super_user=False):
 
     if _engine is None:
         if super_user:
-            connect_string = 'postgresql+psycopg2://%(super_username)s' \
-                             ':%(super_password)s@%(host)s/%(database)s?' \
-                             'client_encoding=utf8'
+            connect_string = SUPER_CONNECT_STRING
         else:
-            connect_string = 'postgresql+psycopg2://%(username)s:%(password)s' \
-                             '@%(host)s/%(database)s?client_encoding=utf8'
+            connect_string = CONNECT_STRING
 
-        _engine = sqlalchemy.create_engine(
-            connect_string % config,
-            pool_recycle=3600
-        )
+        _engine = _create_engine(connect_string % config, config)
 
     return _engine
 
 
+def get_replica_engine(config):
+    '''
+    Get a SQLAlchemy engine for a read-only replica.
+
+    Replicas are listed in the ``replica_hosts`` setting; they use the same
+    credentials and database name as the primary. If several replicas are
+    configured, one is chosen at random on each call. If none are configured,
+    this returns the primary engine.
+    '''
+
+    global _replica_engines
+
+    if _replica_engines is None:
+        hosts = [h.strip() for h in config.get('replica_hosts', '').split(',')
+                 if h.strip() != '']
+        _replica_engines = []
+
+        for host in hosts:
+            replica_config = dict(config, host=host)
+            engine = _create_engine(CONNECT_STRING % replica_config, config)
+            _replica_engines.append(engine)
+
+    if len(_replica_engines) == 0:
+        return get_engine(config)
+
+    return random.choice(_replica_engines)
+
+
+def has_replicas():
+    ''' Return True if any replica engines have been created. '''
+
+    return _replica_engines is not None and len(_replica_engines) > 0
+
+
+def mark_write(redis, user_id, window):
+    '''
+    Record that a user has just written to the primary.
+
+    For ``window`` seconds afterwards, recently_wrote() returns True for that
+    user, so that the user's reads go to the primary and include their own
+    writes even if the replicas are lagging.
+    '''
+
+    redis.set(RECENT_WRITE_KEY.format(user_id), 1, ex=window)
+
+
+def recently_wrote(redis, user_id):
+    ''' Return True if mark_write() was called for a user recently. '''
+
+    return redis.exists(RECENT_WRITE_KEY.format(user_id))
+
+
+def pool_stats():
+    '''
+    Return statistics about this process's database connection pool.
+
+    Returns None if the engine has not been created.
+    '''
+
+    if _engine is None:
+        return None
+
+    return _engine.pool.stats()
+
+
+def replica_pool_stats():
+    ''' Return a list of statistics for each replica's connection pool. '''
+
+    if _replica_engines is None:
+        return []
+
+    return [engine.pool.stats() for engine in _replica_engines]
+
+
 def get_redis(config):
     ''' Get a Redis connection handle. '''
 
-    return redis.Redis(connection_pool=redis.ConnectionPool(**config))
+    pool = redis.ConnectionPool(connection_class=InstrumentedConnection,
+                                **config)
+
+    return redis.Redis(connection_pool=pool)
+
+
+def get_lazy_session(choose_engine):
+    '''
+    Get a proxy that creates a SQLAlchemy session the first time it is used.
+
+    Requests that never touch the database (e.g. static assets) then don't pay
+    for a session. ``choose_engine`` is called with no arguments when the
+    session is created and returns the engine to bind it to, so the choice can
+    depend on state that is only known later in the request.
+    '''
+
+    return LazySession(choose_engine)
 
 
 def get_session(engine):
@@ -56,10 +208,34 @@ def get_session(engine):
 
 
 def get_solr(config):
-    ''' Get a solr connection handle. '''
+    '''
+    Get a solr connection handle.
+
+    The handle uses a pooled HTTP session with timeouts and a circuit breaker;
+    see ``app.solr.SolrSession``. It is thread safe and should be shared.
+    '''
 
     solr_url = config['url'].rstrip('/') + '/'
-    return scorched.SolrInterface(solr_url)
+    session = SolrSession(
+        pool_size=int(config.get('pool_size', 10)),
+        connect_timeout=float(config.get('connect_timeout', 2)),
+        read_timeout=float(config.get('read_timeout', 20)),
+        breaker_threshold=int(config.get('breaker_threshold', 5)),
+        breaker_reset=float(config.get('breaker_reset', 30))
+    )
+
+    return scorched.SolrInterface(solr_url, http_connection=session)
+
+
+def statement_shape(statement):
+    '''
+    Return the shape of a SQL statement: the statement with its bind
+    parameters (including IN lists of any length) replaced by "?" and its
+    whitespace collapsed.
+    '''
+
+    shape = _PARAMS_PATTERN.sub('?', statement)
+    return _SPACE_PATTERN.sub(' ', shape).strip()
 
 
 def make_date_columns(date_column, start_date, end_date, delta, unit):
@@ -142,6 +318,43 @@ def query_chunks(query, id_column, chunksize=100):
                      .all()
 
 
+def keyset_condition(sort_columns, values):
+    '''
+    Produce a condition that matches rows sorted after ``values``.
+
+    This is used for keyset pagination (a.k.a. "seek" pagination): instead of
+    skipping rows with OFFSET, which gets slower the deeper you page, the
+    query resumes immediately after the last row of the previous page.
+
+    ``sort_columns`` is a list of (column, descending) tuples, as returned by
+    ``app.rest.get_sort_columns()``, and must end with a unique column.
+    ``values`` are the values of those columns in the last row of the
+    previous page. NULLs are assumed to sort last, regardless of direction.
+    '''
+
+    clauses = list()
+
+    for index, (column, descending) in enumerate(sort_columns):
+        terms = [c == v for (c, _), v in zip(sort_columns, values[:index])]
+        value = values[index]
+
+        if value is None:
+            # Nothing sorts after NULL in this column.
+            terms.append(false())
+        else:
+            after = column < value if descending else column > value
+            expression = getattr(column, 'expression', column)
+
+            if getattr(expression, 'nullable', True):
+                after = or_(after, column == None)
+
+            terms.append(after)
+
+        clauses.append(and_(*terms))
+
+    return or_(*clauses)
+
+
 class IntList(TypeDecorator):
     ''' Converts lists of integers to CSV string. '''
 
@@ -159,3 +372,198 @@ class IntList(TypeDecorator):
             return list()
         else:
             return list(map(int, value.split(',')))
+
+
+def _create_engine(url, config):
+    ''' Create an engine with pool settings from ``config``. '''
+
+    return sqlalchemy.create_engine(
+        url,
+        poolclass=InstrumentedQueuePool,
+        pool_size=int(config.get('pool_size', 5)),
+        max_overflow=int(config.get('max_overflow', 10)),
+        pool_timeout=float(config.get('pool_timeout', 30)),
+        pool_recycle=3600
+    )
+
+
+def _collect_pool_metrics():
+    ''' Report connection pool statistics as metrics. '''
+
+    pools = []
+
+    if _engine is not None:
+        pools.append(('primary', _engine.pool.stats()))
+
+    for index, stats in enumerate(replica_pool_stats()):
+        pools.append(('replica{}'.format(index), stats))
+
+    def samples(stat):
+        return [({'pool': name}, stats[stat]) for name, stats in pools]
+
+    return [
+        app.metrics.gauge_family('quickpin_db_pool_checked_out',
+                                 'Database connections in use.',
+                                 samples('checked_out')),
+        app.metrics.gauge_family('quickpin_db_pool_overflow',
+                                 'Database connections open beyond the pool'
+                                 ' size.',
+                                 samples('overflow')),
+        app.metrics.gauge_family('quickpin_db_pool_size',
+                                 'Configured database pool size.',
+                                 samples('size')),
+        app.metrics.counter_family('quickpin_db_pool_checkouts',
+                                   'Database connections checked out.',
+                                   samples('checkout_count')),
+        app.metrics.counter_family('quickpin_db_pool_timeouts',
+                                   'Times a thread gave up waiting for a'
+                                   ' database connection.',
+                                   samples('timeout_count')),
+        app.metrics.counter_family('quickpin_db_pool_wait_seconds',
+                                   'Time spent waiting for database'
+                                   ' connections.',
+                                   samples('wait_time')),
+    ]
+
+
+app.metrics.REGISTRY.add_collector(_collect_pool_metrics)
+
+
+class InstrumentedConnection(redis.Connection):
+    ''' A Redis connection that counts round trips to the server. '''
+
+    def send_packed_command(self, *args, **kwargs):
+        ''' Send a command (or a pipeline of commands) to the server. '''
+
+        REDIS_ROUND_TRIPS.inc()
+        return super().send_packed_command(*args, **kwargs)
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    A connection pool that records how long threads wait for a connection.
+
+    Use these statistics, along with the number of connections in use, to
+    size the pool for the number of threads in each process.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        ''' Constructor. '''
+
+        super().__init__(*args, **kwargs)
+
+        self._stats_lock = threading.Lock()
+        self.checkout_count = 0
+        self.timeout_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def stats(self):
+        ''' Return a dictionary of pool statistics. '''
+
+        with self._stats_lock:
+            return {
+                'checked_out': self.checkedout(),
+                'checkout_count': self.checkout_count,
+                'max_overflow': self._max_overflow,
+                'max_wait_time': self.max_wait_time,
+                'overflow': max(0, self.overflow()),
+                'size': self.size(),
+                'timeout_count': self.timeout_count,
+                'wait_time': self.wait_time,
+            }
+
+    def _do_get(self):
+        ''' Check out a connection, timing the wait. '''
+
+        start = time.perf_counter()
+
+        try:
+            connection = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            with self._stats_lock:
+                self.timeout_count += 1
+            raise
+
+        elapsed = time.perf_counter() - start
+
+        with self._stats_lock:
+            self.checkout_count += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+
+        return connection
+
+
+class QueryStats:
+    '''
+    Counts the SQL statements run while handling a request, and their time.
+
+    Statements are also counted by shape (the statement with its parameters
+    removed), so that a request that runs the same query over and over again,
+    e.g. loading a relationship lazily for each item in a list, can be
+    flagged.
+    '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self.count = 0
+        self.time = 0.0
+        self.statements = Counter()
+
+    def add(self, statement, elapsed):
+        ''' Record a statement that took ``elapsed`` seconds. '''
+
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        '''
+        Return a list of (shape, count) for statement shapes that ran more
+        than ``threshold`` times, most frequent first.
+        '''
+
+        # Statements are counted verbatim while the request runs, which is
+        # cheap, and only merged by shape here, once per request.
+        shapes = Counter()
+
+        for statement, count in self.statements.items():
+            shapes[statement_shape(statement)] += count
+
+        return [(shape, count) for shape, count in shapes.most_common()
+                if count > threshold]
+
+
+class LazySession:
+    ''' A proxy that creates a session when it is first used. '''
+
+    def __init__(self, choose_engine):
+        ''' Constructor. '''
+
+        self._choose_engine = choose_engine
+        self._session = None
+
+    def close(self):
+        ''' Close the session, if it was created. '''
+
+        if self._session is not None:
+            self._session.close()
+
+    def reset(self):
+        '''
+        Close the session, if it was created, so that the next use creates a
+        new session and chooses its engine again.
+        '''
+
+        self.close()
+        self._session = None
+
+    def __getattr__(self, name):
+        ''' Create the session if necessary and delegate to it. '''
+
+        if self._session is None:
+            self._session = get_session(self._choose_engine())
+
+        return getattr(self._session, name)
@@ -0,0 +1,150 @@
+'''
+Version counters for conditional GET requests.
+
+Each profile has a version counter in Redis that is incremented whenever the
+profile or its posts, relations, notes, labels, or avatar change. Views build
+ETags from these counters, so they can answer `If-None-Match` with 304 NOT
+MODIFIED without running any database queries.
+
+Some data is shown outside of its own profile: label names, and the usernames
+and avatars of related profiles. Changes to those increment global generation
+counters that are also included in the ETags of the views that display them.
+'''
+
+import hashlib
+import time
+
+from flask import g, request, Response
+
+
+LABEL_GENERATION_KEY = 'etag:label'
+PROFILE_VERSION_KEY = 'etag:profile:{}'
+SUMMARY_GENERATION_KEY = 'etag:summary'
+
+
+def bump_label_generation(redis):
+    ''' Mark that a label was renamed or deleted. '''
+
+    _increment(redis, LABEL_GENERATION_KEY)
+
+
+def bump_profile_version(redis, profile_id):
+    ''' Mark that a profile or any of its related data changed. '''
+
+    _increment(redis, PROFILE_VERSION_KEY.format(profile_id))
+
+
+def bump_profile_versions(redis, profile_ids):
+    ''' Mark that several profiles changed, in one round trip. '''
+
+    now = int(time.time() * 1000)
+    pipeline = redis.pipeline()
+
+    # Same as _increment(): initialize missing counters from the clock.
+    for profile_id in profile_ids:
+        key = PROFILE_VERSION_KEY.format(profile_id)
+        pipeline.setnx(key, now)
+        pipeline.incr(key)
+
+    pipeline.execute()
+
+
+def bump_summary_generation(redis):
+    '''
+    Mark that some profile's username or current avatar changed.
+
+    These are displayed in other profiles' relation listings.
+    '''
+
+    _increment(redis, SUMMARY_GENERATION_KEY)
+
+
+def get_version(redis, key):
+    '''
+    Get the value of a version counter.
+
+    A missing counter is initialized from the clock rather than zero. If Redis
+    is ever flushed, new versions will not collide with ETags that clients
+    cached before the flush.
+    '''
+
+    version = redis.get(key)
+
+    if version is None:
+        redis.setnx(key, int(time.time() * 1000))
+        version = redis.get(key)
+
+    return int(version)
+
+
+def make_etag(*parts):
+    ''' Combine version numbers and other values into an opaque ETag. '''
+
+    encoded = '\x00'.join(str(part) for part in parts).encode('utf8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def profile_etag(redis, profile_id, *extra_keys):
+    '''
+    Make an ETag for a view of a profile.
+
+    The ETag covers the profile's own version counter, the global counters
+    named by ``extra_keys``, and the request's query string (since paging and
+    sorting arguments change the response). The rest of the request reads from
+    the primary database, so that the body is at least as new as the ETag.
+    '''
+
+    _read_from_primary()
+    versions = [get_version(redis, PROFILE_VERSION_KEY.format(profile_id))]
+    versions.extend(get_version(redis, key) for key in extra_keys)
+
+    return make_etag(profile_id, request.path, request.query_string,
+                     *versions)
+
+
+def not_modified(etag):
+    '''
+    Return a 304 response if the client already has the current version.
+
+    Returns None if the client needs a full response.
+    '''
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        set_etag(response, etag)
+        return response
+
+    return None
+
+
+def set_etag(response, etag):
+    ''' Attach an ETag to a response and require revalidation. '''
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
+
+
+def _read_from_primary():
+    '''
+    Send the rest of this request's queries to the primary database.
+
+    Workers bump version counters right after committing, and clients re-fetch
+    as soon as they are notified. A replica may not have replayed that commit
+    yet, and a stale body would then be cached under the new ETag and
+    revalidated with 304s until the next change. So views that use ETags must
+    read from the primary. A session that authentication already opened (on a
+    replica) is discarded.
+    '''
+
+    if not g.get('db_primary', False):
+        g.db_primary = True
+        g.db.reset()
+
+
+def _increment(redis, key):
+    ''' Increment a version counter, initializing it if necessary. '''
+
+    get_version(redis, key)
+    redis.incr(key)
@@ -0,0 +1,192 @@
+'''
+An index of failed background tasks.
+
+RQ keeps failed jobs in a single list, and a job's metadata can only be read by
+loading the job itself, so listing or filtering the failed queue directly gets
+slower with every failure. This module keeps failed job IDs in sorted sets
+(scored by the time of failure, overall and per task type and per profile),
+which makes each page of a filtered listing a couple of cheap Redis commands.
+
+Workers add jobs to the index after moving them to the failed queue. The index
+is also reconciled with the failed queue whenever their sizes differ, and at
+least every few minutes regardless. This picks up jobs that failed without
+running the worker's exception handler (e.g. a killed work horse) and jobs
+that were added to or removed from the queue by other tools.
+'''
+
+import calendar
+import time
+
+import rq
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+
+INDEX_KEY = 'tasks:failed'
+TYPE_KEY = 'tasks:failed:type:{}'
+PROFILE_KEY = 'tasks:failed:profile:{}'
+
+# Hash of the filter values that a job was indexed under.
+JOB_KEY = 'tasks:failed:job:{}'
+
+# Temporary result of intersecting two filters.
+QUERY_KEY = 'tasks:failed:query:{}:{}'
+
+# Exists while a full reconciliation is not yet due.
+RECONCILED_KEY = 'tasks:failed:reconciled'
+
+# Seconds between full reconciliations when the sizes match.
+RECONCILE_INTERVAL = 300
+
+
+def add(redis, job, failed_at=None):
+    ''' Add a failed job to the index. '''
+
+    if failed_at is None:
+        failed_at = time.time()
+
+    type_ = job.meta.get('type')
+    profile_id = job.meta.get('profile_id')
+    fields = {}
+
+    pipeline = redis.pipeline()
+    pipeline.zadd(INDEX_KEY, {job.id: failed_at})
+
+    if type_ is not None:
+        pipeline.zadd(TYPE_KEY.format(type_), {job.id: failed_at})
+        fields['type'] = type_
+
+    if profile_id is not None:
+        pipeline.zadd(PROFILE_KEY.format(profile_id), {job.id: failed_at})
+        fields['profile_id'] = profile_id
+
+    pipeline.delete(JOB_KEY.format(job.id))
+
+    if len(fields) > 0:
+        pipeline.hmset(JOB_KEY.format(job.id), fields)
+
+    pipeline.execute()
+
+
+def clear(redis):
+    ''' Remove all jobs from the index. '''
+
+    keys = list(redis.scan_iter(match=INDEX_KEY + ':*', count=1000))
+    keys.append(INDEX_KEY)
+    redis.delete(*keys)
+
+
+def query(redis, type_=None, profile_id=None, offset=0, limit=10):
+    '''
+    Get a page of failed job IDs, most recent failures first.
+
+    If ``limit`` is None, all IDs after ``offset`` are returned. Returns a
+    tuple (job_ids, total_count).
+    '''
+
+    end = -1 if limit is None else offset + limit - 1
+
+    if type_ is not None and profile_id is not None:
+        key = QUERY_KEY.format(type_, profile_id)
+        pipeline = redis.pipeline()
+        pipeline.zinterstore(key, [TYPE_KEY.format(type_),
+                                   PROFILE_KEY.format(profile_id)],
+                             aggregate='MAX')
+        pipeline.zrevrange(key, offset, end)
+        pipeline.delete(key)
+        total_count, job_ids, _ = pipeline.execute()
+    else:
+        if type_ is not None:
+            key = TYPE_KEY.format(type_)
+        elif profile_id is not None:
+            key = PROFILE_KEY.format(profile_id)
+        else:
+            key = INDEX_KEY
+
+        pipeline = redis.pipeline()
+        pipeline.zcard(key)
+        pipeline.zrevrange(key, offset, end)
+        total_count, job_ids = pipeline.execute()
+
+    return [id_.decode('ascii') for id_ in job_ids], total_count
+
+
+def reconcile(redis):
+    '''
+    Make the index match the failed queue, if their sizes differ or a full
+    reconciliation is due.
+
+    IDs of jobs that no longer exist are removed from the failed queue, so
+    that they do not keep the sizes different. Returns the number of jobs
+    added to and removed from the index.
+    '''
+
+    failed_queue = rq.get_failed_queue(connection=redis)
+
+    if failed_queue.count == redis.zcard(INDEX_KEY) and \
+       not redis.set(RECONCILED_KEY, 1, ex=RECONCILE_INTERVAL, nx=True):
+        return 0
+
+    queued = set(failed_queue.job_ids)
+    indexed = {id_.decode('ascii') for id_ in redis.zrange(INDEX_KEY, 0, -1)}
+    missing = queued - indexed
+    stale = indexed - queued
+    dead = []
+
+    for job_id in missing:
+        try:
+            job = Job.fetch(job_id, connection=redis)
+        except NoSuchJobError:
+            dead.append(job_id)
+            continue
+
+        if job.ended_at is not None:
+            # RQ timestamps are naive UTC datetimes.
+            failed_at = calendar.timegm(job.ended_at.utctimetuple())
+        else:
+            failed_at = None
+
+        add(redis, job, failed_at)
+
+    if len(dead) > 0:
+        pipeline = redis.pipeline()
+
+        for job_id in dead:
+            pipeline.lrem(failed_queue.key, 1, job_id)
+
+        pipeline.execute()
+
+    remove(redis, stale)
+
+    return len(missing) + len(stale)
+
+
+def remove(redis, job_ids):
+    ''' Remove jobs from the index. '''
+
+    job_ids = list(job_ids)
+
+    if len(job_ids) == 0:
+        return
+
+    pipeline = redis.pipeline()
+
+    for job_id in job_ids:
+        pipeline.hgetall(JOB_KEY.format(job_id))
+
+    filters = pipeline.execute()
+    pipeline = redis.pipeline()
+    pipeline.zrem(INDEX_KEY, *job_ids)
+
+    for job_id, fields in zip(job_ids, filters):
+        if b'type' in fields:
+            type_ = fields[b'type'].decode('utf8')
+            pipeline.zrem(TYPE_KEY.format(type_), job_id)
+
+        if b'profile_id' in fields:
+            profile_id = fields[b'profile_id'].decode('utf8')
+            pipeline.zrem(PROFILE_KEY.format(profile_id), job_id)
+
+        pipeline.delete(JOB_KEY.format(job_id))
+
+    pipeline.execute()
@@ -0,0 +1,155 @@
+'''
+A cache for File metadata.
+
+File records never change after they are created, so the information needed to
+serve a file (its path relative to the data directory and its MIME type) can be
+cached indefinitely. Lookups check a small LRU cache in the current process
+first, then (optionally) Redis, and only then the database.
+
+Workers warm the Redis cache when they create files, so that the first request
+for a new avatar does not need a database query either.
+'''
+
+from collections import OrderedDict
+import threading
+
+from model import File
+
+
+REDIS_KEY = 'file:meta:{}'
+
+# Redis entries expire eventually so that unused files don't use memory
+# forever.
+REDIS_TTL = 7 * 24 * 60 * 60
+
+_cache = None
+
+
+class LruCache:
+    ''' A thread-safe, bounded, least-recently-used cache. '''
+
+    def __init__(self, max_size):
+        ''' Constructor. '''
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Return the value for `key`, or None if not cached. '''
+
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        ''' Store a value, evicting the least recently used if necessary. '''
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        ''' Return the number of cached items. '''
+
+        return len(self._data)
+
+
+def get_file_metadata(config, db, redis, id_):
+    '''
+    Get metadata for the File identified by ``id_``.
+
+    Returns a tuple (relpath, mime), or None if the file does not exist.
+    '''
+
+    cache = _get_cache(config)
+    metadata = cache.get(id_)
+
+    if metadata is not None:
+        return metadata
+
+    use_redis = config.getboolean('file', 'cache_redis')
+
+    if use_redis:
+        cached = redis.hmget(REDIS_KEY.format(id_), 'relpath', 'mime')
+
+        if cached[0] is not None:
+            metadata = (
+                cached[0].decode('utf8'),
+                cached[1].decode('utf8') if cached[1] else None,
+            )
+            cache.put(id_, metadata)
+            return metadata
+
+    file_ = db.query(File).filter(File.id == id_).first()
+
+    if file_ is None:
+        return None
+
+    metadata = (file_.relpath(), file_.mime)
+    cache.put(id_, metadata)
+
+    if use_redis:
+        _store(redis, file_)
+
+    return metadata
+
+
+def stats(config):
+    ''' Return statistics about this process's cache. '''
+
+    cache = _get_cache(config)
+    lookups = cache.hits + cache.misses
+
+    return {
+        'hit_rate': cache.hits / lookups if lookups > 0 else None,
+        'hits': cache.hits,
+        'max_size': cache.max_size,
+        'misses': cache.misses,
+        'size': len(cache),
+    }
+
+
+def warm(config, redis, file_):
+    '''
+    Store metadata for a newly created File in Redis.
+
+    This does nothing if Redis caching is disabled.
+    '''
+
+    if config.getboolean('file', 'cache_redis'):
+        _store(redis, file_)
+
+
+def _get_cache(config):
+    ''' Return the process-wide cache, creating it if necessary. '''
+
+    global _cache
+
+    if _cache is None:
+        _cache = LruCache(config.getint('file', 'cache_size'))
+
+    return _cache
+
+
+def _store(redis, file_):
+    ''' Store a File's metadata in Redis. '''
+
+    key = REDIS_KEY.format(file_.id)
+    mapping = {'relpath': file_.relpath(), 'mime': file_.mime or ''}
+    pipeline = redis.pipeline()
+    pipeline.hmset(key, mapping)
+    pipeline.expire(key, REDIS_TTL)
+    pipeline.execute()
@@ -6,6 +6,12 @@ from markdown import markdown
 from app.rest import isodate
 
 
+# Redis key holding the index generation counter. Every writer that commits to
+# Solr bumps this counter, which implicitly invalidates any search results that
+# were cached under an older generation.
+GENERATION_KEY = 'index:generation'
+
+
 def make_post_doc(post, author):
     ''' Take a Post object and turn it into a Solr document. '''
 
@@ -63,3 +69,25 @@ def make_profile_doc(profile):
         doc['last_update_tdt'] = last_update,
 
     return doc
+
+
+def get_generation(redis):
+    ''' Return the current index generation. '''
+
+    generation = redis.get(GENERATION_KEY)
+
+    if generation is None:
+        return 0
+    else:
+        return int(generation)
+
+
+def bump_generation(redis):
+    '''
+    Increment the index generation.
+
+    This should be called after each Solr commit so that cached search
+    results are not served for a stale index.
+    '''
+
+    return redis.incr(GENERATION_KEY)
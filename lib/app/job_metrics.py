@@ -0,0 +1,240 @@
+'''
+Rolling histograms of background job timings, stored in Redis.
+
+Each job records how long it waited in its queue, how long it ran, how much of
+that time was spent on HTTP, database, and Solr requests, and how many items it
+processed. Measurements are aggregated per job type into one Redis hash per
+minute, so a summary over any recent window can be computed by reading a
+handful of small hashes, and old data simply expires.
+'''
+
+import bisect
+import calendar
+import time
+
+
+# Hash of measurements for one job type in one minute.
+METRICS_KEY = 'job_metrics:{}:{}'
+
+# Hash of measurements for one job type since metrics were first recorded.
+TOTALS_KEY = 'job_metrics:totals:{}'
+
+# Set of job types that have recorded measurements.
+TYPES_KEY = 'job_metrics:types'
+
+# Hash counting HTTP requests made by jobs, by host and status.
+HTTP_REQUESTS_KEY = 'job_metrics:http_requests'
+
+# Measurements recorded for each job. Items are a count; the rest are seconds.
+METRICS = ('queue_wait', 'run_time', 'http_time', 'db_time', 'solr_time',
+           'items')
+
+# Upper bounds of histogram buckets. The same bounds serve both durations in
+# seconds and item counts. Larger values fall into a final "inf" bucket.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100,
+           250, 500, 1000, 2500, 5000, 10000)
+
+PERCENTILES = (50, 95, 99)
+
+
+class JobTimer:
+    '''
+    Accumulates measurements for the job that is running in this process.
+
+    HTTP and database time are added by the code that makes those requests.
+    Solr time is the growth of the Solr session's ``wall_time`` counter while
+    the job runs.
+    '''
+
+    def __init__(self, enqueued_at, solr_time):
+        ''' Constructor. '''
+
+        self.started = time.perf_counter()
+        self.queue_wait = None
+        self.http_time = 0.0
+        self.db_time = 0.0
+        self._solr_time = solr_time
+
+        if enqueued_at is not None:
+            # RQ timestamps are naive UTC datetimes.
+            enqueued = calendar.timegm(enqueued_at.utctimetuple())
+            self.queue_wait = max(0.0, time.time() - enqueued)
+
+    def measurements(self, solr_time, items=None):
+        ''' Return a dictionary of measurements for the finished job. '''
+
+        measurements = {
+            'run_time': time.perf_counter() - self.started,
+            'http_time': self.http_time,
+            'db_time': self.db_time,
+            'solr_time': max(0.0, solr_time - self._solr_time),
+        }
+
+        if self.queue_wait is not None:
+            measurements['queue_wait'] = self.queue_wait
+
+        if items is not None:
+            measurements['items'] = items
+
+        return measurements
+
+
+def record(redis, job_type, status, measurements, retention):
+    '''
+    Add one job's measurements to the current minute's histograms.
+
+    ``status`` is "finished" or "failed". ``retention`` is the number of
+    minutes to keep data for.
+    '''
+
+    minute = int(time.time() // 60)
+    key = METRICS_KEY.format(job_type, minute)
+
+    pipeline = redis.pipeline()
+    pipeline.sadd(TYPES_KEY, job_type)
+
+    # The same fields are added to the current minute's hash and to the
+    # running totals, which the metrics exporter reads.
+    for hash_key in (key, TOTALS_KEY.format(job_type)):
+        pipeline.hincrby(hash_key, 'jobs:{}'.format(status), 1)
+
+        for metric, value in measurements.items():
+            pipeline.hincrby(hash_key,
+                             '{}:{}'.format(metric, _bucket(value)), 1)
+            pipeline.hincrby(hash_key, '{}:count'.format(metric), 1)
+            pipeline.hincrbyfloat(hash_key, '{}:sum'.format(metric), value)
+
+    pipeline.expire(key, retention * 60)
+    pipeline.execute()
+
+
+def record_http_request(redis, host, status):
+    '''
+    Count an HTTP request made by a job.
+
+    ``status`` is the response's status code, or "error" if no response was
+    received.
+    '''
+
+    redis.hincrby(HTTP_REQUESTS_KEY, '{} {}'.format(host, status), 1)
+
+
+def summarize(redis, window):
+    '''
+    Summarize measurements for each job type over the last ``window`` minutes.
+
+    Returns a dictionary keyed by job type. Percentiles are estimated from the
+    histograms: each one is the upper bound of the bucket that contains it.
+    '''
+
+    now = int(time.time() // 60)
+    minutes = range(now - window + 1, now + 1)
+    job_types = sorted(t.decode('utf8') for t in redis.smembers(TYPES_KEY))
+
+    pipeline = redis.pipeline()
+
+    for job_type in job_types:
+        for minute in minutes:
+            pipeline.hgetall(METRICS_KEY.format(job_type, minute))
+
+    results = iter(pipeline.execute())
+    summary = {}
+
+    for job_type in job_types:
+        totals = {}
+
+        for _ in minutes:
+            for field, value in next(results).items():
+                field = field.decode('ascii')
+                totals[field] = totals.get(field, 0) + float(value)
+
+        if len(totals) > 0:
+            summary[job_type] = _summarize_type(totals, window)
+
+    return summary
+
+
+def totals(redis):
+    '''
+    Get the running totals of measurements for each job type.
+
+    Returns a dictionary keyed by job type, where each value is a dictionary
+    of histogram fields (see `record()`).
+    '''
+
+    job_types = sorted(t.decode('utf8') for t in redis.smembers(TYPES_KEY))
+    pipeline = redis.pipeline()
+
+    for job_type in job_types:
+        pipeline.hgetall(TOTALS_KEY.format(job_type))
+
+    results = {}
+
+    for job_type, fields in zip(job_types, pipeline.execute()):
+        results[job_type] = {field.decode('ascii'): float(value)
+                             for field, value in fields.items()}
+
+    return results
+
+
+def _bucket(value):
+    ''' Return the name of the histogram bucket for ``value``. '''
+
+    index = bisect.bisect_left(BUCKETS, value)
+
+    if index == len(BUCKETS):
+        return 'inf'
+    else:
+        return str(BUCKETS[index])
+
+
+def _percentile(totals, metric, count, percentile):
+    ''' Estimate a percentile from a histogram. '''
+
+    rank = count * percentile / 100
+    seen = 0
+
+    for bound in BUCKETS:
+        seen += totals.get('{}:{}'.format(metric, bound), 0)
+
+        if seen >= rank:
+            return bound
+
+    # The percentile is in the unbounded bucket, so report its lower bound.
+    return BUCKETS[-1]
+
+
+def _summarize_type(totals, window):
+    ''' Summarize one job type's aggregated histogram fields. '''
+
+    finished = int(totals.get('jobs:finished', 0))
+    failed = int(totals.get('jobs:failed', 0))
+
+    summary = {
+        'failed': failed,
+        'finished': finished,
+        'jobs_per_minute': (finished + failed) / window,
+    }
+
+    for metric in METRICS:
+        count = int(totals.get('{}:count'.format(metric), 0))
+
+        if count == 0:
+            continue
+
+        total = totals['{}:sum'.format(metric)]
+        summary[metric] = {
+            'count': count,
+            'mean': total / count,
+            'sum': total,
+        }
+
+        for percentile in PERCENTILES:
+            summary[metric]['p{}'.format(percentile)] = \
+                _percentile(totals, metric, count, percentile)
+
+    if 'items' in summary and summary['run_time']['sum'] > 0:
+        summary['items_per_second'] = \
+            summary['items']['sum'] / summary['run_time']['sum']
+
+    return summary
@@ -0,0 +1,434 @@
+'''
+Lightweight metrics in the Prometheus text exposition format.
+
+Counters and histograms are kept in memory by each process and rendered on
+demand. Recording a value takes a lock and a few arithmetic operations, so
+instrumentation can be left on in production. Values that are already tracked
+elsewhere (such as connection pool statistics) are read by collector functions
+when the metrics are rendered, so they cost nothing in between.
+
+A web server runs many processes, and a scrape reaches only one of them. So
+each process periodically publishes its metrics to Redis. Counters and
+histograms are added to running totals that all processes share, so they keep
+going up when a process is recycled. Gauges describe a live process, so each
+process publishes a snapshot of them that expires shortly after the process
+stops publishing, and the snapshots of all live processes are added up.
+'''
+
+from collections import namedtuple, OrderedDict
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+
+_logger = logging.getLogger('metrics')
+_publisher_lock = threading.Lock()
+_publisher_pid = None
+
+# The value of each counter and histogram sample that this process has added
+# to the running totals, keyed by its field in TOTALS_KEY.
+_published = {}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Running totals of counter and histogram samples from all processes. Each
+# field is a JSON list [name, suffix, labels].
+TOTALS_KEY = 'metrics:totals'
+
+# The type and description of each metric in TOTALS_KEY, as a JSON list.
+FAMILIES_KEY = 'metrics:families'
+
+# Each process's latest gauge values.
+SNAPSHOT_KEY = 'metrics:process:{}'
+
+# Upper bounds (seconds) of latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+# A metric and its current samples. Each sample is a tuple (suffix, labels,
+# value), where ``suffix`` is appended to the metric name (e.g. "_bucket") and
+# ``labels`` is a dictionary.
+MetricFamily = namedtuple('MetricFamily',
+                          ['name', 'type', 'description', 'samples'])
+
+
+class Counter:
+    ''' A value that only goes up, optionally split by labels. '''
+
+    def __init__(self, name, description, labels=()):
+        ''' Constructor. '''
+
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def collect(self):
+        ''' Return a `MetricFamily` with this counter's current values. '''
+
+        with self._lock:
+            values = list(self._values.items())
+
+        samples = [('_total', dict(zip(self.labels, key)), value)
+                   for key, value in sorted(values)]
+
+        return MetricFamily(self.name, 'counter', self.description, samples)
+
+    def inc(self, amount=1, **labels):
+        ''' Increment the counter for the given label values. '''
+
+        key = tuple(str(labels[label]) for label in self.labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram:
+    ''' Counts observations in buckets, optionally split by labels. '''
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        ''' Constructor. '''
+
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def collect(self):
+        ''' Return a `MetricFamily` with this histogram's current values. '''
+
+        with self._lock:
+            values = [(key, (list(counts), total))
+                      for key, (counts, total) in self._values.items()]
+
+        samples = []
+
+        for key, (counts, total) in sorted(values):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = dict(labels, le=_format_value(bound))
+                samples.append(('_bucket', bucket_labels, cumulative))
+
+            samples.append(('_count', labels, cumulative))
+            samples.append(('_sum', labels, total))
+
+        return MetricFamily(self.name, 'histogram', self.description, samples)
+
+    def observe(self, value, **labels):
+        ''' Record an observation for the given label values. '''
+
+        key = tuple(str(labels[label]) for label in self.labels)
+        index = len(self.buckets)
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+            entry = self._values[key]
+            entry[0][index] += 1
+            entry[1] += value
+
+
+class Registry:
+    ''' A set of metrics and collectors that are rendered together. '''
+
+    def __init__(self):
+        ''' Constructor. '''
+
+        self._lock = threading.Lock()
+        self._metrics = []
+        self._collectors = []
+
+    def add_collector(self, collector):
+        '''
+        Register a function that is called each time metrics are rendered.
+
+        The function takes no arguments and returns a list of `MetricFamily`.
+        '''
+
+        with self._lock:
+            self._collectors.append(collector)
+
+    def counter(self, name, description, labels=()):
+        ''' Create and register a `Counter`. '''
+
+        counter = Counter(name, description, labels)
+
+        with self._lock:
+            self._metrics.append(counter)
+
+        return counter
+
+    def histogram(self, name, description, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        ''' Create and register a `Histogram`. '''
+
+        histogram = Histogram(name, description, labels, buckets)
+
+        with self._lock:
+            self._metrics.append(histogram)
+
+        return histogram
+
+    def collect(self):
+        ''' Return a list of `MetricFamily` for all metrics. '''
+
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        families = [metric.collect() for metric in metrics]
+
+        for collector in collectors:
+            families.extend(collector())
+
+        return families
+
+
+def counter_family(name, description, samples):
+    '''
+    Make a counter `MetricFamily` for a collector.
+
+    ``samples`` is a list of tuples (labels, value).
+    '''
+
+    return MetricFamily(name, 'counter', description,
+                        [('_total', labels, value) for labels, value in samples])
+
+
+def gauge_family(name, description, samples):
+    '''
+    Make a gauge `MetricFamily` for a collector.
+
+    ``samples`` is a list of tuples (labels, value).
+    '''
+
+    return MetricFamily(name, 'gauge', description,
+                        [('', labels, value) for labels, value in samples])
+
+
+def collect_published(redis):
+    '''
+    Return a list of `MetricFamily` with the metrics that all processes have
+    published.
+    '''
+
+    pipeline = redis.pipeline()
+    pipeline.hgetall(FAMILIES_KEY)
+    pipeline.hgetall(TOTALS_KEY)
+    descriptions, totals = pipeline.execute()
+    merged = OrderedDict()
+
+    for field, value in totals.items():
+        name, suffix, labels = json.loads(field.decode('utf8'))
+        description = descriptions.get(name.encode('utf8'))
+
+        if description is None:
+            continue
+
+        if name not in merged:
+            type_, text = json.loads(description.decode('utf8'))
+            merged[name] = (type_, text, [])
+
+        merged[name][2].append((suffix, dict(labels), _parse_value(value)))
+
+    # Gauges are added up over the snapshots of live processes.
+    keys = list(redis.scan_iter(match=SNAPSHOT_KEY.format('*'), count=1000))
+    snapshots = redis.mget(keys) if len(keys) > 0 else []
+    gauges = OrderedDict()
+
+    for snapshot in snapshots:
+        if snapshot is None:
+            continue
+
+        for name, type_, description, samples in json.loads(snapshot):
+            if type_ != 'gauge':
+                continue
+
+            if name not in gauges:
+                gauges[name] = (type_, description, OrderedDict())
+
+            values = gauges[name][2]
+
+            for suffix, labels, value in samples:
+                key = (suffix, tuple(sorted(labels.items())))
+                values[key] = values.get(key, 0) + value
+
+    for name, (type_, description, values) in gauges.items():
+        merged[name] = (type_, description,
+                        [(suffix, dict(labels), value)
+                         for (suffix, labels), value in values.items()])
+
+    families = []
+
+    for name, (type_, description, samples) in sorted(merged.items()):
+        samples.sort(key=_sample_order)
+        families.append(MetricFamily(name, type_, description, samples))
+
+    return families
+
+
+def publish_snapshot(redis, registry, ttl):
+    '''
+    Publish this process's metrics to Redis.
+
+    Each counter and histogram sample's growth since the last call is added to
+    the running totals. Gauges are stored in a snapshot that expires after
+    ``ttl`` seconds.
+    '''
+
+    gauges = []
+    published = {}
+    pipeline = redis.pipeline()
+
+    for family in registry.collect():
+        if family.type == 'gauge':
+            gauges.append(family)
+            continue
+
+        pipeline.hset(FAMILIES_KEY, family.name,
+                      json.dumps([family.type, family.description]))
+
+        for suffix, labels, value in family.samples:
+            field = json.dumps([family.name, suffix, sorted(labels.items())])
+            delta = value - _published.get(field, 0)
+
+            # A smaller value means the source was reset (e.g. a collector's
+            # object was replaced), so all of the new value is growth.
+            if delta < 0:
+                delta = value
+
+            if delta != 0:
+                pipeline.hincrbyfloat(TOTALS_KEY, field, delta)
+
+            published[field] = value
+
+    process_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    pipeline.setex(SNAPSHOT_KEY.format(process_id), ttl, json.dumps(gauges))
+    pipeline.execute()
+
+    # Only count values as published once Redis has them.
+    _published.update(published)
+
+
+def start_publisher(redis, interval, registry=None):
+    '''
+    Publish snapshots of this process's metrics every ``interval`` seconds.
+
+    This may be called more than once, e.g. on every request: only the first
+    call in each process starts a publisher thread.
+    '''
+
+    global _publisher_pid
+
+    if _publisher_pid == os.getpid():
+        return
+
+    with _publisher_lock:
+        if _publisher_pid == os.getpid():
+            return
+
+        _publisher_pid = os.getpid()
+
+    if registry is None:
+        registry = REGISTRY
+
+    def publish_forever():
+        while True:
+            try:
+                publish_snapshot(redis, registry, interval * 3)
+            except Exception:
+                _logger.exception('Could not publish metrics.')
+
+            time.sleep(interval)
+
+    thread = threading.Thread(target=publish_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+
+
+def render(families):
+    ''' Render a list of `MetricFamily` in the Prometheus text format. '''
+
+    lines = []
+
+    for family in families:
+        lines.append('# HELP {} {}'.format(family.name, family.description))
+        lines.append('# TYPE {} {}'.format(family.name, family.type))
+
+        for suffix, labels, value in family.samples:
+            if len(labels) > 0:
+                label_text = ','.join(
+                    '{}="{}"'.format(name, _escape(labels[name]))
+                    for name in sorted(labels)
+                )
+                lines.append('{}{}{{{}}} {}'.format(
+                    family.name, suffix, label_text, _format_value(value)
+                ))
+            else:
+                lines.append('{}{} {}'.format(family.name, suffix,
+                                              _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    ''' Escape a label value. '''
+
+    return str(value).replace('\\', '\\\\') \
+                     .replace('"', '\\"') \
+                     .replace('\n', '\\n')
+
+
+def _parse_value(value):
+    ''' Parse a running total read from Redis. '''
+
+    value = float(value)
+
+    return int(value) if value.is_integer() else value
+
+
+def _sample_order(sample):
+    '''
+    Sort key that groups samples by labels, with histogram buckets in order
+    of their bounds, followed by the count and sum.
+    '''
+
+    suffix, labels, _ = sample
+    other_labels = sorted((name, value) for name, value in labels.items()
+                          if name != 'le')
+    bound = float(labels['le']) if 'le' in labels else 0
+
+    return (other_labels, suffix != '_bucket', suffix, bound)
+
+
+def _format_value(value):
+    ''' Format a sample value. '''
+
+    if value == math.inf:
+        return '+Inf'
+    elif isinstance(value, bool):
+        return '1' if value else '0'
+    else:
+        return repr(value)
+
+
+# Metrics for this process.
+REGISTRY = Registry()
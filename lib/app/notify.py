@@ -0,0 +1,409 @@
+'''
+Publish notifications and fan them out to many local subscribers.
+
+Notifications are appended to a capped Redis Stream. Each entry's stream ID is
+used as the SSE event ID, so a client that reconnects with a `Last-Event-ID`
+header can be sent exactly the events that it missed.
+
+Each process runs a single hub thread that reads new entries from the stream.
+Every open notification stream registers a subscriber with the hub and then
+blocks on its own in-memory queue, so the number of Redis connections does not
+grow with the number of connected clients and no thread has to poll.
+'''
+
+from collections import namedtuple
+import json
+import logging
+import queue
+import threading
+import time
+
+
+STREAM_KEY = 'notification:stream'
+
+# The stream is trimmed to approximately this many entries.
+STREAM_MAXLEN = 10000
+
+# Channels whose messages identify a profile by ID, and the key that holds it.
+PROFILE_KEYS = {
+    'avatar': 'id',
+    'profile': 'id',
+    'profile_notes': 'profile_id',
+    'profile_posts': 'id',
+    'profile_relations': 'id',
+    'worker': 'profile_id',
+}
+
+_logger = logging.getLogger('notify')
+
+Event = namedtuple('Event', ['id', 'channel', 'data', 'payload'])
+
+
+def publish(redis, channel, data):
+    '''
+    Publish a notification.
+
+    ``data`` is a string, usually JSON. Returns the new event's ID.
+    '''
+
+    event_id = redis.xadd(
+        STREAM_KEY,
+        {'channel': channel, 'data': data},
+        maxlen=STREAM_MAXLEN,
+        approximate=True
+    )
+
+    return event_id.decode('ascii')
+
+
+def replay(redis, last_event_id, count=STREAM_MAXLEN):
+    '''
+    Get the events published after ``last_event_id``.
+
+    Returns a tuple (events, complete). ``events`` is a list of `Event`
+    tuples. ``complete`` is False if some of the requested events have already
+    been trimmed from the stream (or the ID is not valid), in which case the
+    client should reload its state instead.
+    '''
+
+    try:
+        last_key = parse_event_id(last_event_id)
+    except ValueError:
+        return [], False
+
+    oldest = redis.xrange(STREAM_KEY, count=1)
+
+    if len(oldest) == 0:
+        # The stream is empty, so nothing could have been published since
+        # this client's last event, unless Redis was flushed.
+        return [], True
+
+    # If the client's last event is no longer in the stream, then events after
+    # it may have been trimmed too.
+    oldest_key = parse_event_id(oldest[0][0].decode('ascii'))
+    complete = oldest_key <= last_key
+
+    entries = redis.xrange(STREAM_KEY, min=last_event_id, count=count + 1)
+    events = [_decode_entry(id_, fields) for id_, fields in entries]
+
+    # XRANGE is inclusive, so drop the event the client already has.
+    if len(events) > 0 and events[0].id == last_event_id:
+        events.pop(0)
+
+    if len(events) > count:
+        del events[count:]
+        complete = False
+
+    return events, complete
+
+
+def parse_event_id(event_id):
+    '''
+    Parse a stream ID into a tuple of integers, so that IDs can be compared.
+
+    Raises ValueError if the ID is not valid.
+    '''
+
+    millis, _, sequence = event_id.partition('-')
+    return int(millis), int(sequence or 0)
+
+
+def _decode_entry(id_, fields):
+    '''
+    Convert a raw stream entry into an `Event`.
+
+    The data is decoded once here so that subscribers can filter on it.
+    '''
+
+    data = fields[b'data'].decode('utf8')
+
+    try:
+        payload = json.loads(data)
+    except ValueError:
+        payload = None
+
+    if not isinstance(payload, dict):
+        payload = {}
+
+    return Event(
+        id_.decode('ascii'),
+        fields[b'channel'].decode('utf8'),
+        data,
+        payload
+    )
+
+
+class Interests:
+    '''
+    The notifications that a subscriber wants to receive.
+
+    An event is wanted if its channel is one of ``channels`` and it passes the
+    ID filters. If ``profile_ids`` or ``job_ids`` is given, then an event that
+    refers to a profile or a job must match at least one of the given IDs.
+    Events that refer to neither (such as label changes) are always wanted.
+    '''
+
+    def __init__(self, channels, profile_ids=None, job_ids=None):
+        ''' Constructor. '''
+
+        self.channels = frozenset(channels)
+        self.profile_ids = profile_ids
+        self.job_ids = job_ids
+
+    def wants(self, event):
+        ''' Return True if ``event`` matches these interests. '''
+
+        if event.channel not in self.channels:
+            return False
+
+        if self.profile_ids is None and self.job_ids is None:
+            return True
+
+        filtered = False
+
+        if self.profile_ids is not None and event.channel in PROFILE_KEYS:
+            profile_id = event.payload.get(PROFILE_KEYS[event.channel])
+
+            if profile_id is not None:
+                if profile_id in self.profile_ids:
+                    return True
+
+                filtered = True
+
+        if self.job_ids is not None and event.channel == 'worker':
+            if event.payload.get('id') in self.job_ids:
+                return True
+
+            filtered = True
+
+        return not filtered
+
+
+class ProgressCoalescer:
+    '''
+    Limit the rate of worker progress events sent to a single client.
+
+    At most ``max_rate`` progress events per job are sent per second. When
+    progress events arrive faster than that, only the latest one is held and
+    it is sent when the job's interval elapses. Any other event for the job
+    (e.g. finished or failed) replaces a held progress event, so events are
+    never sent out of order.
+
+    A held event is sent under the newest ID that the coalescer has seen, so
+    that the client's `Last-Event-ID` never goes backwards and a reconnect
+    does not replay events that the client already has.
+    '''
+
+    def __init__(self, max_rate):
+        ''' Constructor. '''
+
+        self.interval = 1 / max_rate if max_rate > 0 else 0
+        self._last_sent = {}
+        self._pending = {}
+        self._newest_id = None
+        self._newest_key = None
+
+    def add(self, event, now):
+        ''' Add an event and return a list of events to send now. '''
+
+        key = parse_event_id(event.id)
+
+        if self._newest_key is None or key > self._newest_key:
+            self._newest_id = event.id
+            self._newest_key = key
+
+        if event.channel != 'worker' or self.interval == 0:
+            return [event]
+
+        job_id = event.payload.get('id')
+
+        if event.payload.get('status') != 'progress':
+            # The job's state changed, so any held progress is obsolete.
+            self._pending.pop(job_id, None)
+
+            if event.payload.get('status') in ('finished', 'failed'):
+                self._last_sent.pop(job_id, None)
+
+            return [event]
+
+        last_sent = self._last_sent.get(job_id)
+
+        if last_sent is None or now - last_sent >= self.interval:
+            self._pending.pop(job_id, None)
+            self._last_sent[job_id] = now
+            return [event]
+
+        self._pending[job_id] = event
+        return []
+
+    def flush(self, now):
+        ''' Return a list of held events that are now due. '''
+
+        due = []
+
+        for job_id, event in list(self._pending.items()):
+            if now - self._last_sent[job_id] >= self.interval:
+                del self._pending[job_id]
+                self._last_sent[job_id] = now
+                due.append(event)
+
+        due.sort(key=lambda event: parse_event_id(event.id))
+
+        return [event._replace(id=self._newest_id) for event in due]
+
+    def next_due(self, now):
+        '''
+        Return the number of seconds until a held event is due, or None if no
+        events are held.
+        '''
+
+        if len(self._pending) == 0:
+            return None
+
+        due_at = min(self._last_sent[job_id] + self.interval
+                     for job_id in self._pending)
+
+        return max(0, due_at - now)
+
+
+class Subscriber:
+    ''' A local subscriber's message queue. '''
+
+    def __init__(self, max_size, interests=None):
+        ''' Constructor. '''
+
+        self.closed = False
+        self.interests = interests
+        self._queue = queue.Queue(maxsize=max_size)
+
+    def get(self, timeout):
+        '''
+        Wait up to `timeout` seconds for a message.
+
+        Returns an `Event`, or None if the timeout expires.
+        '''
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, message):
+        '''
+        Add a message to this subscriber's queue without blocking.
+
+        Messages that do not match the subscriber's interests are ignored. If
+        the subscriber has fallen too far behind, it is closed instead. (The
+        client will reconnect and catch up from the stream.)
+        '''
+
+        if self.interests is not None and not self.interests.wants(message):
+            return
+
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.closed = True
+
+
+class NotificationHub:
+    ''' A single stream reader shared by all subscribers in a process. '''
+
+    def __init__(self, redis, queue_size=1000):
+        ''' Constructor. '''
+
+        self.queue_size = queue_size
+
+        self._redis = redis
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._should_quit = False
+        self._thread = None
+
+    def start(self):
+        ''' Start the hub's reader thread. '''
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='notification-hub')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        ''' Ask the reader thread to exit. '''
+
+        self._should_quit = True
+
+    def subscribe(self, interests=None):
+        '''
+        Register and return a new subscriber.
+
+        If ``interests`` is given, the subscriber only receives matching
+        events.
+        '''
+
+        subscriber = Subscriber(self.queue_size, interests)
+
+        with self._lock:
+            self._subscribers.add(subscriber)
+
+        return subscriber
+
+    def subscriber_count(self):
+        ''' Return the number of registered subscribers. '''
+
+        with self._lock:
+            return len(self._subscribers)
+
+    def unsubscribe(self, subscriber):
+        ''' Remove a subscriber. '''
+
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _publish(self, message):
+        ''' Deliver a message to all subscribers. '''
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+            if subscriber.closed:
+                _logger.warning('Dropping a notification subscriber that '
+                                'fell too far behind.')
+                self.unsubscribe(subscriber)
+
+    def _run(self):
+        ''' Reader thread: read new stream entries and fan them out. '''
+
+        last_id = None
+
+        while not self._should_quit:
+            try:
+                if last_id is None:
+                    # Only deliver events published after the hub starts.
+                    # Subscribers that need older events get them from
+                    # replay().
+                    newest = self._redis.xrevrange(STREAM_KEY, count=1)
+
+                    if len(newest) > 0:
+                        last_id = newest[0][0].decode('ascii')
+                    else:
+                        last_id = '0-0'
+
+                # Block in Redis for a short time so that the quit flag is
+                # still checked periodically.
+                response = self._redis.xread({STREAM_KEY: last_id},
+                                             block=1000)
+            except Exception:
+                _logger.exception('Notification hub could not read from '
+                                  'Redis; retrying.')
+                time.sleep(1)
+                continue
+
+            for _, entries in response or []:
+                for id_, fields in entries:
+                    event = _decode_entry(id_, fields)
+                    last_id = event.id
+                    self._publish(event)
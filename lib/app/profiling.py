@@ -0,0 +1,162 @@
+'''
+On-demand profiling of individual requests.
+
+An administrator can ask for a request to be profiled by sending an
+``X-Profile: 1`` header or an ``xprofile=1`` query parameter. The request then
+runs under ``cProfile`` and the resulting statistics are stored in Redis, from
+where they can be downloaded through ``/api/profiling/``. The response's
+``X-Profile-ID`` header identifies the stored profile.
+
+Profiles are stored in the same format as ``cProfile``'s ``dump_stats()``, so
+they can be opened with ``pstats`` or tools such as SnakeViz.
+'''
+
+import cProfile
+import io
+import json
+import marshal
+import os
+import pstats
+import tempfile
+import time
+import uuid
+
+
+# The raw statistics for a profile.
+PROFILE_KEY = 'profiling:profile:{}'
+
+# A JSON description of a profile (request, user, duration).
+META_KEY = 'profiling:meta:{}'
+
+# Sorted set of profile IDs, scored by the time they were taken.
+INDEX_KEY = 'profiling:profiles'
+
+# Number of profiles that a user has taken in the current rate limit period.
+RATE_KEY = 'profiling:rate:{}:{}'
+
+# Length of the rate limit period, in seconds.
+RATE_PERIOD = 3600
+
+
+def allow(redis, user_id, limit):
+    '''
+    Return True if ``user_id`` may take another profile in this period.
+
+    Each call counts against the limit.
+    '''
+
+    period = int(time.time() // RATE_PERIOD)
+    key = RATE_KEY.format(user_id, period)
+
+    pipeline = redis.pipeline()
+    pipeline.incr(key)
+    pipeline.expire(key, RATE_PERIOD)
+    count, _ = pipeline.execute()
+
+    return count <= limit
+
+
+def format_stats(data, sort='cumulative', limit=50):
+    '''
+    Format raw profile statistics as a text report.
+
+    The report lists the ``limit`` most expensive functions, sorted by
+    ``sort`` (any key accepted by ``pstats.Stats.sort_stats()``).
+    '''
+
+    # pstats can only load statistics from a file.
+    with tempfile.NamedTemporaryFile(suffix='.prof', delete=False) as file_:
+        file_.write(data)
+
+    try:
+        output = io.StringIO()
+        stats = pstats.Stats(file_.name, stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    finally:
+        os.unlink(file_.name)
+
+    return output.getvalue()
+
+
+def get_profile(redis, profile_id):
+    '''
+    Get a profile's description and raw statistics.
+
+    Returns a tuple (meta, data), or None if the profile does not exist.
+    '''
+
+    pipeline = redis.pipeline()
+    pipeline.get(META_KEY.format(profile_id))
+    pipeline.get(PROFILE_KEY.format(profile_id))
+    meta, data = pipeline.execute()
+
+    if meta is None or data is None:
+        return None
+
+    return json.loads(meta.decode('utf8')), data
+
+
+def list_profiles(redis):
+    ''' Get descriptions of all stored profiles, newest first. '''
+
+    profile_ids = [id_.decode('ascii')
+                   for id_ in redis.zrevrange(INDEX_KEY, 0, -1)]
+
+    if len(profile_ids) == 0:
+        return []
+
+    metas = redis.mget([META_KEY.format(id_) for id_ in profile_ids])
+    profiles = []
+    expired = []
+
+    for profile_id, meta in zip(profile_ids, metas):
+        if meta is None:
+            expired.append(profile_id)
+        else:
+            profiles.append(json.loads(meta.decode('utf8')))
+
+    if len(expired) > 0:
+        redis.zrem(INDEX_KEY, *expired)
+
+    return profiles
+
+
+def save(redis, profiler, meta, ttl):
+    '''
+    Store a finished profiler's statistics for ``ttl`` seconds.
+
+    ``meta`` is a dictionary that describes the profile. Returns the new
+    profile's ID.
+    '''
+
+    profiler.create_stats()
+    data = marshal.dumps(profiler.stats)
+    profile_id = uuid.uuid4().hex
+    now = time.time()
+    meta = dict(meta, id=profile_id, created=now, size=len(data))
+
+    pipeline = redis.pipeline()
+    pipeline.setex(PROFILE_KEY.format(profile_id), ttl, data)
+    pipeline.setex(META_KEY.format(profile_id), ttl, json.dumps(meta))
+    pipeline.zadd(INDEX_KEY, {profile_id: now})
+    pipeline.execute()
+
+    return profile_id
+
+
+def start():
+    '''
+    Start profiling the current thread and return the profiler.
+
+    Returns None if a profiler is already running where Python does not allow
+    two at once.
+    '''
+
+    profiler = cProfile.Profile()
+
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+
+    return profiler
@@ -1,21 +1,24 @@
-""" Message queues. """
+"""
+Message queues.
 
-import json
+Connections and queues are created the first time that a job is scheduled,
+not when this module is imported. Jobs are referred to by their dotted names,
+so that scheduling a job doesn't import the (large) worker modules. Queues are
+provisioned by ``bin/queues.py``, not at application startup.
+"""
 
 from rq import Connection, Queue
 
 import app.config
+import app.database
 import worker
-import worker.index
-import worker.scrape
-import worker.sleep
 
 
-_config = app.config.get_config()
-_redis = app.database.get_redis(dict(_config.items('redis')))
-_redis_worker = dict(_config.items('redis_worker'))
-_index_queue = Queue('index', connection=_redis)
-_scrape_queue = Queue('scrape', connection=_redis)
+QUEUE_NAMES = ('index', 'scrape')
+
+_queues = {}
+_redis = None
+_redis_worker = None
 
 
 def dummy_job():
@@ -36,11 +39,9 @@ def init_queues(redis):
     create that queue.
     """
 
-    queues = {q for q in globals().values() if type(q) is Queue}
-
     with Connection(redis):
-        for queue in queues:
-            queue.enqueue(dummy_job)
+        for name in QUEUE_NAMES:
+            Queue(name).enqueue(dummy_job)
 
 
 def remove_unused_queues(redis):
@@ -51,11 +52,9 @@ def remove_unused_queues(redis):
     removed.
     """
 
-    queue_names = {q.name for q in globals().values() if type(q) is Queue}
-
     with Connection(redis):
         for queue in Queue.all():
-            if queue.name not in queue_names:
+            if queue.name not in QUEUE_NAMES:
                 queue.empty()
                 redis.srem('rq:queues', 'rq:queue:{}'.format(queue.name))
 
@@ -63,10 +62,10 @@ def remove_unused_queues(redis):
 def schedule_avatar(profile, avatar_url):
     """ Queue a job to fetch an avatar image for the specified profile. """
 
-    job = _scrape_queue.enqueue_call(
-        func=worker.scrape.scrape_avatar,
+    job = _get_queue('scrape').enqueue_call(
+        func='worker.scrape.scrape_avatar',
         args=(profile.id, profile.site, avatar_url),
-        timeout=_redis_worker['avatar_timeout']
+        timeout=_get_timeouts()['avatar_timeout']
     )
 
     description = 'Getting avatar image for "{}" on {}' \
@@ -78,10 +77,10 @@ def schedule_avatar(profile, avatar_url):
 def schedule_index_profile(profile):
     """ Queue a job to index the specified profile. """
 
-    job = _index_queue.enqueue_call(
-        func=worker.index.index_profile,
+    job = _get_queue('index').enqueue_call(
+        func='worker.index.index_profile',
         args=[profile.id],
-        timeout=_redis_worker['solr_timeout']
+        timeout=_get_timeouts()['solr_timeout']
     )
 
     description = 'Indexing profile "{}" on {}' \
@@ -93,10 +92,10 @@ def schedule_index_profile(profile):
 def schedule_index_posts(post_ids):
     """ Queue a job to index the specified posts. """
 
-    job = _index_queue.enqueue_call(
-        func=worker.index.index_posts,
+    job = _get_queue('index').enqueue_call(
+        func='worker.index.index_posts',
         kwargs={'post_ids': post_ids},
-        timeout=_redis_worker['solr_timeout']
+        timeout=_get_timeouts()['solr_timeout']
     )
 
     description = 'Indexing {} posts' \
@@ -110,10 +109,10 @@ def schedule_delete_profile_from_index(profile):
     Queue a job to delete the specified profile from the index.
     """
 
-    job = _index_queue.enqueue_call(
-        func=worker.index.delete_profile,
+    job = _get_queue('index').enqueue_call(
+        func='worker.index.delete_profile',
         args=[profile.id],
-        timeout=_redis_worker['solr_timeout']
+        timeout=_get_timeouts()['solr_timeout']
     )
 
     description = 'Deleting profile "{}" on {} from index' \
@@ -127,10 +126,10 @@ def schedule_delete_profile_posts_from_index(profile_id):
     Queue a job to delete the specified profile posts from the index.
     """
 
-    job = _index_queue.enqueue_call(
-        func=worker.index.delete_profile_posts,
+    job = _get_queue('index').enqueue_call(
+        func='worker.index.delete_profile_posts',
         args=[profile_id],
-        timeout=_redis_worker['solr_timeout']
+        timeout=_get_timeouts()['solr_timeout']
     )
 
     description = 'Deleting profile "{}" posts from index' \
@@ -142,10 +141,10 @@ def schedule_delete_profile_posts_from_index(profile_id):
 def schedule_delete_profile_from_index(profile_id):
     """ Queue a job to index the specified profile. """
 
-    job = _index_queue.enqueue_call(
-        func=worker.index.delete_profile,
+    job = _get_queue('index').enqueue_call(
+        func='worker.index.delete_profile',
         args=[profile_id],
-        timeout=_redis_worker['solr_timeout']
+        timeout=_get_timeouts()['solr_timeout']
     )
 
     description = 'Deleting profile "{}" from index' \
@@ -157,10 +156,10 @@ def schedule_delete_profile_from_index(profile_id):
 def schedule_profile(site, username, stub=False):
     """ Queue a job to fetch the specified profile from a social media site. """
 
-    job = _scrape_queue.enqueue_call(
-        func=worker.scrape.scrape_profile,
+    job = _get_queue('scrape').enqueue_call(
+        func='worker.scrape.scrape_profile',
         args=(site, [username], stub),
-        timeout=_redis_worker['profile_timeout']
+        timeout=_get_timeouts()['profile_timeout']
     )
 
     description = 'Scraping bio for "{}" on {}'.format(username, site)
@@ -170,10 +169,10 @@ def schedule_profile(site, username, stub=False):
 def schedule_profile_id(site, upstream_id, profile_id=None, stub=False):
     """ Queue a job to fetch the specified profile from a social media site. """
 
-    job = _scrape_queue.enqueue_call(
-        func=worker.scrape.scrape_profile_by_id,
+    job = _get_queue('scrape').enqueue_call(
+        func='worker.scrape.scrape_profile_by_id',
         args=(site, [upstream_id], stub),
-        timeout=_redis_worker['profile_timeout']
+        timeout=_get_timeouts()['profile_timeout']
     )
 
     description = 'Scraping bio for "{}" on {}'.format(upstream_id, site)
@@ -245,18 +244,18 @@ def schedule_profiles(profiles, stub=False):
                 if type_ == 'upstream_id':
                     ids = [i['upstream_id'] for i in chunk]
                     labels = _create_labels_dict(profiles=chunk, type_='upstream_id')
-                    job = _scrape_queue.enqueue_call(
-                        func=worker.scrape.scrape_profile_by_id,
+                    job = _get_queue('scrape').enqueue_call(
+                        func='worker.scrape.scrape_profile_by_id',
                         args=(site, ids, stub, labels),
-                        timeout=_redis_worker['profile_timeout']
+                        timeout=_get_timeouts()['profile_timeout']
                     )
                 else:
                     usernames = [i['username'] for i in chunk]
                     labels = _create_labels_dict(profiles=chunk, type_='username')
-                    job = _scrape_queue.enqueue_call(
-                        func=worker.scrape.scrape_profile,
+                    job = _get_queue('scrape').enqueue_call(
+                        func='worker.scrape.scrape_profile',
                         args=(site, usernames, stub, labels),
-                        timeout=_redis_worker['profile_timeout']
+                        timeout=_get_timeouts()['profile_timeout']
                     )
 
                 description = (
@@ -271,18 +270,18 @@ def schedule_posts(profile, recent=True):
     """ Queue a job to get posts for the specified profile. """
 
     scrapers = {
-        'instagram': worker.scrape.scrape_instagram_posts,
-        'twitter': worker.scrape.scrape_twitter_posts,
+        'instagram': 'worker.scrape.scrape_instagram_posts',
+        'twitter': 'worker.scrape.scrape_twitter_posts',
     }
 
     description = 'Getting posts for "{}" on {}' \
                   .format(profile.username, profile.site_name())
     type_ = 'posts'
 
-    job = _scrape_queue.enqueue_call(
+    job = _get_queue('scrape').enqueue_call(
         func=scrapers[profile.site],
         args=(profile.id, recent),
-        timeout=_redis_worker['posts_timeout']
+        timeout=_get_timeouts()['posts_timeout']
     )
     worker.init_job(
         job=job,
@@ -296,18 +295,18 @@ def schedule_relations(profile):
     """ Queue a job to get relations for the specified profile. """
 
     scrapers = {
-        'instagram': worker.scrape.scrape_instagram_relations,
-        'twitter': worker.scrape.scrape_twitter_relations,
+        'instagram': 'worker.scrape.scrape_instagram_relations',
+        'twitter': 'worker.scrape.scrape_twitter_relations',
     }
 
     description = 'Getting friends & followers for "{}" on {}' \
                   .format(profile.username, profile.site_name())
     type_ = 'relations'
 
-    job = _scrape_queue.enqueue_call(
+    job = _get_queue('scrape').enqueue_call(
         func=scrapers[profile.site],
         args=[profile.id],
-        timeout=_redis_worker['relations_timeout']
+        timeout=_get_timeouts()['relations_timeout']
     )
     worker.init_job(
         job=job,
@@ -322,8 +321,8 @@ def schedule_sleep_determinate(period):
 
     description = 'Determinate sleep for {} seconds'.format(period)
 
-    job = _scrape_queue.enqueue(
-        worker.sleep.sleep_determinate,
+    job = _get_queue('scrape').enqueue(
+        'worker.sleep.sleep_determinate',
         period,
         timeout=period + 1
     )
@@ -336,8 +335,8 @@ def schedule_sleep_exception(period):
 
     description = 'Exception sleep for {} seconds'.format(period)
 
-    job = _scrape_queue.enqueue(
-        worker.sleep.sleep_exception,
+    job = _get_queue('scrape').enqueue(
+        'worker.sleep.sleep_exception',
         period,
         timeout=period + 1
     )
@@ -350,8 +349,8 @@ def schedule_sleep_indeterminate(period):
 
     description = 'Indeterminate sleep for {} seconds'.format(period)
 
-    job = _scrape_queue.enqueue(
-        worker.sleep.sleep_indeterminate,
+    job = _get_queue('scrape').enqueue(
+        'worker.sleep.sleep_indeterminate',
         period,
         timeout=period + 1
     )
@@ -378,3 +377,30 @@ def _create_labels_dict(profiles, type_):
             labels[key] = list(set(profile['labels']))
 
     return labels
+
+
+def _get_queue(name):
+    """ Get a queue by name, connecting to Redis if necessary. """
+
+    global _redis
+
+    if name not in _queues:
+        if _redis is None:
+            config = app.config.get_config()
+            _redis = app.database.get_redis(dict(config.items('redis')))
+
+        _queues[name] = Queue(name, connection=_redis)
+
+    return _queues[name]
+
+
+def _get_timeouts():
+    """ Get job timeouts from the configuration. """
+
+    global _redis_worker
+
+    if _redis_worker is None:
+        config = app.config.get_config()
+        _redis_worker = dict(config.items('redis_worker'))
+
+    return _redis_worker
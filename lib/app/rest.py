@@ -1,11 +1,18 @@
 ''' Utility functions for the REST API. '''
 
+import base64
+import binascii
 from datetime import datetime
+import json
 
+import dateutil.parser
 from flask import url_for as flask_url_for
 from sqlalchemy import case, extract, func
+from sqlalchemy.types import DateTime
 from werkzeug.exceptions import BadRequest
 
+import app.database
+
 
 def get_arg(constructor, name, container, optional=False, nullable=False,
             type_name=None):
@@ -95,6 +102,17 @@ def get_sort_arguments(args, default, allowed_fields):
     ``order_by()``.
     '''
 
+    return [_order_column(column, descending) for column, descending
+            in get_sort_columns(args, default, allowed_fields)]
+
+
+def get_sort_columns(args, default, allowed_fields):
+    '''
+    Get standard sort arguments from the URL as (column, descending) tuples.
+
+    The arguments are the same as for ``get_sort_arguments()``.
+    '''
+
     sort_columns = list()
 
     for sort in args.get('sort', default).split(','):
@@ -109,14 +127,71 @@ def get_sort_arguments(args, default, allowed_fields):
         except KeyError:
             raise BadRequest('Invalid sort field name')
 
-        if descending:
-            sort_column = sort_column.desc()
-
-        sort_columns.append(sort_column.nullslast())
+        sort_columns.append((sort_column, descending))
 
     return sort_columns
 
 
+def paginate(query, args, sort_columns, id_column, entity=None):
+    '''
+    Sort and page a query according to standard paging arguments.
+
+    Clients can page in two ways. The `page` argument selects a page by
+    number, which is simple but gets slower for deeper pages. The `after`
+    argument is an opaque token taken from the `next_after` value of the
+    previous page; it resumes the query immediately after the last row of the
+    previous page (keyset pagination), so every page is equally cheap.
+
+    The total count is estimated by the query planner unless the client
+    passes `count=exact`; see ``app.database.count_query()``.
+
+    ``sort_columns`` is a list of (column, descending) tuples and
+    ``id_column`` is a unique column that is appended to the sort order to
+    break ties. ``entity`` is a function that returns the mapped object that
+    holds the sort columns for a result row; by default, the row itself.
+
+    Returns a tuple: the rows for this page, the total count, True if the
+    total count is exact, and the `after` token for the next page (or None if
+    this is the last page).
+    '''
+
+    page, results_per_page = get_paging_arguments(args)
+    after = args.get('after')
+    exact = args.get('count') == 'exact'
+
+    if entity is None:
+        entity = lambda row: row
+
+    total_count, count_exact = app.database.count_query(query, exact)
+
+    if sort_columns[-1][0] is not id_column:
+        sort_columns = sort_columns + [(id_column, False)]
+
+    for column, descending in sort_columns:
+        query = query.order_by(_order_column(column, descending))
+
+    if after is not None:
+        values = _decode_after(after, sort_columns)
+        query = query.filter(
+            app.database.keyset_condition(sort_columns, values)
+        )
+    else:
+        query = query.offset((page - 1) * results_per_page)
+
+    # Fetch one extra row to find out if there is another page.
+    rows = query.limit(results_per_page + 1).all()
+
+    if len(rows) > results_per_page:
+        rows = rows[:results_per_page]
+        last = entity(rows[-1])
+        values = [getattr(last, column.key) for column, _ in sort_columns]
+        next_after = _encode_after(values)
+    else:
+        next_after = None
+
+    return rows, total_count, count_exact, next_after
+
+
 def isodate(datetime_):
     ''' Convert datetime to ISO-8601 without microseconds. '''
     return datetime_.replace(microsecond=0).isoformat()
@@ -151,3 +226,42 @@ def url_for(*args, **kwargs):
 
     kwargs['_external'] = True
     return flask_url_for(*args, **kwargs)
+
+
+def _decode_after(token, sort_columns):
+    ''' Decode an `after` token produced by _encode_after(). '''
+
+    try:
+        padding = '=' * (-len(token) % 4)
+        decoded = base64.urlsafe_b64decode((token + padding).encode('ascii'))
+        values = json.loads(decoded.decode('utf8'))
+
+        if not isinstance(values, list) or len(values) != len(sort_columns):
+            raise ValueError()
+
+        for index, (column, _) in enumerate(sort_columns):
+            if values[index] is not None and isinstance(column.type, DateTime):
+                values[index] = dateutil.parser.parse(values[index])
+
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+        raise BadRequest('Invalid value for "after" argument.')
+
+    return values
+
+
+def _encode_after(values):
+    ''' Encode the sort values of a row as an opaque `after` token. '''
+
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    encoded = json.dumps(values, separators=(',', ':')).encode('utf8')
+
+    return base64.urlsafe_b64encode(encoded).decode('ascii').rstrip('=')
+
+
+def _order_column(column, descending):
+    ''' Return an ``order_by()`` argument for a column. '''
+
+    if descending:
+        column = column.desc()
+
+    return column.nullslast()
@@ -0,0 +1,226 @@
+''' An HTTP session for Solr with pooling, timeouts, and a circuit breaker. '''
+
+import logging
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.exceptions import ServiceUnavailable
+
+import app.metrics
+
+
+_logger = logging.getLogger('solr')
+
+# Solr reports its own processing time in the response header. Scanning for it
+# is much cheaper than decoding the whole response a second time.
+_QTIME_PATTERN = re.compile(rb'"QTime"\s*:\s*(\d+)')
+
+REQUEST_LATENCY = app.metrics.REGISTRY.histogram(
+    'quickpin_solr_request_duration_seconds',
+    'Time to complete Solr requests, including the network.'
+)
+
+
+class SolrUnavailable(ServiceUnavailable):
+    '''
+    Raised when Solr cannot be reached or the circuit breaker is open.
+
+    This is an HTTP exception, so views that use Solr respond with 503 SERVICE
+    UNAVAILABLE without any extra error handling.
+    '''
+
+    description = 'The search engine is temporarily unavailable.'
+
+
+class SolrSession(requests.Session):
+    '''
+    A requests session customized for talking to Solr.
+
+    Features:
+     * Keeps a fixed-size pool of keep-alive connections that all threads in
+       a process share. When every pooled connection is busy, a request opens
+       a temporary connection instead of waiting for one to be returned, so a
+       slow Solr cannot leave request threads blocked on the pool.
+     * Applies connect and read timeouts to every request that doesn't
+       specify its own.
+     * Times each request and compares wall time to the `QTime` that Solr
+       reports, which separates time spent in Solr from time spent on the
+       network and in (de)serialization.
+     * Implements a circuit breaker: after `breaker_threshold` consecutive
+       failures, requests fail immediately for `breaker_reset` seconds instead
+       of waiting on a Solr instance that is already struggling. After that
+       period, a single trial request is allowed through; if it succeeds then
+       the breaker closes again.
+    '''
+
+    def __init__(self, pool_size=10, connect_timeout=2, read_timeout=20,
+                 breaker_threshold=5, breaker_reset=30):
+        ''' Constructor. '''
+
+        super().__init__()
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              pool_block=False)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_pending = False
+
+        self.request_count = 0
+        self.failure_count = 0
+        self.rejected_count = 0
+        self.wall_time = 0.0
+        self.qtime = 0.0
+
+    def request(self, method, url, **kwargs):
+        ''' Send a request to Solr, subject to the circuit breaker. '''
+
+        if not kwargs.get('timeout'):
+            kwargs['timeout'] = self.timeout
+
+        self._before_request()
+        start = time.perf_counter()
+
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self._record_failure()
+            raise SolrUnavailable() from e
+        except BaseException:
+            # Anything else (including gevent's Timeout and GreenletExit) must
+            # still settle a half-open trial, or the breaker never closes.
+            self._record_failure()
+            raise
+
+        wall_time = time.perf_counter() - start
+
+        if response.status_code >= 500:
+            self._record_failure()
+        else:
+            self._record_success()
+
+        qtime = self._parse_qtime(response)
+        self._record_timing(method, url, wall_time, qtime)
+
+        return response
+
+    def collect_metrics(self):
+        ''' Report this session's counters and breaker state as metrics. '''
+
+        stats = self.stats()
+
+        return [
+            app.metrics.gauge_family('quickpin_solr_breaker_open',
+                                     'Whether the Solr circuit breaker is'
+                                     ' open.',
+                                     [({}, stats['breaker_open'])]),
+            app.metrics.counter_family('quickpin_solr_failures',
+                                       'Failed Solr requests.',
+                                       [({}, stats['failure_count'])]),
+            app.metrics.counter_family('quickpin_solr_qtime_seconds',
+                                       'Processing time reported by Solr.',
+                                       [({}, stats['qtime'])]),
+            app.metrics.counter_family('quickpin_solr_rejected',
+                                       'Solr requests rejected by the circuit'
+                                       ' breaker.',
+                                       [({}, stats['rejected_count'])]),
+        ]
+
+    def stats(self):
+        ''' Return a dictionary of statistics about this session. '''
+
+        with self._lock:
+            return {
+                'breaker_open': self._opened_at is not None,
+                'failure_count': self.failure_count,
+                'qtime': self.qtime,
+                'rejected_count': self.rejected_count,
+                'request_count': self.request_count,
+                'wall_time': self.wall_time,
+            }
+
+    def _before_request(self):
+        '''
+        Check the circuit breaker state.
+
+        Raises SolrUnavailable if the breaker is open.
+        '''
+
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            elapsed = time.monotonic() - self._opened_at
+
+            if elapsed >= self.breaker_reset and not self._trial_pending:
+                # Half open: let one request through to probe Solr.
+                self._trial_pending = True
+                return
+
+            self.rejected_count += 1
+
+        raise SolrUnavailable()
+
+    def _parse_qtime(self, response):
+        ''' Return Solr's QTime in seconds, or None if not reported. '''
+
+        match = _QTIME_PATTERN.search(response.content[:256])
+
+        if match is None:
+            return None
+        else:
+            return int(match.group(1)) / 1000
+
+    def _record_failure(self):
+        ''' Count a failed request and open the breaker if necessary. '''
+
+        with self._lock:
+            self._failures += 1
+            self.failure_count += 1
+            self._trial_pending = False
+
+            if self._failures >= self.breaker_threshold:
+                if self._opened_at is None:
+                    _logger.error('Opening Solr circuit breaker after %d '
+                                  'consecutive failures.', self._failures)
+
+                self._opened_at = time.monotonic()
+
+    def _record_success(self):
+        ''' Reset the breaker after a successful request. '''
+
+        with self._lock:
+            if self._opened_at is not None:
+                _logger.warning('Closing Solr circuit breaker.')
+
+            self._failures = 0
+            self._opened_at = None
+            self._trial_pending = False
+
+    def _record_timing(self, method, url, wall_time, qtime):
+        ''' Accumulate timing data and log it. '''
+
+        REQUEST_LATENCY.observe(wall_time)
+
+        with self._lock:
+            self.request_count += 1
+            self.wall_time += wall_time
+
+            if qtime is not None:
+                self.qtime += qtime
+
+        if qtime is None:
+            _logger.debug('%s %s wall=%.3fs', method, url, wall_time)
+        else:
+            _logger.debug('%s %s wall=%.3fs qtime=%.3fs', method, url,
+                          wall_time, qtime)
@@ -1,11 +1,11 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 from flask import g, json, jsonify, render_template, request
 from flask_classy import FlaskView, route
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest, Unauthorized
 
-from app.authorization import login_required
+from app.authorization import login_required, make_token
 from app.rest import url_for
 from model import User
 from model.user import check_password
@@ -98,11 +98,11 @@ class AuthenticationView(FlaskView):
             if not check_password(request_json['password'], user.password_hash):
                 raise AuthenticationFailure()
 
-            expires = (datetime.now() + timedelta(hours=24)).isoformat()
+            lifetime = timedelta(hours=24).total_seconds()
 
             return jsonify(
                 message='Authentication is successful.',
-                token=g.sign('%d|%s' % (user.id, expires))
+                token=make_token(g.sign, user.id, lifetime)
             )
 
         except KeyError:
@@ -1,11 +1,16 @@
-from flask import g, send_from_directory
-from flask_classy import FlaskView
+import mimetypes
+import os
+import re
+
+from flask import current_app, g, jsonify, send_from_directory
+from flask_classy import FlaskView, route
 from werkzeug.exceptions import NotFound
 
 import app.config
+import app.file_cache
 from app.authorization import login_required
-from app.rest import url_for
-from model import File
+from app.rest import get_int_arg, url_for
+from model.file import relpath_from_hash
 
 
 class FileView(FlaskView):
@@ -13,25 +18,145 @@ class FileView(FlaskView):
 
     decorators = [login_required]
 
+    # Matches content-addressed file names, i.e. the value of File.hash_name().
+    HASH_NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(\.[A-Za-z0-9]+)?$')
+
+    # Content-addressed files never change, so browsers may cache them for as
+    # long as they like. One year is the conventional maximum.
+    IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
     def get(self, id_):
         '''
         Get a file identified by ``id_``.
 
+        The file can be identified either by its numeric ID or by its content
+        hash, as returned by `File.hash_name()`: the SHA-256 hash in hex,
+        optionally followed by an extension that determines the MIME type. A
+        file requested by hash is served straight from the data directory
+        without a database lookup, and is marked as immutable so that browsers
+        do not revalidate it.
+
+        If the `[file] offload` setting is enabled, then the file contents are
+        not sent by the application. Instead, the response carries an
+        `X-Sendfile` or `X-Accel-Redirect` header that tells the front end web
+        server (Apache with mod_xsendfile, or nginx) to send the file itself.
+
         :status 200: ok
         :status 401: authentication required
         :status 404: no file with that ID
         '''
 
-        file_ = g.db.query(File).filter(File.id==id_).first()
-        data_dir = app.config.get_path('data')
+        match = FileView.HASH_NAME_PATTERN.match(id_)
+
+        if match is not None:
+            return self._get_by_hash(match.group(1), match.group(2))
+
+        id_ = get_int_arg('id_', id_)
+        metadata = app.file_cache.get_file_metadata(g.config, g.db, g.redis,
+                                                    id_)
         cache_timeout = 0 if g.debug else None
 
-        if file_ is None:
+        if metadata is None:
             raise NotFound('No file exists with id={}'.format(id_))
 
-        return send_from_directory(
-            data_dir,
-            file_.relpath(),
-            mimetype=file_.mime,
-            cache_timeout=cache_timeout
+        relpath, mime = metadata
+
+        return self._send_file(relpath, mime, cache_timeout)
+
+    @route('/cache/stats')
+    def cache_stats(self):
+        '''
+        Get statistics for this process's file metadata cache.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "hit_rate": 0.9704,
+                "hits": 24013,
+                "max_size": 10000,
+                "misses": 732,
+                "size": 732
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json float hit_rate: fraction of lookups answered by the in-process
+            cache, or null if there have been no lookups
+        :>json int hits: number of lookups answered by the in-process cache
+        :>json int max_size: maximum number of cached entries
+        :>json int misses: number of lookups that went to Redis or the database
+        :>json int size: number of cached entries
+
+        :status 200: ok
+        :status 401: authentication required
+        '''
+
+        return jsonify(**app.file_cache.stats(g.config))
+
+    def _get_by_hash(self, hash_hex, extension):
+        ''' Serve a file identified by its content hash. '''
+
+        mime = None
+
+        if extension is not None:
+            mime, _ = mimetypes.guess_type('file' + extension)
+
+        response = self._send_file(
+            relpath_from_hash(hash_hex),
+            mime or 'application/octet-stream',
+            FileView.IMMUTABLE_MAX_AGE
         )
+
+        response.headers['Cache-Control'] = 'private, max-age={}, immutable' \
+                                            .format(FileView.IMMUTABLE_MAX_AGE)
+
+        return response
+
+    def _send_file(self, relpath, mimetype, cache_timeout):
+        '''
+        Send a file from the data directory.
+
+        Depending on the `[file] offload` setting, the file is either sent by
+        Flask or handed off to the front end web server.
+        '''
+
+        data_dir = app.config.get_path('data')
+        offload = g.config.get('file', 'offload')
+
+        if offload == 'none':
+            return send_from_directory(
+                data_dir,
+                relpath,
+                mimetype=mimetype,
+                cache_timeout=cache_timeout
+            )
+
+        path = os.path.join(data_dir, relpath)
+
+        if not os.path.isfile(path):
+            raise NotFound()
+
+        response = current_app.response_class(mimetype=mimetype)
+
+        if offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = path
+        elif offload == 'x-accel-redirect':
+            prefix = g.config.get('file', 'accel_redirect_prefix')
+            response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + \
+                                                   relpath.replace(os.sep, '/')
+        else:
+            raise ValueError('Invalid file offload mode: {}'.format(offload))
+
+        # Match send_from_directory()'s cache headers.
+        if cache_timeout is None:
+            cache_timeout = current_app.get_send_file_max_age(relpath)
+
+        if cache_timeout is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = cache_timeout
+
+        return response
@@ -10,6 +10,8 @@ from werkzeug.exceptions import BadRequest, NotFound
 import worker
 from model.label import Label
 from app.authorization import login_required
+import app.etag
+import app.notify
 from app.rest import get_int_arg, get_arg
 from app.rest import get_paging_arguments
 from app.rest import url_for
@@ -111,7 +113,8 @@ class LabelView(FlaskView):
                     label = Label(name=t['name'].lower().strip())
                     g.db.add(label)
                     g.db.flush()
-                    redis.publish('label', json.dumps(label.as_dict()))
+                    app.notify.publish(redis, 'label',
+                                       json.dumps(label.as_dict()))
                     labels.append(label.as_dict())
                 except IntegrityError:
                     g.db.rollback()
@@ -309,6 +312,8 @@ class LabelView(FlaskView):
             g.db.rollback()
             raise BadRequest('Database error: {}'.format(e))
 
+        app.etag.bump_label_generation(g.redis)
+
         response = label.as_dict()
         response['url'] = url_for('LabelView:get', id_=label.id)
 
@@ -353,6 +358,8 @@ class LabelView(FlaskView):
         except DBAPIError as e:
             raise BadRequest('Database error: {}'.format(e))
 
+        app.etag.bump_label_generation(g.redis)
+
         message = 'Label {} deleted'.format(label.name)
         response = jsonify(message=message)
         response.status_code = 202
@@ -0,0 +1,54 @@
+from flask import g, request, Response
+from flask_classy import FlaskView
+from werkzeug.exceptions import Forbidden
+
+import app.metrics
+
+
+class MetricsView(FlaskView):
+    '''
+    Export metrics in the Prometheus text format.
+
+    Every web server process publishes its metrics to Redis periodically
+    (see `app.metrics`), and this view reports the totals for all processes,
+    so it does not matter which process answers the scrape. Worker metrics are exported
+    separately by ``bin/metrics-exporter.py``.
+
+    This view does not use token authentication, since Prometheus cannot log
+    in. Instead, it only answers clients whose addresses are listed in
+    ``[metrics] allowed_ips``.
+    '''
+
+    def index(self):
+        '''
+        Get metrics for all web server processes.
+
+        The response is plain text in the Prometheus exposition format.
+        Metrics include:
+
+        * ``quickpin_http_request_duration_seconds``: request latency
+          histogram, labeled by view, method, and status
+        * ``quickpin_db_pool_*``: database connection pool statistics,
+          labeled by pool
+        * ``quickpin_redis_round_trips_total``: commands and pipelines sent
+          to Redis
+        * ``quickpin_solr_*``: Solr latency histogram, failures, and circuit
+          breaker state
+        * ``quickpin_sse_connections``: open notification streams
+
+        :>header Content-Type: text/plain
+
+        :status 200: ok
+        :status 403: the client's address is not allowed
+        '''
+
+        allowed = g.config.get('metrics', 'allowed_ips')
+        allowed_ips = [ip.strip() for ip in allowed.split(',') if ip.strip()]
+
+        if len(allowed_ips) > 0 and request.remote_addr not in allowed_ips:
+            raise Forbidden('Metrics are not available to this address.')
+
+        families = app.metrics.collect_published(g.redis)
+
+        return Response(app.metrics.render(families),
+                        content_type=app.metrics.CONTENT_TYPE)
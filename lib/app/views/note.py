@@ -6,7 +6,9 @@ from werkzeug.exceptions import BadRequest, NotFound
 
 from model.profile import Profile, ProfileNote
 from app.authorization import login_required
-from app.rest import get_int_arg, get_paging_arguments
+import app.etag
+import app.notify
+from app.rest import get_int_arg, paginate
 from app.rest import url_for
 import worker
 
@@ -163,7 +165,9 @@ class ProfileNoteView(FlaskView):
 
         # Publish SSEs
         for note in notes:
-            redis.publish(
+            app.etag.bump_profile_version(redis, note.profile_id)
+            app.notify.publish(
+                redis,
                 'profile_notes',
                 json.dumps(note.as_dict())
             )
@@ -250,7 +254,9 @@ class ProfileNoteView(FlaskView):
             raise BadRequest('Could not update note.')
 
         # Generate SSE
-        redis.publish(
+        app.etag.bump_profile_version(redis, note.profile_id)
+        app.notify.publish(
+            redis,
             'profile_notes',
             json.dumps(note.as_dict())
         )
@@ -293,14 +299,18 @@ class ProfileNoteView(FlaskView):
             raise NotFound("Note `%s` does not exist." % id_)
 
         # Delete note
+        profile_id = note.profile_id
         g.db.delete(note)
         try:
             g.db.commit()
         except DBAPIError as e:
             raise BadRequest('Database error: {}'.format(e))
 
+        app.etag.bump_profile_version(redis, profile_id)
+
         message = 'Note `{}` deleted'.format(note.id)
-        redis.publish(
+        app.notify.publish(
+            redis,
             'profile_notes',
             json.dumps({
                 'id': id_,
@@ -339,12 +349,18 @@ class ProfileNoteView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query after: resume after the last note of the previous page, using
+            that page's `next_after` token (optional, overrides `page`)
+        :query count: set to "exact" to count all notes exactly, instead of
+            using an estimate for large result sets (optional)
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
         :query profile_id: profile id to filter by
 
 
         :>header Content-Type: application/json
+        :>json str next_after: token for fetching the next page, or null if
+            this is the last page
         :>json list notes: list of profile note objects
         :>json int list[n].id: unique identifier for the note
         :>json str list[n].category: the user-defined category of this note
@@ -352,34 +368,37 @@ class ProfileNoteView(FlaskView):
         :>json str list[n].profile_id: the unique id of the profile this note belongs to
         :>json str list[n].created_at: the iso-formatted creation time of the note
         :>json str list[n].url: API endpoint URL for this note object
+        :>json int total_count: the total number of notes
+        :>json bool total_count_exact: false if `total_count` is an estimate
 
         :status 200: ok
         :status 400: invalid argument[s]
         :status 401: authentication required
         '''
 
-        # Parse paging arguments
-        page, results_per_page = get_paging_arguments(request.args)
         # Create base query
         query = g.db.query(ProfileNote)
         # Parse filter arguments
         profile_id = request.args.get('profile_id', None)
         if profile_id is not None:
             query = query.filter(ProfileNote.profile_id == profile_id)
-        # Store the total result count before paging arguments limit result set
-        total_count = query.count()
-        # Apply paging arguments
-        query = query.order_by(ProfileNote.category.asc()) \
-                     .limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        # Count, sort, and page the results
+        rows, total_count, count_exact, next_after = paginate(
+            query,
+            request.args,
+            [(ProfileNote.category, False)],
+            ProfileNote.id
+        )
         # Add API endpoint URL for each note object
         notes = list()
-        for note in query:
+        for note in rows:
             data = note.as_dict()
             data['url'] = url_for('ProfileNoteView:get', id_=note.id)
             notes.append(data)
 
         return jsonify(
+            next_after=next_after,
             notes=notes,
-            total_count=total_count
+            total_count=total_count,
+            total_count_exact=count_exact
         )
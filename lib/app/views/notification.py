@@ -1,13 +1,16 @@
+import threading
 import time
 
 from flask import g, request, Response, send_from_directory
 from flask_classy import FlaskView
-from werkzeug.exceptions import NotAcceptable, NotFound
+from werkzeug.exceptions import BadRequest, NotAcceptable, NotFound
 
 from app.authorization import login_required
 import app.config
 import app.database
-from app.rest import url_for
+import app.metrics
+import app.notify
+from app.rest import get_int_arg, url_for
 
 
 class NotificationView(FlaskView):
@@ -16,6 +19,15 @@ class NotificationView(FlaskView):
 
     Based on this:
     http://stackoverflow.com/questions/13386681/streaming-data-with-python-and-flask
+
+    All streams in a process share a single Redis reader: see
+    `app.notify.NotificationHub`. Each stream waits on its own queue, so a new
+    message is sent as soon as it arrives and idle streams use no CPU.
+
+    Event IDs are Redis Stream IDs. When a client reconnects, the browser
+    sends the ID of the last event it received in the `Last-Event-ID` header
+    and the events it missed are replayed. If they are no longer available,
+    a `reset` event tells the client to reload its state.
     '''
 
     CHANNELS = (
@@ -29,6 +41,8 @@ class NotificationView(FlaskView):
     )
 
     decorators = [login_required]
+    __hub = None
+    __hub_lock = threading.Lock()
     __should_quit = False
 
     @classmethod
@@ -36,42 +50,198 @@ class NotificationView(FlaskView):
         '''A helper function to end long-running notification threads. '''
         cls.__should_quit = True
 
+        if cls.__hub is not None:
+            cls.__hub.stop()
+
+    @classmethod
+    def collect_metrics(cls):
+        ''' Report the number of open streams in this process. '''
+
+        if cls.__hub is None:
+            count = 0
+        else:
+            count = cls.__hub.subscriber_count()
+
+        return [app.metrics.gauge_family('quickpin_sse_connections',
+                                         'Open notification streams.',
+                                         [({}, count)])]
+
+    @classmethod
+    def get_hub(cls):
+        '''
+        Return this process's hub, starting it if necessary.
+
+        The hub is started lazily so that its thread is created in the process
+        that serves requests (e.g. after a WSGI server forks).
+        '''
+
+        with cls.__hub_lock:
+            if cls.__hub is None:
+                redis = app.database.get_redis(dict(g.config.items('redis')))
+                queue_size = g.config.getint('notification', 'queue_size')
+                cls.__hub = app.notify.NotificationHub(redis, queue_size)
+                cls.__hub.start()
+
+        return cls.__hub
+
     def index(self):
-        ''' Open an SSE stream. '''
+        '''
+        Open an SSE stream.
+
+        The ID of the last event that the client received may be given in the
+        `Last-Event-ID` header (which browsers send automatically when they
+        reconnect) or the `last_event_id` query parameter.
+
+        Clients should declare which events they are interested in, so that
+        they are not sent every event in the deployment:
+
+        :query channels: comma-separated list of channels (default: all)
+        :query profile_ids: comma-separated list of profile IDs; events about
+            other profiles are not sent
+        :query job_ids: comma-separated list of job IDs; worker events for
+            other jobs are not sent
+
+        If both `profile_ids` and `job_ids` are given, an event is sent if it
+        matches either one. Events that do not refer to a profile or a job
+        (e.g. label changes) are always sent.
+
+        Worker progress events are coalesced: at most `[notification]
+        progress_rate` progress events are sent per job per second, and
+        intermediate progress events are skipped.
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        :status 406: the client does not accept `text/event-stream`
+        '''
 
         if request.headers.get('Accept') == 'text/event-stream':
-            redis = app.database.get_redis(dict(g.config.items('redis')))
-            pubsub = redis.pubsub(ignore_subscribe_messages=True)
-            pubsub.subscribe(*self.__class__.CHANNELS)
+            interests = self._get_interests()
+            hub = self.__class__.get_hub()
+            keepalive = g.config.getint('notification', 'keepalive')
+            progress_rate = g.config.getint('notification', 'progress_rate')
+            coalescer = app.notify.ProgressCoalescer(progress_rate)
+            last_event_id = request.headers.get('Last-Event-ID') or \
+                            request.args.get('last_event_id')
+
+            # Subscribe before replaying so that no event falls in between.
+            subscriber = hub.subscribe(interests)
+
+            if last_event_id is not None:
+                replayed, complete = app.notify.replay(g.redis, last_event_id)
+                replayed = [e for e in replayed if interests.wants(e)]
+            else:
+                replayed, complete = [], True
+
+            stream = self._stream(hub, subscriber, keepalive, coalescer,
+                                  last_event_id, replayed, complete)
 
-            return Response(self._stream(pubsub), content_type='text/event-stream')
+            return Response(stream, content_type='text/event-stream')
         else:
             message = 'This endpoint is only for use with server-sent ' \
                       'events (SSE).'
             raise NotAcceptable(message)
 
-    def _stream(self, pubsub):
+    def _get_interests(self):
+        ''' Parse the client's interests from the query string. '''
+
+        channels = self._get_list_arg('channels')
+        profile_ids = self._get_list_arg('profile_ids')
+        job_ids = self._get_list_arg('job_ids')
+
+        if channels is None:
+            channels = self.__class__.CHANNELS
+        else:
+            for channel in channels:
+                if channel not in self.__class__.CHANNELS:
+                    raise BadRequest('Invalid channel: {}'.format(channel))
+
+        if profile_ids is not None:
+            profile_ids = {get_int_arg('profile_ids', id_)
+                           for id_ in profile_ids}
+
+        if job_ids is not None:
+            job_ids = set(job_ids)
+
+        return app.notify.Interests(channels, profile_ids, job_ids)
+
+    def _get_list_arg(self, name):
+        ''' Get a comma-separated query argument, or None if not given. '''
+
+        value = request.args.get(name)
+
+        if value is None:
+            return None
+
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    def _stream(self, hub, subscriber, keepalive, coalescer, last_event_id,
+                replayed, complete):
         ''' Stream events. '''
 
-        # Prime the stream. (This forces headers to be sent. Otherwise the
-        # client will think the stream is not open yet.)
-        yield ''
+        try:
+            # Prime the stream. (This forces headers to be sent. Otherwise the
+            # client will think the stream is not open yet.)
+            yield ''
 
-        # Now send real events from the Redis pubsub channel.
-        event_id = 1
+            if not complete:
+                yield 'event: reset\ndata: {}\n\n'
 
-        while True:
-            if self.__class__.__should_quit:
-                break
+            # Send missed events, then real events from the hub. Skip live
+            # events that the client already has, either from before it
+            # reconnected or from the replay. (This process's hub may lag
+            # behind the stream, e.g. if the client was previously connected
+            # to another process.)
+            last_key = None
 
-            message = pubsub.get_message()
+            if last_event_id is not None:
+                try:
+                    last_key = app.notify.parse_event_id(last_event_id)
+                except ValueError:
+                    pass
 
-            if message is not None:
-                channel = message['channel'].decode('utf8')
-                data = message['data'].decode('utf8')
-                message_args = event_id, channel, data
-                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(*message_args)
-                event_id += 1
-            else:
-                time.sleep(0.2)
+            for event in replayed:
+                for due in coalescer.add(event, time.monotonic()):
+                    yield self._format_event(due)
+
+            if len(replayed) > 0:
+                last_key = app.notify.parse_event_id(replayed[-1].id)
+
+            while not self.__class__.__should_quit and not subscriber.closed:
+                now = time.monotonic()
+
+                for due in coalescer.flush(now):
+                    yield self._format_event(due)
+
+                timeout = coalescer.next_due(now)
+
+                if timeout is None or timeout > keepalive:
+                    timeout = keepalive
+
+                event = subscriber.get(timeout=timeout)
+
+                if event is None:
+                    if coalescer.next_due(time.monotonic()) is None:
+                        # Send an SSE comment. This keeps proxies from closing
+                        # an idle connection, and lets the server notice
+                        # clients that have gone away.
+                        yield ':\n\n'
+
+                    continue
+
+                if last_key is not None:
+                    if app.notify.parse_event_id(event.id) <= last_key:
+                        continue
+
+                    last_key = None
+
+                for due in coalescer.add(event, time.monotonic()):
+                    yield self._format_event(due)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    def _format_event(self, event):
+        ''' Format an event for the SSE stream. '''
 
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event.id, event.channel,
+                                                        event.data)
@@ -1,16 +1,21 @@
 from flask import g, json, jsonify, request
 from flask_classy import FlaskView, route
 from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.exceptions import BadRequest, NotFound
 
 from app.authorization import login_required
 import app.database
+import app.etag
+import app.notify
 import app.queue
 from app.rest import get_int_arg, get_paging_arguments, \
-                     get_sort_arguments, isodate, url_for
-from model import Avatar, Post, Profile, Label
-from model.profile import avatar_join_profile, profile_join_self
+                     get_sort_columns, isodate, paginate, url_for
+from model import Avatar, File, Post, Profile, Label
+from model.post import file_join_post
+from model.profile import avatar_join_profile, label_join_profile, \
+                          profile_join_self, ProfileNote
 import worker
 
 
@@ -121,10 +126,18 @@ class ProfileView(FlaskView):
 
         # Get profile.
         id_ = get_int_arg('id_', id_)
+        etag = app.etag.profile_etag(g.redis, id_,
+                                     app.etag.LABEL_GENERATION_KEY)
+        not_modified = app.etag.not_modified(etag)
+
+        if not_modified is not None:
+            return not_modified
 
         try:
             profile, avatar = g.db.query(Profile, Avatar) \
                                   .outerjoin(Profile.current_avatar) \
+                                  .options(joinedload(Avatar.file),
+                                           joinedload(Avatar.thumb_file)) \
                                   .filter(Profile.id == id_).one()
         except NoResultFound:
             raise NotFound("Profile '%s' does not exist." % id_)
@@ -158,11 +171,11 @@ class ProfileView(FlaskView):
         if avatar is not None:
             response['avatar_url'] = url_for(
                 'FileView:get',
-                id_=avatar.file.id
+                id_=avatar.file.hash_name()
             )
             response['avatar_thumb_url'] = url_for(
                 'FileView:get',
-                id_=avatar.thumb_file.id
+                id_=avatar.thumb_file.hash_name()
             )
         else:
             response['avatar_url'] = url_for(
@@ -175,7 +188,7 @@ class ProfileView(FlaskView):
             )
 
         # Send response.
-        return jsonify(**response)
+        return app.etag.set_etag(jsonify(**response), etag)
 
     @route('/<id_>/posts')
     def get_posts(self, id_):
@@ -207,10 +220,16 @@ class ProfileView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query after: resume after the last post of the previous page, using
+            that page's `next_after` token (optional, overrides `page`)
+        :query count: set to "exact" to count all posts exactly, instead of
+            using an estimate for large result sets (optional)
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
 
         :>header Content-Type: application/json
+        :>json str next_after: token for fetching the next page, or null if
+            this is the last page
         :>json list posts: List of post objects.
         :>json str posts[n].content: Text content of the post.
         :>json int posts[n].id: Unique identifier for post.
@@ -225,6 +244,7 @@ class ProfileView(FlaskView):
         :>json str site_name: Site name associated with the requested profile
         :>json int total_count: Total count of all posts by this profile, not
             just those displayed on this page
+        :>json bool total_count_exact: false if `total_count` is an estimate
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -232,7 +252,13 @@ class ProfileView(FlaskView):
         :status 404: user does not exist
         '''
 
-        page, results_per_page = get_paging_arguments(request.args)
+        id_ = get_int_arg('id_', id_)
+        etag = app.etag.profile_etag(g.redis, id_)
+        not_modified = app.etag.not_modified(etag)
+
+        if not_modified is not None:
+            return not_modified
+
         profile = g.db.query(Profile).filter(Profile.id == id_).first()
 
         if profile is None:
@@ -242,13 +268,17 @@ class ProfileView(FlaskView):
         post_query = g.db.query(Post) \
                          .filter(Post.author_id == id_)
 
-        total_count = post_query.count()
+        sort_columns = [(Post.upstream_created, True)]
+        rows, total_count, count_exact, next_after = paginate(
+            post_query,
+            request.args,
+            sort_columns,
+            Post.id
+        )
 
-        post_query = post_query.order_by(Post.upstream_created.desc()) \
-                               .limit(results_per_page) \
-                               .offset((page - 1) * results_per_page)
+        attachments = self._prefetch_attachments([post.id for post in rows])
 
-        for post in post_query:
+        for post in rows:
             post_dict = {
                 'content': post.content,
                 'id': post.id,
@@ -259,24 +289,29 @@ class ProfileView(FlaskView):
                 'upstream_id': post.upstream_id,
             }
 
-            if len(post.attachments) > 0:
-                attachment = post.attachments[0]
+            if post.id in attachments:
+                attachment = attachments[post.id]
 
                 post_dict['attachment'] = {
                     'mime': attachment.mime,
                     'name': attachment.name,
-                    'url': url_for('FileView:get', id_=attachment.id)
+                    'url': url_for('FileView:get',
+                                   id_=attachment.hash_name())
                 }
 
             posts.append(post_dict)
 
-        return jsonify(
+        response = jsonify(
+            next_after=next_after,
             posts=posts,
             site_name=profile.site_name(),
             total_count=total_count,
+            total_count_exact=count_exact,
             username=profile.username
         )
 
+        return app.etag.set_etag(response, etag)
+
     @route('/<id_>/posts/fetch')
     def get_older_posts(self, id_):
         '''
@@ -353,10 +388,16 @@ class ProfileView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query after: resume after the last relation of the previous page,
+            using that page's `next_after` token (optional, overrides `page`)
+        :query count: set to "exact" to count all relations exactly, instead
+            of using an estimate for large result sets (optional)
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
 
         :>header Content-Type: application/json
+        :>json str next_after: token for fetching the next page, or null if
+            this is the last page
         :>json object relations Array of related profiles.
         :>json int relations[n].avatar_thumb_url a URL to a thumbnail of the
             user's current avatar
@@ -365,6 +406,7 @@ class ProfileView(FlaskView):
         :>json str relations[n].username This relation's username.
         :>json int total_count Total count of all related profiles, not just
             those on the current page.
+        :>json bool total_count_exact false if `total_count` is an estimate
 
         :status 200: ok
         :status 400: invalid argument[s]
@@ -372,7 +414,14 @@ class ProfileView(FlaskView):
         :status 404: user does not exist
         '''
 
-        page, results_per_page = get_paging_arguments(request.args)
+        id_ = get_int_arg('id_', id_)
+        etag = app.etag.profile_etag(g.redis, id_,
+                                     app.etag.SUMMARY_GENERATION_KEY)
+        not_modified = app.etag.not_modified(etag)
+
+        if not_modified is not None:
+            return not_modified
+
         profile = g.db.query(Profile).filter(Profile.id == id_).first()
 
         if profile is None:
@@ -390,23 +439,26 @@ class ProfileView(FlaskView):
         relationship_query = \
             g.db.query(Profile, Avatar) \
                 .outerjoin(Profile.current_avatar) \
+                .options(joinedload(Avatar.thumb_file)) \
                 .join(profile_join_self, join_cond) \
                 .filter(filter_cond)
 
-        total_count = relationship_query.count()
-
-        relationship_query = relationship_query \
-            .order_by(Profile.is_stub, Profile.username) \
-            .limit(results_per_page) \
-            .offset((page - 1) * results_per_page)
+        sort_columns = [(Profile.is_stub, False), (Profile.username, False)]
+        rows, total_count, count_exact, next_after = paginate(
+            relationship_query,
+            request.args,
+            sort_columns,
+            Profile.id,
+            entity=lambda row: row[0]
+        )
 
         relations = list()
 
-        for relation, avatar in relationship_query:
+        for relation, avatar in rows:
             if avatar is not None:
                 thumb_url = url_for(
                     'FileView:get',
-                    id_=avatar.thumb_file.id
+                    id_=avatar.thumb_file.hash_name()
                 )
             else:
                 thumb_url = url_for(
@@ -421,13 +473,17 @@ class ProfileView(FlaskView):
                 'username': relation.username,
             })
 
-        return jsonify(
+        response = jsonify(
+            next_after=next_after,
             site_name=profile.site_name(),
             relations=relations,
             total_count=total_count,
+            total_count_exact=count_exact,
             username=profile.username
         )
 
+        return app.etag.set_etag(response, etag)
+
     @route('/<id_>/relations/fetch')
     def get_more_relations(self, id_):
         '''
@@ -507,6 +563,10 @@ class ProfileView(FlaskView):
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query after: resume after the last profile of the previous page,
+            using that page's `next_after` token (optional, overrides `page`)
+        :query count: set to "exact" to count all profiles exactly, instead of
+            using an estimate for large result sets (optional)
         :query page: the page number to display (default: 1)
         :query rpp: the number of results per page (default: 10)
         :query interesting: filter by whether profile is set as interesting
@@ -515,6 +575,8 @@ class ProfileView(FlaskView):
         :query stub: filter by whether profile is stub
 
         :>header Content-Type: application/json
+        :>json str next_after: token for fetching the next page, or null if
+            this is the last page
         :>json list profiles: a list of profile objects
         :>json str profiles[n].avatar_url: a URL to the user's current avatar
             image
@@ -555,24 +617,26 @@ class ProfileView(FlaskView):
         :>json str profiles[n].username: the current username for this profile
         :>json int total_count: count of all profile objects, not just those on
             the current page
+        :>json bool total_count_exact: false if `total_count` is an estimate
 
         :status 200: ok
         :status 400: invalid argument[s]
         :status 401: authentication required
         '''
 
-        page, results_per_page = get_paging_arguments(request.args)
         allowed_sort_fields = {
             'score': Profile.score,
             'updated': Profile.last_update,
             'added': Profile.id
         }
-        sort_arguments = get_sort_arguments(request.args,
-                                            '-added',
-                                            allowed_sort_fields)
+        sort_columns = get_sort_columns(request.args,
+                                        '-added',
+                                        allowed_sort_fields)
 
         query = g.db.query(Profile, Avatar) \
-                    .outerjoin(Profile.current_avatar)
+                    .outerjoin(Profile.current_avatar) \
+                    .options(joinedload(Avatar.file),
+                             joinedload(Avatar.thumb_file))
 
         # Parse filter arguments
         is_stub = request.args.get('stub', None)
@@ -603,28 +667,34 @@ class ProfileView(FlaskView):
                     Profile.labels.any(Label.name==label.lower())
                 )
 
-        total_count = query.count()
-
-        for argument in sort_arguments:
-            query = query.order_by(argument)
-
-        query = query.limit(results_per_page) \
-                     .offset((page - 1) * results_per_page)
+        rows, total_count, count_exact, next_after = paginate(
+            query,
+            request.args,
+            sort_columns,
+            Profile.id,
+            entity=lambda row: row[0]
+        )
 
         profiles = list()
-
-        for profile, avatar in query:
-            data = profile.as_dict()
+        profile_ids = [profile.id for profile, avatar in rows]
+        labels = self._prefetch_labels(profile_ids)
+        notes = self._prefetch_notes(profile_ids)
+
+        for profile, avatar in rows:
+            data = profile.as_dict(
+                labels=labels.get(profile.id, []),
+                notes=notes.get(profile.id, [])
+            )
             data['url'] = url_for('ProfileView:get', id_=profile.id)
 
             if avatar is not None:
                 data['avatar_url'] = url_for(
                     'FileView:get',
-                    id_=avatar.file.id
+                    id_=avatar.file.hash_name()
                 )
                 data['avatar_thumb_url'] = url_for(
                     'FileView:get',
-                    id_=avatar.thumb_file.id
+                    id_=avatar.thumb_file.hash_name()
                 )
             else:
                 data['avatar_url'] = url_for(
@@ -639,8 +709,10 @@ class ProfileView(FlaskView):
             profiles.append(data)
 
         return jsonify(
+            next_after=next_after,
             profiles=profiles,
-            total_count=total_count
+            total_count=total_count,
+            total_count_exact=count_exact
         )
 
     def post(self):
@@ -931,7 +1003,8 @@ class ProfileView(FlaskView):
                                 g.db.add(label)
                                 g.db.flush()
 
-                                redis.publish(
+                                app.notify.publish(
+                                    redis,
                                     'label',
                                     json.dumps(label.as_dict())
                                 )
@@ -961,7 +1034,8 @@ class ProfileView(FlaskView):
         # Save the profile
         try:
             g.db.commit()
-            redis.publish('profile', json.dumps(profile.as_dict()))
+            app.etag.bump_profile_version(redis, profile.id)
+            app.notify.publish(redis, 'profile', json.dumps(profile.as_dict()))
         except DBAPIError as e:
             g.db.rollback()
             raise BadRequest('Profile could not be saved')
@@ -992,11 +1066,11 @@ class ProfileView(FlaskView):
         if avatar is not None:
             response['avatar_url'] = url_for(
                 'FileView:get',
-                id_=avatar.file.id
+                id_=avatar.file.hash_name()
             )
             response['avatar_thumb_url'] = url_for(
                 'FileView:get',
-                id_=avatar.thumb_file.id
+                id_=avatar.thumb_file.hash_name()
             )
         else:
             response['avatar_url'] = url_for(
@@ -1170,6 +1244,9 @@ class ProfileView(FlaskView):
         except DBAPIError as e:
             raise BadRequest('Database error: {}'.format(e))
 
+        app.etag.bump_profile_version(g.redis, id_)
+        app.etag.bump_summary_generation(g.redis)
+
         # Queue jobs to delete profile and posts from index
         app.queue.schedule_delete_profile_from_index(id_)
         app.queue.schedule_delete_profile_posts_from_index(id_)
@@ -1180,6 +1257,69 @@ class ProfileView(FlaskView):
 
         return response
 
+    def _prefetch_attachments(self, post_ids):
+        '''
+        Load the first attachment for each of several posts in one query.
+
+        Returns a dictionary that maps post ID to File.
+        '''
+
+        attachments = dict()
+
+        if len(post_ids) == 0:
+            return attachments
+
+        query = g.db.query(file_join_post.c.post_id, File) \
+                    .join(File, File.id == file_join_post.c.file_id) \
+                    .filter(file_join_post.c.post_id.in_(post_ids)) \
+                    .order_by(file_join_post.c.post_id, File.id)
+
+        for post_id, file_ in query:
+            attachments.setdefault(post_id, file_)
+
+        return attachments
+
+    def _prefetch_labels(self, profile_ids):
+        '''
+        Load labels for several profiles in one query.
+
+        Returns a dictionary that maps profile ID to a list of labels.
+        '''
+
+        labels = dict()
+
+        if len(profile_ids) == 0:
+            return labels
+
+        query = g.db.query(label_join_profile.c.profile_id, Label) \
+                    .join(Label, Label.id == label_join_profile.c.label_id) \
+                    .filter(label_join_profile.c.profile_id.in_(profile_ids))
+
+        for profile_id, label in query:
+            labels.setdefault(profile_id, []).append(label)
+
+        return labels
+
+    def _prefetch_notes(self, profile_ids):
+        '''
+        Load notes for several profiles in one query.
+
+        Returns a dictionary that maps profile ID to a list of notes.
+        '''
+
+        notes = dict()
+
+        if len(profile_ids) == 0:
+            return notes
+
+        query = g.db.query(ProfileNote) \
+                    .filter(ProfileNote.profile_id.in_(profile_ids))
+
+        for note in query:
+            notes.setdefault(note.profile_id, []).append(note)
+
+        return notes
+
     def _get_label_id(self, name):
         """
         Get or create a database label object, return the ID.
@@ -1208,6 +1348,6 @@ class ProfileView(FlaskView):
                     .format(name)
                 )
 
-            redis.publish('label', json.dumps(label.as_dict()))
+            app.notify.publish(redis, 'label', json.dumps(label.as_dict()))
             print('Created label :{}'.format(label.id), flush=True)
             return label.id
@@ -0,0 +1,136 @@
+from flask import g, jsonify, request, Response
+from flask_classy import FlaskView
+from werkzeug.exceptions import BadRequest, NotFound
+
+from app.authorization import admin_required
+import app.profiling
+from app.rest import get_int_arg, url_for
+
+
+class ProfilingView(FlaskView):
+    '''
+    Download profiles of individual requests.
+
+    An administrator can profile any request by sending an `X-Profile: 1`
+    header or an `xprofile=1` query parameter with it. The response then
+    includes an `X-Profile-ID` header with the ID of the stored profile.
+    Each administrator may profile `[profiling] rate_limit` requests per hour,
+    and profiles expire after `[profiling] ttl` seconds.
+
+    Requires an administrator account.
+    '''
+
+    SORT_KEYS = ('calls', 'cumulative', 'ncalls', 'time', 'tottime')
+
+    decorators = [admin_required]
+
+    def get(self, id_):
+        '''
+        Download a profile.
+
+        By default, the profile is sent as a binary file in the format written
+        by `cProfile`, which can be opened with `pstats` or SnakeViz. With
+        `format=text`, a summary of the most expensive functions is sent
+        instead.
+
+        :<header X-Auth: the client's auth token
+        :query format: "binary" (default) or "text"
+        :query sort: for text summaries, the sort key: "cumulative" (default),
+            "tottime", "time", "calls", or "ncalls"
+        :query limit: for text summaries, the number of functions to list
+            (default: 50)
+
+        :>header Content-Type: application/octet-stream or text/plain
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        :status 403: must be an administrator
+        :status 404: no profile with this ID (it may have expired)
+        '''
+
+        profile = app.profiling.get_profile(g.redis, id_)
+
+        if profile is None:
+            raise NotFound('No profile exists with ID "{}".'.format(id_))
+
+        meta, data = profile
+        format_ = request.args.get('format', 'binary')
+
+        if format_ == 'binary':
+            filename = 'request-{}.prof'.format(id_)
+            headers = {
+                'Content-Disposition': 'attachment; filename={}'
+                                       .format(filename),
+            }
+
+            return Response(data, mimetype='application/octet-stream',
+                            headers=headers)
+        elif format_ == 'text':
+            sort = request.args.get('sort', 'cumulative')
+            limit = get_int_arg('limit', request.args.get('limit', 50))
+
+            if sort not in self.__class__.SORT_KEYS:
+                raise BadRequest('Invalid sort key: {}'.format(sort))
+
+            header = '{} {} ({:.3f}s)\n\n'.format(meta['method'], meta['path'],
+                                                  meta['duration'])
+            text = app.profiling.format_stats(data, sort, limit)
+
+            return Response(header + text, mimetype='text/plain')
+        else:
+            raise BadRequest('`format` must be "binary" or "text".')
+
+    def index(self):
+        '''
+        List stored profiles, newest first.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "profiles": [
+                    {
+                        "created": 1476889200.5,
+                        "duration": 1.7342,
+                        "endpoint": "ProfileView:index",
+                        "id": "7b1d6cbe0a3a4f1c9ad1d5a0f3f2e1c4",
+                        "method": "GET",
+                        "path": "/api/profile/?page=3",
+                        "size": 48211,
+                        "url": "https://quickpin/api/profiling/7b1d6cbe...",
+                        "user_id": 1
+                    },
+                    ...
+                ]
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json list profiles: stored profiles
+        :>json float profiles[n]["created"]: when the profile was taken (Unix
+            time)
+        :>json float profiles[n]["duration"]: time to handle the request
+            (seconds, including profiling overhead)
+        :>json str profiles[n]["endpoint"]: the view that handled the request
+        :>json str profiles[n]["id"]: unique identifier
+        :>json str profiles[n]["method"]: HTTP method of the request
+        :>json str profiles[n]["path"]: path and query string of the request
+        :>json int profiles[n]["size"]: size of the profile (bytes)
+        :>json str profiles[n]["url"]: URL to download the profile
+        :>json int profiles[n]["user_id"]: ID of the user who made the request
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 403: must be an administrator
+        '''
+
+        profiles = app.profiling.list_profiles(g.redis)
+
+        for profile in profiles:
+            profile['url'] = url_for('ProfilingView:get', id_=profile['id'])
+
+        return jsonify(profiles=profiles)
@@ -1,11 +1,16 @@
-from datetime import date
+from collections import defaultdict
+import csv
+from datetime import date, datetime
+import hashlib
+import io
 import re
-from flask import g, jsonify, request
+from flask import g, json, jsonify, request, Response
 from flask_classy import FlaskView, route
 from scorched.strings import DismaxString
 from werkzeug.exceptions import BadRequest
 
 from app.authorization import login_required
+import app.index
 from app.rest import get_paging_arguments
 
 
@@ -20,6 +25,24 @@ class SearchView(FlaskView):
     # instead. Get it??
     HIGHLIGHT_TOKEN = '☼☼☼'
 
+    # Search results are cached in Redis under this prefix. The index
+    # generation is part of each key, so a commit to the index makes all
+    # older entries unreachable and they simply expire.
+    CACHE_PREFIX = 'search:result'
+    FACET_CACHE_PREFIX = 'search:facets'
+    CACHE_STATS_KEY = 'search:cache:stats'
+
+    # The number of rows to fetch from Solr per cursor page when exporting.
+    EXPORT_BATCH_SIZE = 500
+
+    # Columns included in CSV exports, in order. Each hit type only fills in
+    # the columns that apply to it.
+    EXPORT_CSV_FIELDS = (
+        'id', 'type', 'site', 'username', 'profile_id', 'post_id', 'name',
+        'upstream_id', 'description', 'content', 'location', 'joined',
+        'posted', 'updated', 'friend_count', 'follower_count', 'post_count',
+    )
+
     @route('')
     def query(self):
         '''
@@ -57,6 +80,12 @@ class SearchView(FlaskView):
         should be highlighted if and only if `highlighted[i]` is `true`. In the
         example above, the word "quick" should be highlighted by the client.
 
+        Results are cached in Redis for each distinct combination of query,
+        facets, type, sort, and paging arguments. Facet counts are cached
+        separately for each combination of query, facets, and type, so paging
+        through results does not recompute them. The cache is invalidated
+        whenever the search index is modified.
+
         Facets can be selected by encoding a list of facet field/value pairs as
         a list delimited by null bytes and passing it in the `facets` query
         parameter. Note that the current implementation only supports one value
@@ -119,6 +148,8 @@ class SearchView(FlaskView):
         :<header Content-Type: application/json
         :query facets: a null-delimited list of facet field names and values,
             delimited by null bytes (optional)
+        :query include_facets: set to 0 to omit facet counts from the
+            response (default: 1)
         :query page: the page number to display (default: 1)
         :query sort: a field name to sort by, optionally prefixed with a "-" to
             indicate descending sort, e.g. "post_date" sorts ascending by the
@@ -147,24 +178,270 @@ class SearchView(FlaskView):
         type_ = request.args.get('type')
         sort = request.args.get('sort')
         facet_args = request.args.get('facets')
+        include_facets = request.args.get('include_facets', '1') != '0'
         page, results_per_page = get_paging_arguments(request.args)
         start_row = (page - 1) * results_per_page
 
-        highlight_fields = [
-            'content_txt_en',
-            'description_txt_en',
-            'location_txt_en',
-            'name_txt_en',
-            'site_name_txt_en',
-            'username_s',
-        ]
-
-        highlight_options = {
-            'snippets': 1,
-            'simple.pre': SearchView.HIGHLIGHT_TOKEN,
-            'simple.post': SearchView.HIGHLIGHT_TOKEN,
+        cache_key = self._cache_key(
+            SearchView.CACHE_PREFIX,
+            query=query,
+            type=type_,
+            sort=sort,
+            facets=facet_args,
+            page=page,
+            rpp=results_per_page
+        )
+        data = self._cache_get(cache_key, 'hits', 'misses')
+
+        if data is None:
+            highlight_fields = [
+                'content_txt_en',
+                'description_txt_en',
+                'location_txt_en',
+                'name_txt_en',
+                'site_name_txt_en',
+                'username_s',
+            ]
+
+            highlight_options = {
+                'snippets': 1,
+                'simple.pre': SearchView.HIGHLIGHT_TOKEN,
+                'simple.post': SearchView.HIGHLIGHT_TOKEN,
+            }
+
+            search = self._base_search(query, type_, facet_args) \
+                         .highlight(highlight_fields, **highlight_options) \
+                         .paginate(start=start_row, rows=results_per_page)
+
+            if sort is not None:
+                search = search.sort_by(sort)
+
+            response = search.execute()
+            results = list()
+            highlights = response.highlighting
+            for doc in response:
+                formatter = formatters[doc['type_s']]
+                results.append(formatter(doc, highlights))
+
+            data = {
+                'results': results,
+                'total_count': response.result.numFound,
+            }
+
+            self._cache_set(cache_key, data)
+
+        if include_facets:
+            data['facets'] = self._get_facets(query, type_, facet_args)
+
+        return jsonify(**data)
+
+    @route('facets')
+    def facets(self):
+        '''
+        Get facet counts for a search query.
+
+        This returns the same facets as the main search API, but without
+        fetching any search hits. Facet counts do not depend on paging or sort
+        order, so they are cached separately from search hits: a client that
+        pages through results can request hits with `include_facets=0` and
+        fetch facets from this API once per query.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "facets": {
+                    "site_name_txt_en": [
+                        ["twitter", 181],
+                        ["instagram", 90],
+                        ...
+                    ],
+                    ...
+                }
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+        :query facets: a null-delimited list of facet field names and values,
+            delimited by null bytes (optional)
+        :query query: search query
+        :query type: type of document to match, e.g. Profile, Post, etc.
+            (optional)
+
+        :>header Content-Type: application/json
+        :>json dict facets: dictionary of facet names and facet values/counts
+
+        :status 200: ok
+        :status 401: authentication required
+        '''
+
+        query = request.args.get('query')
+        type_ = request.args.get('type')
+        facet_args = request.args.get('facets')
+
+        return jsonify(facets=self._get_facets(query, type_, facet_args))
+
+    @route('export')
+    def export(self):
+        '''
+        Export all hits for a search query.
+
+        Unlike the main search API, this API is not paged: it streams every
+        hit that matches the query. It walks the Solr result set with a cursor
+        rather than an offset, so exporting a large result set takes constant
+        memory and each batch is as cheap as the first.
+
+        Hits are formatted the same way as in the main search API, except that
+        highlighting is disabled and highlighted fields are flattened to
+        plain strings.
+
+        The `format` argument selects newline-delimited JSON (one hit per
+        line) or CSV.
+
+        :<header X-Auth: the client's auth token
+        :query facets: a null-delimited list of facet field names and values,
+            delimited by null bytes (optional)
+        :query format: "ndjson" (default) or "csv"
+        :query query: search query
+        :query sort: a field name to sort by, optionally prefixed with a "-" to
+            indicate descending sort
+        :query type: type of document to match, e.g. Profile, Post, etc.
+            (optional)
+
+        :>header Content-Type: application/x-ndjson or text/csv
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        '''
+
+        query = request.args.get('query')
+        type_ = request.args.get('type')
+        sort = request.args.get('sort')
+        facet_args = request.args.get('facets')
+        format_ = request.args.get('format', 'ndjson')
+
+        if format_ == 'ndjson':
+            mimetype = 'application/x-ndjson'
+            serialize = self._export_ndjson
+        elif format_ == 'csv':
+            mimetype = 'text/csv'
+            serialize = self._export_csv
+        else:
+            raise BadRequest('`format` must be "ndjson" or "csv".')
+
+        search = self._base_search(query, type_, facet_args)
+
+        # A cursor requires a sort that ends on the unique key.
+        if sort is not None:
+            search = search.sort_by(sort)
+
+        search = search.sort_by('id')
+        cursor = search.cursor(rows=SearchView.EXPORT_BATCH_SIZE)
+        hits = (self._flatten_hit(hit) for hit in self._export_hits(cursor))
+        filename = 'search.{}'.format('csv' if format_ == 'csv' else 'json')
+        headers = {
+            'Content-Disposition': 'attachment; filename={}'.format(filename),
         }
 
+        return Response(serialize(hits), mimetype=mimetype, headers=headers)
+
+    @route('cache')
+    def cache(self):
+        '''
+        Get search result cache statistics.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "facet_hits": 1402,
+                "facet_misses": 117,
+                "generation": 42,
+                "hits": 1208,
+                "misses": 311
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json int facet_hits: number of facet counts answered from the cache
+        :>json int facet_misses: number of facet counts computed by Solr
+        :>json int generation: the current search index generation
+        :>json int hits: number of searches answered from the cache
+        :>json int misses: number of searches that were sent to Solr
+
+        :status 200: ok
+        :status 401: authentication required
+        '''
+
+        stats = g.redis.hgetall(SearchView.CACHE_STATS_KEY)
+
+        return jsonify(
+            facet_hits=int(stats.get(b'facet_hits', 0)),
+            facet_misses=int(stats.get(b'facet_misses', 0)),
+            generation=app.index.get_generation(g.redis),
+            hits=int(stats.get(b'hits', 0)),
+            misses=int(stats.get(b'misses', 0))
+        )
+
+    def _add_facet_fields(self, query):
+        ''' Tell Solr to generate facets on a search query. '''
+
+        return query.facet_by('site_name_txt_en', mincount=1) \
+                    .facet_by('username_s', mincount=1) \
+                    .facet_by('type_s', mincount=1) \
+                    .facet_by('is_stub_b', mincount=1) \
+                    .facet_range(fields='join_date_tdt',
+                                 start='NOW-120MONTHS/MONTH',
+                                 end='NOW/MONTH',
+                                 gap='+1MONTH',
+                                 mincount=1) \
+                    .facet_range(fields='post_date_tdt',
+                                 start='NOW-120MONTHS/MONTH',
+                                 end='NOW/MONTH',
+                                 gap='+1MONTH',
+                                 mincount=1)
+
+    def _add_facet_filters(self, query, facet_args):
+        '''
+        Interpret the request's facet arguments as constraints on the Solr
+        query.
+        '''
+
+        if facet_args is not None:
+            facet_arg_list = facet_args.split('\x00')
+            facets = {}
+
+            try:
+                for i in range(0, len(facet_arg_list), 2):
+                    facets[facet_arg_list[i]] = facet_arg_list[i+1]
+            except IndexError:
+                raise BadRequest("Invalid facet list.")
+
+            for field, value in facets.items():
+                if field == 'join_date_tdt':
+                    date_range = '[%s/MONTH TO %s+1MONTHS/MONTH]' % (value,value)
+                    query = query.filter(join_date_tdt=DismaxString(date_range))
+                elif field == 'post_date_tdt':
+                    date_range = '[%s/MONTH TO %s+1MONTHS/MONTH]' % (value,value)
+                    query = query.filter(post_date_tdt=DismaxString(date_range))
+                else:
+                    query = query.filter(**{field: value})
+
+        return query
+
+    def _base_search(self, query, type_, facet_args):
+        '''
+        Build a Solr query for the search string, type, and facet filters.
+
+        The caller is responsible for adding highlighting, paging, sorting, or
+        facet fields as needed.
+        '''
+
         # These are user-friendly(er) names for the cryptic field names. Solr
         # allows a single alias to refer to multiple fields, so the fields are
         # specified as a list.
@@ -192,25 +469,84 @@ class SearchView(FlaskView):
         }
 
         search = g.solr.query(DismaxString(query)) \
-                       .alt_parser('edismax', f=aliases, qf=boosts) \
-                       .highlight(highlight_fields, **highlight_options) \
-                       .paginate(start=start_row, rows=results_per_page)
+                       .alt_parser('edismax', f=aliases, qf=boosts)
 
-        search = self._add_facets(search, facet_args)
+        search = self._add_facet_filters(search, facet_args)
 
         if type_ is not None:
             search = search.filter(type_s=type_)
 
-        if sort is not None:
-            search = search.sort_by(sort)
+        return search
+
+    def _cache_get(self, cache_key, hit_stat, miss_stat):
+        ''' Return cached data for `cache_key`, or None if not cached. '''
+
+        cached = g.redis.get(cache_key)
+
+        if cached is None:
+            g.redis.hincrby(SearchView.CACHE_STATS_KEY, miss_stat, 1)
+            return None
+        else:
+            g.redis.hincrby(SearchView.CACHE_STATS_KEY, hit_stat, 1)
+            return json.loads(cached.decode('utf8'))
+
+    def _cache_set(self, cache_key, data):
+        ''' Store `data` in the search cache. '''
+
+        cache_ttl = g.config.getint('search', 'cache_ttl')
+        g.redis.set(cache_key, json.dumps(data), ex=cache_ttl)
+
+    def _cache_key(self, prefix, **params):
+        '''
+        Return a Redis key for caching a search with the given parameters.
+
+        The query string is whitespace-normalized and the facet
+        pairs are sorted, so that equivalent searches share a cache entry.
+        '''
+
+        query = params.get('query')
+
+        if query is not None:
+            params['query'] = ' '.join(query.split())
+
+        facet_args = params.get('facets')
+
+        if facet_args is not None:
+            facet_arg_list = facet_args.split('\x00')
+            pairs = [facet_arg_list[i:i+2]
+                     for i in range(0, len(facet_arg_list), 2)]
+            params['facets'] = sorted(pairs)
+
+        encoded = json.dumps(params, sort_keys=True).encode('utf8')
+        digest = hashlib.sha1(encoded).hexdigest()
+        generation = app.index.get_generation(g.redis)
 
+        return '{}:{}:{}'.format(prefix, generation, digest)
+
+    def _get_facets(self, query, type_, facet_args):
+        '''
+        Get facet counts for a search, using the cache if possible.
+
+        Only facet counts are requested from Solr (no rows), and the result
+        is cached independently of paging and sort order.
+        '''
+
+        cache_key = self._cache_key(
+            SearchView.FACET_CACHE_PREFIX,
+            query=query,
+            type=type_,
+            facets=facet_args
+        )
+        facets = self._cache_get(cache_key, 'facet_hits', 'facet_misses')
+
+        if facets is not None:
+            return facets
+
+        search = self._base_search(query, type_, facet_args) \
+                     .paginate(rows=0)
+        search = self._add_facet_fields(search)
         response = search.execute()
-        results = list()
         facets = dict()
-        highlights = response.highlighting
-        for doc in response:
-            formatter = formatters[doc['type_s']]
-            results.append(formatter(doc, highlights))
 
         for field, field_facets in response.facet_counts.facet_fields.items():
             facets[field] = sorted(field_facets, key=lambda f: f[0].lower())
@@ -220,62 +556,77 @@ class SearchView(FlaskView):
             list_ = [(k, v) for k, v in counts.items()]
             facets[field] = sorted(list_, key=lambda f: f[0])
 
-        return jsonify(
-            results=results,
-            facets=facets,
-            total_count=response.result.numFound
-        )
+        self._cache_set(cache_key, facets)
 
-    def _add_facets(self, query, facet_args):
-        ''' Add facets to a search query. '''
-
-        # Tell Solr to generate facets on these fields.
-        query = query.facet_by('site_name_txt_en', mincount=1) \
-                     .facet_by('username_s', mincount=1) \
-                     .facet_by('type_s', mincount=1) \
-                     .facet_by('is_stub_b', mincount=1) \
-                     .facet_range(fields='join_date_tdt',
-                                  start='NOW-120MONTHS/MONTH',
-                                  end='NOW/MONTH',
-                                  gap='+1MONTH',
-                                  mincount=1) \
-                     .facet_range(fields='post_date_tdt',
-                                  start='NOW-120MONTHS/MONTH',
-                                  end='NOW/MONTH',
-                                  gap='+1MONTH',
-                                  mincount=1)
-
-        # Interpret the request's facet arguments as constraints on the Solr
-        # query.
-        if facet_args is not None:
-            facet_arg_list = facet_args.split('\x00')
-            facets = {}
+        return facets
 
-            try:
-                for i in range(0, len(facet_arg_list), 2):
-                    facets[facet_arg_list[i]] = facet_arg_list[i+1]
-            except IndexError:
-                raise BadRequest("Invalid facet list.")
+    def _export_csv(self, hits):
+        ''' Serialize exported hits as CSV, one row at a time. '''
 
-            for field, value in facets.items():
-                if field == 'join_date_tdt':
-                    date_range = '[%s/MONTH TO %s+1MONTHS/MONTH]' % (value,value)
-                    query = query.filter(join_date_tdt=DismaxString(date_range))
-                elif field == 'post_date_tdt':
-                    date_range = '[%s/MONTH TO %s+1MONTHS/MONTH]' % (value,value)
-                    query = query.filter(post_date_tdt=DismaxString(date_range))
-                else:
-                    query = query.filter(**{field: value})
+        buffer_ = io.StringIO()
+        writer = csv.DictWriter(buffer_, SearchView.EXPORT_CSV_FIELDS,
+                                extrasaction='ignore')
+        writer.writeheader()
 
-        return query
+        for hit in hits:
+            writer.writerow(hit)
+            yield buffer_.getvalue()
+            buffer_.seek(0)
+            buffer_.truncate()
+
+        yield buffer_.getvalue()
+
+    def _export_hits(self, cursor):
+        ''' Format each document returned by a Solr cursor. '''
+
+        formatters = {
+            'Post': self._format_post,
+            'Profile': self._format_profile,
+        }
+
+        # Highlighting is turned off, so every field falls back to plain text.
+        highlights = defaultdict(dict)
 
-    def _format_post(self, doc, highlights):
+        for doc in cursor:
+            yield formatters[doc['type_s']](doc, highlights, chars=None)
+
+    def _export_ndjson(self, hits):
+        ''' Serialize exported hits as newline-delimited JSON. '''
+
+        for hit in hits:
+            yield json.dumps(hit) + '\n'
+
+    def _flatten_hit(self, hit):
+        '''
+        Convert a formatted hit to plain values.
+
+        Highlighted fields are joined back into a single string and dates are
+        converted to ISO-8601.
+        '''
+
+        flattened = dict()
+
+        for key, value in hit.items():
+            if isinstance(value, dict) and 'text' in value:
+                value = ''.join(value['text'])
+            elif isinstance(value, list):
+                value = ','.join(map(str, value))
+            elif isinstance(value, datetime):
+                value = value.replace(microsecond=0).isoformat()
+
+            flattened[key] = value
+
+        return flattened
+
+    def _format_post(self, doc, highlights, chars=200):
         ''' Take a Solr doc and format it as a post search hit. '''
 
         id_ = doc['id']
-        content = self._highlight(doc, highlights[id_], 'content_txt_en')
-        site_name = self._highlight(doc, highlights[id_], 'site_name_txt_en')
-        username = self._highlight(doc, highlights[id_], 'username_s')
+        doc_highlights = highlights[id_]
+        content = self._highlight(doc, doc_highlights, 'content_txt_en', chars)
+        site_name = self._highlight(doc, doc_highlights,
+                                    'site_name_txt_en', chars)
+        username = self._highlight(doc, doc_highlights, 'username_s', chars)
 
         formatted = {
             'content': content,
@@ -290,20 +641,24 @@ class SearchView(FlaskView):
         }
 
         if 'location_txt_en' in doc:
-            formatted['location'] = self._highlight(doc, highlights[id_],
-                                                    'location_txt_en')
+            formatted['location'] = self._highlight(doc, doc_highlights,
+                                                    'location_txt_en', chars)
 
         return formatted
 
-    def _format_profile(self, doc, highlights):
+    def _format_profile(self, doc, highlights, chars=200):
         ''' Take a Solr doc and format it as a profile search hit. '''
 
         id_ = doc['id']
-        description = self._highlight(doc, highlights[id_], 'description_txt_en')
-        location = self._highlight(doc, highlights[id_], 'location_txt_en')
-        name = self._highlight(doc, highlights[id_], 'name_txt_en')
-        site_name = self._highlight(doc, highlights[id_], 'site_name_txt_en')
-        username = self._highlight(doc, highlights[id_], 'username_s')
+        doc_highlights = highlights[id_]
+        description = self._highlight(doc, doc_highlights,
+                                      'description_txt_en', chars)
+        location = self._highlight(doc, doc_highlights,
+                                   'location_txt_en', chars)
+        name = self._highlight(doc, doc_highlights, 'name_txt_en', chars)
+        site_name = self._highlight(doc, doc_highlights,
+                                    'site_name_txt_en', chars)
+        username = self._highlight(doc, doc_highlights, 'username_s', chars)
 
         formatted = {
             'description': description,
@@ -348,7 +703,8 @@ class SearchView(FlaskView):
         any words that need highlighting, then the returned text is truncated to
         the first `chars` characters (approximately). This function will try to
         truncate the string on a word boundary, which affects how many
-        characters are actually returned.
+        characters are actually returned. If `chars` is None, then the text is
+        not truncated.
         '''
 
         if field in highlights:
@@ -367,6 +723,9 @@ class SearchView(FlaskView):
 
             text = {'text': parts, 'highlighted': highlighted}
 
+        elif field in doc and chars is None:
+            text = {'text': [doc[field]], 'highlighted': [False]}
+
         elif field in doc:
             pattern = r'(.{,%d})\s?' % chars
             match = re.match(pattern, doc[field])
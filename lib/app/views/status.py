@@ -0,0 +1,71 @@
+from flask import jsonify
+from flask_classy import FlaskView, route
+
+import app.database
+from app.authorization import admin_required
+
+
+class StatusView(FlaskView):
+    '''
+    Report the status of this server process.
+
+    Requires an administrator account.
+    '''
+
+    decorators = [admin_required]
+
+    @route('database')
+    def database(self):
+        '''
+        Get statistics for this process's database connection pools.
+
+        Each server process has its own pools, so successive requests may be
+        answered by different processes. The top-level fields describe the
+        primary's pool, and `replicas` contains the same fields for each read
+        replica's pool.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "checked_out": 3,
+                "checkout_count": 18233,
+                "max_overflow": 10,
+                "max_wait_time": 0.0214,
+                "overflow": 0,
+                "replicas": [],
+                "size": 5,
+                "timeout_count": 0,
+                "wait_time": 1.8801
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+
+        :>header Content-Type: application/json
+        :>json int checked_out: number of connections currently in use
+        :>json int checkout_count: number of connections checked out since
+            the process started
+        :>json int max_overflow: maximum number of connections opened beyond
+            the pool size
+        :>json float max_wait_time: longest time (seconds) that a thread has
+            waited for a connection
+        :>json int overflow: number of connections currently open beyond the
+            pool size
+        :>json list replicas: statistics for each replica's pool
+        :>json int size: configured pool size
+        :>json int timeout_count: number of times a thread gave up waiting
+            for a connection
+        :>json float wait_time: total time (seconds) that threads have spent
+            waiting for connections
+
+        :status 200: ok
+        :status 401: authentication required
+        :status 403: must be an administrator
+        '''
+
+        return jsonify(
+            replicas=app.database.replica_pool_stats(),
+            **app.database.pool_stats()
+        )
@@ -1,11 +1,15 @@
-from flask import g, jsonify
+from flask import g, jsonify, request
 from flask_classy import FlaskView, route
 import rq
-from rq.exceptions import NoSuchJobError, UnpickleError
-from werkzeug.exceptions import NotFound
+from rq.exceptions import InvalidJobOperationError, NoSuchJobError, \
+                          UnpickleError
+from rq.job import Job
+from werkzeug.exceptions import BadRequest, NotFound
 
 from app.authorization import login_required
-from app.rest import url_for
+import app.failed_tasks
+import app.job_metrics
+from app.rest import get_int_arg, get_paging_arguments, url_for
 
 class TasksView(FlaskView):
     ''' Data about background tasks. '''
@@ -29,24 +33,56 @@ class TasksView(FlaskView):
         :status 404: no job exists with this ID
         '''
 
-        with rq.Connection(g.redis):
-            found = False
+        if self._delete_failed_tasks([id_]) == 0:
+            raise NotFound('No job exists with ID "%s".' % id_)
 
-            for job in rq.get_failed_queue().jobs:
-                if job.id == id_:
-                    job.delete()
-                    found = True
-                    break
+        return jsonify(message='ok')
 
-            if not found:
-                raise NotFound('No job exists with ID "%s".' % id_)
+    @route('/failed/delete', methods=['POST'])
+    def delete_failed(self):
+        '''
+        Delete several failed tasks.
 
-        return jsonify(message='ok')
+        Tasks are selected by ID, by the same filters as the failed task
+        listing, or all at once.
+
+        **Example Request**
+
+        .. sourcecode:: json
+
+            {
+                "type": "posts",
+                "profile_id": 1
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+        :<json list ids: IDs of tasks to delete (optional)
+        :<json str type: delete failed tasks of this type (optional)
+        :<json int profile_id: delete failed tasks for this profile (optional)
+        :<json bool all: delete all failed tasks (optional)
+
+        :>header Content-Type: application/json
+        :>json int count: the number of tasks deleted
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        '''
+
+        job_ids = self._get_selected_ids(allow_all=True)
+
+        if job_ids is None:
+            count = self._delete_all_failed_tasks()
+        else:
+            count = self._delete_failed_tasks(job_ids)
+
+        return jsonify(count=count)
 
     @route('failed')
     def failed_tasks(self):
         '''
-        Get data about failed tasks.
+        Get data about failed tasks, most recent failures first.
 
         **Example Response**
 
@@ -64,11 +100,16 @@ class TasksView(FlaskView):
                         "original_queue": "index"
                     },
                     ...
-                ]
+                ],
+                "total_count": 1
             }
 
         :<header Content-Type: application/json
         :<header X-Auth: the client's auth token
+        :query page: the page number to display (default: 1)
+        :query rpp: the number of results per page (default: 10)
+        :query type: only show tasks of this type (optional)
+        :query profile_id: only show tasks for this profile (optional)
 
         :>header Content-Type: application/json
         :>json list failed: list of failed tasks
@@ -81,62 +122,45 @@ class TasksView(FlaskView):
             performed
         :>json str failed[n]["original_queue"]: the queue that this task was
             initially placed on before it failed
+        :>json int total_count: the number of failed tasks that match the
+            filters
 
         :status 200: ok
+        :status 400: invalid argument[s]
         :status 401: authentication required
         :status 403: you must be an administrator
         '''
 
+        page, results_per_page = get_paging_arguments(request.args)
+        profile_id = get_int_arg('profile_id', request.args.get('profile_id'),
+                                 optional=True)
+
+        app.failed_tasks.reconcile(g.redis)
+        job_ids, total_count = app.failed_tasks.query(
+            g.redis,
+            type_=request.args.get('type'),
+            profile_id=profile_id,
+            offset=(page - 1) * results_per_page,
+            limit=results_per_page
+        )
+
         failed_tasks = list()
+        missing = list()
 
-        with rq.Connection(g.redis):
-            for failed_task in rq.get_failed_queue().jobs:
-                try:
-                    if 'description' in failed_task.meta:
-                        desc = failed_task.meta['description']
-                    else:
-                        desc = None
-
-                    if 'profile_id' in failed_task.meta:
-                        profile_id = failed_task.meta['profile_id']
-                    else:
-                        profile_id = None
-
-                    if 'type' in failed_task.meta:
-                        type_ = failed_task.meta['type']
-                    else:
-                        type_ = None
-
-                    exception_info = failed_task.exc_info
-                    if exception_info is not None:
-                        try:
-                            exception_info = exception_info.decode()
-                        except AttributeError:
-                            exception_info = exception_info
-                    else:
-                        exception_info = 'Unknown error'
-
-                    failed_tasks.append({
-                        'description': desc,
-                        'function': failed_task.get_call_string(),
-                        'exception': exception_info,
-                        'id': failed_task.id,
-                        'profile_id': profile_id,
-                        'type': type_,
-                        'original_queue': failed_task.origin,
-                    })
-                except UnpickleError:
-                    failed_tasks.append({
-                        'description': 'Error: this job cannot be unpickled.',
-                        'function': None,
-                        'exception': exception_info,
-                        'id': failed_task.id,
-                        'profile_id': profile_id,
-                        'type': type_,
-                        'original_queue': failed_task.origin,
-                    })
-
-        return jsonify(failed=failed_tasks)
+        for job_id in job_ids:
+            try:
+                failed_task = Job.fetch(job_id, connection=g.redis)
+            except NoSuchJobError:
+                missing.append(job_id)
+                continue
+
+            failed_tasks.append(self._failed_task_json(failed_task))
+
+        if len(missing) > 0:
+            app.failed_tasks.remove(g.redis, missing)
+            total_count -= len(missing)
+
+        return jsonify(failed=failed_tasks, total_count=total_count)
 
     @route('job/<id_>')
     def job(self, id_):
@@ -179,33 +203,102 @@ class TasksView(FlaskView):
         :status 404: no job with the specified ID
         '''
 
-        # workers = list()
+        try:
+            job = Job.fetch(id_, connection=g.redis)
+        except NoSuchJobError:
+            raise NotFound('No job exists with that ID.')
+
+        if 'current' in job.meta:
+            return jsonify(
+                current=job.meta['current'],
+                description=job.meta['description'],
+                id=job.id,
+                progress=job.meta['current']  / job.meta['total'],
+                total=job.meta['total'],
+                type=job.meta['type'] if 'type' in job.meta else None
+            )
+        else:
+            return jsonify(
+                description=job.meta['description'],
+                id=job.id,
+                type=job.meta['type'] if 'type' in job.meta else None
+            )
+
+    @route('metrics')
+    def metrics(self):
+        '''
+        Get timing and throughput metrics for each type of job.
 
-        with rq.Connection(g.redis):
-            for queue in rq.Queue.all():
-                if queue.name == 'failed':
-                    continue
+        Each job records how long it waited in its queue, how long it ran,
+        how much of that time it spent on HTTP, database, and Solr requests,
+        and how many items it processed. Percentiles are estimated from
+        histograms, so each one is the upper bound of a histogram bucket.
+
+        **Example Response**
+
+        .. sourcecode:: json
+
+            {
+                "metrics": {
+                    "scrape_twitter_posts": {
+                        "db_time": {
+                            "count": 12,
+                            "mean": 0.84,
+                            "p50": 0.5,
+                            "p95": 2.5,
+                            "p99": 2.5,
+                            "sum": 10.08
+                        },
+                        "failed": 1,
+                        "finished": 11,
+                        "items_per_second": 41.2,
+                        "jobs_per_minute": 0.2,
+                        ...
+                    },
+                    ...
+                },
+                "window": 60
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+        :query window: number of minutes to summarize (default: 60)
+
+        :>header Content-Type: application/json
+        :>json object metrics: metrics keyed by job type (the name of the job's
+            function)
+        :>json int metrics[type]["failed"]: number of jobs that failed
+        :>json int metrics[type]["finished"]: number of jobs that finished
+        :>json float metrics[type]["jobs_per_minute"]: jobs completed per
+            minute (finished or failed)
+        :>json float metrics[type]["items_per_second"]: items processed per
+            second of run time (only for jobs that report progress)
+        :>json object metrics[type][metric]: a summary of one measurement,
+            where ``metric`` is ``queue_wait``, ``run_time``, ``http_time``,
+            ``db_time``, ``solr_time`` (all in seconds), or ``items``
+        :>json int metrics[type][metric]["count"]: number of measurements
+        :>json float metrics[type][metric]["mean"]: mean value
+        :>json float metrics[type][metric]["p50"]: estimated median
+        :>json float metrics[type][metric]["p95"]: estimated 95th percentile
+        :>json float metrics[type][metric]["p99"]: estimated 99th percentile
+        :>json float metrics[type][metric]["sum"]: sum of all values
+        :>json int window: number of minutes summarized
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        '''
+
+        retention = g.config.getint('job_metrics', 'retention')
+        window = get_int_arg('window', request.args.get('window', 60))
+
+        if window < 1 or window > retention:
+            raise BadRequest('`window` must be between 1 and {}.'
+                             .format(retention))
 
-                job = queue.fetch_job(id_)
-
-                if job is not None:
-                    if 'current' in job.meta:
-                        return jsonify(
-                            current=job.meta['current'],
-                            description=job.meta['description'],
-                            id=job.id,
-                            progress=job.meta['current']  / job.meta['total'],
-                            total=job.meta['total'],
-                            type=job.meta['type'] if 'type' in job.meta else None
-                        )
-                    else:
-                        return jsonify(
-                            description=job.meta['description'],
-                            id=job.id,
-                            type=job.meta['type'] if 'type' in job.meta else None
-                        )
-
-        raise NotFound('No job exists with that ID.')
+        metrics = app.job_metrics.summarize(g.redis, window)
+
+        return jsonify(metrics=metrics, window=window)
 
     @route('queues')
     def queues(self):
@@ -255,6 +348,54 @@ class TasksView(FlaskView):
 
         return jsonify(queues=queues)
 
+    @route('/failed/requeue', methods=['POST'])
+    def requeue_failed(self):
+        '''
+        Put several failed tasks back on their original queues.
+
+        Tasks are selected in the same way as for ``POST
+        /api/tasks/failed/delete``.
+
+        **Example Request**
+
+        .. sourcecode:: json
+
+            {
+                "ids": ["dea6bd20-4f8e-44d2-bee1-b5db78eb4cc8"]
+            }
+
+        :<header Content-Type: application/json
+        :<header X-Auth: the client's auth token
+        :<json list ids: IDs of tasks to requeue (optional)
+        :<json str type: requeue failed tasks of this type (optional)
+        :<json int profile_id: requeue failed tasks for this profile (optional)
+        :<json bool all: requeue all failed tasks (optional)
+
+        :>header Content-Type: application/json
+        :>json int count: the number of tasks requeued
+
+        :status 200: ok
+        :status 400: invalid argument[s]
+        :status 401: authentication required
+        '''
+
+        job_ids = self._get_selected_ids()
+        count = 0
+
+        with rq.Connection(g.redis):
+            failed_queue = rq.get_failed_queue()
+
+            for job_id in job_ids:
+                try:
+                    failed_queue.requeue(job_id)
+                    count += 1
+                except (InvalidJobOperationError, NoSuchJobError):
+                    pass
+
+        app.failed_tasks.remove(g.redis, job_ids)
+
+        return jsonify(count=count)
+
     @route('workers')
     def workers(self):
         '''
@@ -384,3 +525,113 @@ class TasksView(FlaskView):
                 })
 
         return jsonify(workers=workers)
+
+    def _delete_all_failed_tasks(self):
+        ''' Delete all failed tasks and return the number deleted. '''
+
+        count = rq.get_failed_queue(connection=g.redis).empty()
+        app.failed_tasks.clear(g.redis)
+
+        return count
+
+    def _delete_failed_tasks(self, job_ids):
+        ''' Delete failed tasks and return the number deleted. '''
+
+        # Each LREM scans the failed queue, so send them all in one round trip
+        # and then delete only the jobs that were actually on the queue.
+        failed_queue = rq.get_failed_queue(connection=g.redis)
+        pipeline = g.redis.pipeline()
+
+        for job_id in job_ids:
+            pipeline.lrem(failed_queue.key, 1, job_id)
+
+        removed = [job_id for job_id, count in zip(job_ids, pipeline.execute())
+                   if count > 0]
+
+        if len(removed) > 0:
+            g.redis.delete(*[Job.key_for(job_id) for job_id in removed])
+
+        app.failed_tasks.remove(g.redis, job_ids)
+
+        return len(removed)
+
+    def _failed_task_json(self, failed_task):
+        ''' Convert a failed task to a JSON-serializable dictionary. '''
+
+        if 'description' in failed_task.meta:
+            desc = failed_task.meta['description']
+        else:
+            desc = None
+
+        if 'profile_id' in failed_task.meta:
+            profile_id = failed_task.meta['profile_id']
+        else:
+            profile_id = None
+
+        if 'type' in failed_task.meta:
+            type_ = failed_task.meta['type']
+        else:
+            type_ = None
+
+        exception_info = failed_task.exc_info
+        if exception_info is not None:
+            try:
+                exception_info = exception_info.decode()
+            except AttributeError:
+                exception_info = exception_info
+        else:
+            exception_info = 'Unknown error'
+
+        try:
+            function = failed_task.get_call_string()
+        except UnpickleError:
+            desc = 'Error: this job cannot be unpickled.'
+            function = None
+
+        return {
+            'description': desc,
+            'function': function,
+            'exception': exception_info,
+            'id': failed_task.id,
+            'profile_id': profile_id,
+            'type': type_,
+            'original_queue': failed_task.origin,
+        }
+
+    def _get_selected_ids(self, allow_all=False):
+        '''
+        Get the IDs of the failed tasks selected by a bulk action request.
+
+        If ``allow_all`` is True and the request selects all tasks, returns
+        None instead of listing them. Raises 400 BAD REQUEST if the request
+        does not select any tasks.
+        '''
+
+        request_json = request.get_json()
+
+        if request_json is None:
+            raise BadRequest('This request requires JSON data.')
+
+        if 'ids' in request_json:
+            if not isinstance(request_json['ids'], list):
+                raise BadRequest('`ids` must be a list.')
+
+            return [str(id_) for id_ in request_json['ids']]
+
+        type_ = request_json.get('type')
+        profile_id = get_int_arg('profile_id', request_json.get('profile_id'),
+                                 optional=True)
+
+        if type_ is None and profile_id is None and \
+           request_json.get('all') is not True:
+            raise BadRequest('Select tasks with `ids`, `type`, `profile_id`,'
+                             ' or `all`.')
+
+        if allow_all and type_ is None and profile_id is None:
+            return None
+
+        app.failed_tasks.reconcile(g.redis)
+        job_ids, _ = app.failed_tasks.query(g.redis, type_, profile_id,
+                                            limit=None)
+
+        return job_ids
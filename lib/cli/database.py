@@ -12,6 +12,7 @@ from sqlalchemy.schema import DropConstraint, DropTable, ForeignKeyConstraint, \
 
 from app.config import get_path
 import app.database
+import app.queue
 import cli
 from model import Avatar, Base, Configuration, File, Post, Profile, \
                   ProfileUsername, User
@@ -328,6 +329,11 @@ class DatabaseCli(cli.BaseCli):
             self._logger.info('Creating fixture data.')
             self._create_fixtures(config)
 
+            self._logger.info('Creating job queues.')
+            redis = app.database.get_redis(dict(config.items('redis')))
+            app.queue.remove_unused_queues(redis)
+            app.queue.init_queues(redis)
+
         if args.action == 'build' and args.sample_data:
             self._logger.info('Creating sample data.')
             self._create_samples(config)
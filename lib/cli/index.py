@@ -156,9 +156,11 @@ class IndexCli(cli.BaseCli):
         except:
             raise cli.CliError('Unable to connect to solr: %s' % solr_url)
 
+        redis = app.database.get_redis(dict(config.items('redis')))
+
         if args.action in ('add', 'add-all'):
             database_config = dict(config.items('database'))
-            db = app.database.get_engine(database_config)
+            db = app.database.get_replica_engine(database_config)
             if args.stubs == 1:
                 profile_stubs = True
             else:
@@ -170,6 +172,7 @@ class IndexCli(cli.BaseCli):
                 self.add_models(db, solr, profile_stubs=profile_stubs)
 
             solr.optimize()
+            app.index.bump_generation(redis)
             self._logger.info("Added requested documents and optimized index.")
 
         elif args.action in ('delete', 'delete-all'):
@@ -179,6 +182,7 @@ class IndexCli(cli.BaseCli):
                 solr.delete_all()
 
             solr.optimize()
+            app.index.bump_generation(redis)
             self._logger.info("Deleted requested documents and optimized "
                               "index.")
 
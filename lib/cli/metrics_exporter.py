@@ -0,0 +1,158 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from rq import Queue, Worker
+
+import app.database
+import app.job_metrics
+import app.metrics
+import app.queue
+import cli
+
+
+class MetricsExporterCli(cli.BaseCli):
+    '''
+    Export metrics about queues and background jobs for Prometheus.
+
+    Work horses are short-lived, so jobs record their measurements in Redis
+    (see `app.job_metrics`) and this exporter reads them from there. Run one
+    exporter per deployment, not one per worker host: every exporter reports
+    the same, deployment-wide values.
+
+    Metrics include:
+
+     * quickpin_queue_depth: jobs waiting in each queue, including "failed"
+     * quickpin_workers: workers by state
+     * quickpin_jobs_total: jobs by type and status
+     * quickpin_job_<measurement>: histograms of queue wait, run time, HTTP,
+       database and Solr time (seconds), and items processed, by job type
+     * quickpin_job_http_requests_total: HTTP requests made by jobs (e.g.
+       calls to the Twitter and Instagram APIs), by host and status
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--ip',
+            default='127.0.0.1',
+            help='Specify an IP address to bind to. (Defaults to loopback.)'
+        )
+
+        arg_parser.add_argument(
+            '--port',
+            type=int,
+            default=9101,
+            help='Specify a port to listen on. (Defaults to 9101.)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        redis = app.database.get_redis(dict(config.items('redis')))
+        logger = self._logger
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = app.metrics.render(_collect(redis)).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', app.metrics.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        server = HTTPServer((args.ip, args.port), Handler)
+        self._logger.info('Listening on http://%s:%d/metrics', args.ip,
+                          args.port)
+        server.serve_forever()
+
+
+def _collect(redis):
+    ''' Read worker metrics from Redis. '''
+
+    queue_names = app.queue.QUEUE_NAMES + ('failed',)
+    queue_depths = [({'queue': name}, Queue(name, connection=redis).count)
+                    for name in queue_names]
+
+    worker_states = {}
+
+    for worker in Worker.all(connection=redis):
+        state = worker.get_state()
+
+        if isinstance(state, bytes):
+            state = state.decode()
+
+        worker_states[state] = worker_states.get(state, 0) + 1
+
+    families = [
+        app.metrics.gauge_family('quickpin_queue_depth',
+                                 'Jobs waiting in each queue.',
+                                 queue_depths),
+        app.metrics.gauge_family('quickpin_workers',
+                                 'Workers by state.',
+                                 [({'state': state}, count)
+                                  for state, count in
+                                  sorted(worker_states.items())]),
+    ]
+
+    job_totals = app.job_metrics.totals(redis)
+    families.append(app.metrics.counter_family(
+        'quickpin_jobs',
+        'Jobs completed, by type and status.',
+        [({'type': job_type, 'status': status},
+          fields.get('jobs:{}'.format(status), 0))
+         for job_type, fields in job_totals.items()
+         for status in ('finished', 'failed')]
+    ))
+
+    for metric in app.job_metrics.METRICS:
+        unit = '' if metric == 'items' else '_seconds'
+        name = 'quickpin_job_{}{}'.format(metric, unit)
+        samples = []
+
+        for job_type, fields in job_totals.items():
+            count = fields.get('{}:count'.format(metric), 0)
+
+            if count == 0:
+                continue
+
+            labels = {'type': job_type}
+            cumulative = 0
+
+            for bound in app.job_metrics.BUCKETS:
+                cumulative += fields.get('{}:{}'.format(metric, bound), 0)
+                samples.append(('_bucket', dict(labels, le=str(bound)),
+                                cumulative))
+
+            samples.append(('_bucket', dict(labels, le='+Inf'), count))
+            samples.append(('_count', labels, count))
+            samples.append(('_sum', labels,
+                            fields['{}:sum'.format(metric)]))
+
+        families.append(app.metrics.MetricFamily(
+            name,
+            'histogram',
+            'Job {} by type.'.format(metric.replace('_', ' ')),
+            samples
+        ))
+
+    http_requests = []
+
+    for field, count in redis.hgetall(app.job_metrics.HTTP_REQUESTS_KEY) \
+                             .items():
+        host, _, status = field.decode('utf8').rpartition(' ')
+        http_requests.append(({'host': host, 'status': status}, int(count)))
+
+    families.append(app.metrics.counter_family(
+        'quickpin_job_http_requests',
+        'HTTP requests made by jobs, by host and status.',
+        sorted(http_requests, key=lambda sample: sorted(sample[0].items()))
+    ))
+
+    return families
@@ -0,0 +1,34 @@
+import app.database
+import app.queue
+import cli
+
+
+class QueuesCli(cli.BaseCli):
+    '''
+    A tool for provisioning the job queues.
+
+    Run this after installing or upgrading the application. (The application
+    and the workers do not provision queues when they start.)
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            'action',
+            choices=('init',),
+            help='Specify what action to take.'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        redis = app.database.get_redis(dict(config.items('redis')))
+
+        if args.action == 'init':
+            self._logger.info('Removing unused queues.')
+            app.queue.remove_unused_queues(redis)
+
+            self._logger.info('Creating queues: %s',
+                              ', '.join(app.queue.QUEUE_NAMES))
+            app.queue.init_queues(redis)
@@ -1,9 +1,14 @@
-import sys
+import multiprocessing
+import os
+import signal
+import threading
+import time
 
-from rq import Queue, Connection, Worker
+from rq import Queue, Connection
 
 import cli
 import worker
+from worker.warm import WarmWorker
 
 
 class RunWorkerCli(cli.BaseCli):
@@ -11,17 +16,56 @@ class RunWorkerCli(cli.BaseCli):
     A wrapper for RQ workers.
 
     Wrapping RQ is the only way to generate notifications when a job fails.
+
+    By default, this runs a single worker for the given queues. With
+    --concurrency or --allot, it supervises several worker processes instead:
+    crashed workers are restarted, and on SIGTERM or SIGINT every worker is
+    asked to finish its current job before exiting. (A second signal stops
+    workers immediately.)
+
+    With --warm, workers run jobs in their own process instead of forking a
+    new process for each job, so connections are reused between jobs.
     '''
 
+    # A worker that exits sooner than this after starting is restarted after
+    # a delay, so that a persistent failure doesn't cause a tight loop.
+    MIN_UPTIME = 5
+
+    # How often (seconds) supervised workers check that the supervisor is
+    # still running.
+    SUPERVISOR_POLL_INTERVAL = 2
+
     def _get_args(self, arg_parser):
         ''' Customize arguments. '''
 
         arg_parser.add_argument(
             'queues',
-            nargs='+',
+            nargs='*',
             help='Names of queues for this worker to service.'
         )
 
+        arg_parser.add_argument(
+            '--concurrency',
+            type=int,
+            metavar='N',
+            help='Run <N> worker processes, each servicing all of the given'
+                 ' queues.'
+        )
+
+        arg_parser.add_argument(
+            '--allot',
+            metavar='QUEUE=N,...',
+            help='Run a number of worker processes dedicated to each queue,'
+                 ' e.g. "scrape=8,index=2".'
+        )
+
+        arg_parser.add_argument(
+            '--warm',
+            action='store_true',
+            help='Run jobs in long-lived worker processes instead of forking'
+                 ' a process per job.'
+        )
+
     def _run(self, args, config):
         '''
         Main entry point.
@@ -29,7 +73,156 @@ class RunWorkerCli(cli.BaseCli):
         Adapted from http://python-rq.org/docs/workers/.
         '''
 
-        with Connection():
-            queues = map(Queue, args.queues)
-            w = Worker(queues, exc_handler=worker.handle_exception)
-            w.work()
+        allotments = self._get_allotments(args)
+
+        if allotments is None:
+            _work(args.queues, args.warm)
+        else:
+            self._supervise(allotments, args.warm)
+
+    def _get_allotments(self, args):
+        '''
+        Return a list of queue lists, one per worker process.
+
+        Returns None if a single worker should run in this process.
+        '''
+
+        if args.allot is not None:
+            if args.concurrency is not None or len(args.queues) > 0:
+                raise cli.CliError('--allot cannot be combined with queue'
+                                   ' names or --concurrency.')
+
+            allotments = []
+
+            for item in args.allot.split(','):
+                try:
+                    queue, count = item.split('=')
+                    count = int(count)
+                except ValueError:
+                    raise cli.CliError('Invalid allotment: "{}"'.format(item))
+
+                allotments.extend([[queue.strip()]] * count)
+
+            return allotments
+
+        if len(args.queues) == 0:
+            raise cli.CliError('At least one queue name is required.')
+
+        if args.concurrency is None:
+            return None
+
+        if args.concurrency < 1:
+            raise cli.CliError('--concurrency must be at least 1.')
+
+        return [args.queues] * args.concurrency
+
+    def _start_child(self, queues, warm):
+        ''' Start a worker process. '''
+
+        process = multiprocessing.Process(
+            target=_work,
+            args=(queues, warm, os.getpid()),
+            name='worker-{}'.format(','.join(queues))
+        )
+        process.start()
+        self._logger.info('Started worker %d for queues: %s', process.pid,
+                          ', '.join(queues))
+
+        return process
+
+    def _supervise(self, allotments, warm):
+        ''' Start and monitor a worker process for each allotment. '''
+
+        children = [None] * len(allotments)
+        started = [0] * len(allotments)
+        signals = []
+
+        def handle_signal(signum, frame):
+            signals.append(signum)
+
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+        for index, queues in enumerate(allotments):
+            children[index] = self._start_child(queues, warm)
+            started[index] = time.monotonic()
+
+        while len(signals) == 0:
+            time.sleep(1)
+
+            for index, child in enumerate(children):
+                if child.is_alive() or len(signals) > 0:
+                    continue
+
+                uptime = time.monotonic() - started[index]
+                self._logger.error('Worker %d exited with code %s after %.0f'
+                                   ' seconds.', child.pid, child.exitcode,
+                                   uptime)
+
+                if uptime < RunWorkerCli.MIN_UPTIME:
+                    time.sleep(RunWorkerCli.MIN_UPTIME)
+
+                children[index] = self._start_child(allotments[index], warm)
+                started[index] = time.monotonic()
+
+        # Warm shutdown: RQ workers finish their current job on the first
+        # SIGTERM, and stop immediately on the second.
+        self._logger.info('Waiting for workers to finish their current jobs.')
+        forwarded = 0
+
+        while any(child.is_alive() for child in children):
+            while forwarded < len(signals):
+                for child in children:
+                    if child.is_alive():
+                        child.terminate()
+
+                forwarded += 1
+
+            time.sleep(0.5)
+
+        self._logger.info('All workers have exited.')
+
+
+def _stop_with_supervisor(supervisor_pid):
+    '''
+    Ask this worker to stop (warm shutdown) when the supervisor exits.
+
+    Workers leave the supervisor's process group, so once the supervisor is
+    gone, neither the terminal nor a process manager that signals the group
+    can reach them. Without this, they would keep running next to the workers
+    of a restarted supervisor.
+    '''
+
+    def watch():
+        while os.getppid() == supervisor_pid:
+            time.sleep(RunWorkerCli.SUPERVISOR_POLL_INTERVAL)
+
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    thread = threading.Thread(target=watch, name='supervisor-watch')
+    thread.daemon = True
+    thread.start()
+
+
+def _work(queues, warm=False, supervisor_pid=None):
+    '''
+    Run a worker for the given queues until it is told to stop.
+
+    ``supervisor_pid`` is the PID of the supervising process, if any.
+    '''
+
+    if supervisor_pid is not None:
+        # Leave the terminal's process group, so that Ctrl+C reaches only the
+        # supervisor, which then stops workers exactly once. Then let RQ
+        # install its own signal handlers in this process.
+        os.setpgrp()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        _stop_with_supervisor(supervisor_pid)
+
+    worker_class = WarmWorker if warm else worker.InstrumentedWorker
+
+    with Connection():
+        w = worker_class(list(map(Queue, queues)),
+                         exc_handler=worker.handle_exception)
+        w.work()
@@ -0,0 +1,57 @@
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import app
+import cli
+
+
+class ServeCli(cli.BaseCli):
+    '''
+    Run a production server based on gevent.
+
+    Each request is handled by a greenlet instead of an OS thread, so
+    long-lived notification streams are cheap: one process can hold thousands
+    of them open. This script must be started through bin/serve.py, which
+    patches the standard library before anything else is imported.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--ip',
+            default='127.0.0.1',
+            help='Specify an IP address to bind to. (Defaults to loopback.)'
+        )
+
+        arg_parser.add_argument(
+            '--port',
+            type=int,
+            default=5001,
+            help='Specify a port to listen on. (Defaults to 5001.)'
+        )
+
+        arg_parser.add_argument(
+            '--max-connections',
+            type=int,
+            default=10000,
+            metavar='N',
+            help='Maximum number of concurrent connections. (Defaults to'
+                 ' 10000.)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        flask_app = app.bootstrap()
+
+        server = WSGIServer(
+            (args.ip, args.port),
+            flask_app,
+            spawn=Pool(args.max_connections),
+            log=None,
+            error_log=flask_app.logger
+        )
+
+        self._logger.info('Listening on http://%s:%d/', args.ip, args.port)
+        server.serve_forever()
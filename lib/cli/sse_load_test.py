@@ -0,0 +1,229 @@
+import json
+import socket
+import ssl
+import time
+from urllib.parse import urlencode, urlparse
+
+import gevent
+from gevent.pool import Pool
+
+import app.database
+import app.notify
+import cli
+
+
+class SseLoadTestCli(cli.BaseCli):
+    '''
+    Open many concurrent notification streams and report how they behave.
+
+    Each stream is a greenlet with its own socket, so one process can hold
+    thousands of streams open. Raise the open file limit (ulimit -n) on both
+    the client and the server before testing with more than ~1,000 streams.
+
+    With --publish-interval, the script also publishes a test event on the
+    "worker" channel at the given interval and reports how long each event
+    takes to reach the streams. Clients that are logged in to the server being
+    tested will receive those events, too.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            'url',
+            help='Base URL of the server, e.g. http://127.0.0.1:5001'
+        )
+
+        arg_parser.add_argument(
+            'token',
+            help='An auth token (see POST /api/authentication/).'
+        )
+
+        arg_parser.add_argument(
+            '--streams',
+            type=int,
+            default=2000,
+            metavar='N',
+            help='Number of concurrent streams to open. (Defaults to 2000.)'
+        )
+
+        arg_parser.add_argument(
+            '--duration',
+            type=float,
+            default=60,
+            metavar='S',
+            help='Number of seconds to hold streams open. (Defaults to 60.)'
+        )
+
+        arg_parser.add_argument(
+            '--ramp',
+            type=float,
+            default=10,
+            metavar='S',
+            help='Spread stream connections over this many seconds.'
+                 ' (Defaults to 10.)'
+        )
+
+        arg_parser.add_argument(
+            '--publish-interval',
+            type=float,
+            default=0,
+            metavar='S',
+            help='Publish a test event every <S> seconds. (Defaults to 0,'
+                 ' which disables publishing.)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        self._stats = {
+            'connected': 0,
+            'open': 0,
+            'failed': 0,
+            'events': 0,
+            'latencies': [],
+        }
+
+        url = urlparse(args.url)
+        query = {'xauth': args.token}
+
+        if args.publish_interval > 0:
+            query['channels'] = 'worker'
+            query['job_ids'] = 'load-test'
+
+        path = '/api/notification/?' + urlencode(query)
+        delay = args.ramp / args.streams if args.streams > 0 else 0
+        deadline = time.time() + args.ramp + args.duration
+        pool = Pool(args.streams)
+
+        self._logger.info('Opening %d streams to %s over %.1f seconds.',
+                          args.streams, args.url, args.ramp)
+
+        for _ in range(args.streams):
+            pool.spawn(self._stream, url, path, deadline)
+            gevent.sleep(delay)
+
+        greenlets = [gevent.spawn(self._report, deadline)]
+
+        if args.publish_interval > 0:
+            redis = app.database.get_redis(dict(config.items('redis')))
+            greenlets.append(gevent.spawn(self._publish, redis,
+                                          args.publish_interval, deadline))
+
+        pool.join()
+        gevent.killall(greenlets)
+        self._print_summary(args)
+
+    def _connect(self, url):
+        ''' Open a socket to the server. '''
+
+        if url.scheme == 'https':
+            port = url.port or 443
+            sock = socket.create_connection((url.hostname, port))
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return context.wrap_socket(sock, server_hostname=url.hostname)
+        else:
+            port = url.port or 80
+            return socket.create_connection((url.hostname, port))
+
+    def _print_summary(self, args):
+        ''' Print the final results. '''
+
+        latencies = sorted(self._stats['latencies'])
+
+        print('Streams requested: {}'.format(args.streams))
+        print('Streams connected: {}'.format(self._stats['connected']))
+        print('Streams failed:    {}'.format(self._stats['failed']))
+        print('Events received:   {}'.format(self._stats['events']))
+
+        if len(latencies) > 0:
+            def percentile(p):
+                return latencies[min(len(latencies) - 1,
+                                     int(len(latencies) * p))]
+
+            print('Delivery latency:  p50={:.3f}s p95={:.3f}s p99={:.3f}s '
+                  'max={:.3f}s'.format(percentile(0.5), percentile(0.95),
+                                       percentile(0.99), latencies[-1]))
+
+    def _publish(self, redis, interval, deadline):
+        ''' Publish test events until the deadline. '''
+
+        sequence = 0
+
+        while time.time() < deadline:
+            sequence += 1
+            app.notify.publish(redis, 'worker', json.dumps({
+                'id': 'load-test',
+                'status': 'load_test',
+                'sequence': sequence,
+                'sent': time.time(),
+            }))
+            gevent.sleep(interval)
+
+    def _report(self, deadline):
+        ''' Log progress periodically. '''
+
+        while time.time() < deadline:
+            gevent.sleep(5)
+            self._logger.info('open=%d failed=%d events=%d',
+                              self._stats['open'], self._stats['failed'],
+                              self._stats['events'])
+
+    def _stream(self, url, path, deadline):
+        ''' Hold one stream open until the deadline, counting its events. '''
+
+        try:
+            sock = self._connect(url)
+        except OSError as e:
+            self._logger.debug('Connection failed: %s', e)
+            self._stats['failed'] += 1
+            return
+
+        try:
+            request = 'GET {} HTTP/1.1\r\n' \
+                      'Host: {}\r\n' \
+                      'Accept: text/event-stream\r\n' \
+                      'Connection: keep-alive\r\n\r\n' \
+                      .format(path, url.netloc)
+            sock.sendall(request.encode('ascii'))
+            sock.settimeout(max(1, deadline - time.time()))
+            reader = sock.makefile('rb')
+            status = reader.readline().decode('ascii', 'replace')
+
+            if ' 200 ' not in status:
+                self._logger.debug('Unexpected response: %s', status.strip())
+                self._stats['failed'] += 1
+                return
+
+            self._stats['connected'] += 1
+            self._stats['open'] += 1
+
+            try:
+                while time.time() < deadline:
+                    line = reader.readline()
+
+                    if line == b'':
+                        break
+
+                    if line.startswith(b'data: '):
+                        self._stats['events'] += 1
+                        self._record_latency(line[6:])
+            finally:
+                self._stats['open'] -= 1
+        except (OSError, socket.timeout):
+            pass
+        finally:
+            sock.close()
+
+    def _record_latency(self, data):
+        ''' Record the delivery latency of a test event. '''
+
+        try:
+            payload = json.loads(data.decode('utf8'))
+        except ValueError:
+            return
+
+        if isinstance(payload, dict) and payload.get('id') == 'load-test':
+            self._stats['latencies'].append(time.time() - payload['sent'])
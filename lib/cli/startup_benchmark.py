@@ -0,0 +1,128 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from app.config import get_path
+import cli
+
+
+# Each target is the code that a fresh process runs before it can do any work.
+TARGETS = {
+    'app': 'import app; app.bootstrap()',
+    'worker': 'import worker, worker.index, worker.scrape',
+}
+
+
+class StartupBenchmarkCli(cli.BaseCli):
+    '''
+    Measure cold start time for the application and for a worker.
+
+    Each sample runs a fresh Python interpreter, so the results include
+    interpreter startup and all imports, just like a new WSGI process or a
+    new worker process.
+    '''
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            'targets',
+            nargs='*',
+            default=sorted(TARGETS.keys()),
+            help='What to start: {}. (Defaults to all.)'
+                 .format(', '.join(sorted(TARGETS.keys())))
+        )
+
+        arg_parser.add_argument(
+            '--samples',
+            type=int,
+            default=10,
+            metavar='N',
+            help='Number of times to start each target. (Defaults to 10.)'
+        )
+
+        arg_parser.add_argument(
+            '--imports',
+            type=int,
+            default=0,
+            metavar='N',
+            help='Also list the <N> slowest imports for each target.'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        for target in args.targets:
+            if target not in TARGETS:
+                raise cli.CliError('Invalid target: "{}"'.format(target))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = get_path('lib')
+
+        for target in args.targets:
+            samples = []
+
+            for _ in range(args.samples):
+                samples.append(self._time_start(TARGETS[target], env))
+
+            print('{}: median={:.3f}s min={:.3f}s max={:.3f}s (n={})'.format(
+                target,
+                statistics.median(samples),
+                min(samples),
+                max(samples),
+                len(samples)
+            ))
+
+            if args.imports > 0:
+                for seconds, module in self._slowest_imports(TARGETS[target],
+                                                             env,
+                                                             args.imports):
+                    print('    {:8.3f}s  {}'.format(seconds, module))
+
+    def _slowest_imports(self, code, env, count):
+        '''
+        Return a list of (cumulative seconds, module) for the slowest imports.
+        '''
+
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+
+        imports = []
+
+        for line in process.stderr.decode('utf8').splitlines():
+            if not line.startswith('import time:'):
+                continue
+
+            try:
+                _, cumulative, module = line[12:].split('|')
+                imports.append((int(cumulative) / 1e6, module.rstrip()))
+            except ValueError:
+                # The header line.
+                continue
+
+        imports.sort(reverse=True)
+        return imports[:count]
+
+    def _time_start(self, code, env):
+        ''' Run ``code`` in a new interpreter and return the elapsed time. '''
+
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-c', code],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        elapsed = time.perf_counter() - start
+
+        if process.returncode != 0:
+            raise cli.CliError('Startup failed:\n{}'.format(
+                process.stderr.decode('utf8')))
+
+        return elapsed
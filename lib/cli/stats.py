@@ -1,7 +1,10 @@
 import logging
 import sys
 
-from app.database import get_engine, get_session, query_chunks
+from sqlalchemy import bindparam
+
+from app.database import get_engine, get_replica_engine, get_session, \
+                         query_chunks
 import cli
 from model import Avatar, Profile
 from model.profile import avatar_join_profile
@@ -20,9 +23,16 @@ class StatsCli(cli.BaseCli):
         self._site = None
         super().__init__(*args, **kwargs)
 
-    def profile_stats(self, session):
+    def profile_stats(self, read_session, write_session):
+        '''
+        Cache each profile's current avatar.
+
+        Profiles are read from ``read_session``, which may be a replica, and
+        updated through ``write_session``.
+        '''
+
         current_avatar_id = (
-            session
+            read_session
             .query(Avatar.id)
             .join(avatar_join_profile,
                   avatar_join_profile.c.avatar_id == Avatar.id)
@@ -34,13 +44,20 @@ class StatsCli(cli.BaseCli):
         )
 
         profile_query = (
-            session
-            .query(Profile, Avatar)
-            .outerjoin(Avatar, Avatar.id == current_avatar_id)
+            read_session
+            .query(Profile.id, current_avatar_id.label('avatar_id'))
             .order_by(Profile.id)
         )
 
-        total_count = session.query(Profile).count()
+        profile_table = Profile.__table__
+        update = (
+            profile_table
+            .update()
+            .where(profile_table.c.id == bindparam('profile_id'))
+            .values(current_avatar_id=bindparam('avatar_id'))
+        )
+
+        total_count = read_session.query(Profile).count()
         progress = 0
         msg = 'Calculating stats for {} profiles.'
         self._logger.info(msg.format(total_count))
@@ -51,17 +68,18 @@ class StatsCli(cli.BaseCli):
             pbar = None
 
         for chunk in query_chunks(profile_query, Profile.id):
-            for row in chunk:
-                profile, avatar = row
-                profile.current_avatar = avatar
+            write_session.execute(update, [
+                {'profile_id': row.id, 'avatar_id': row.avatar_id}
+                for row in chunk
+            ])
 
             progress += len(chunk)
-            session.commit()
+            write_session.commit()
 
             if pbar is not None:
                 pbar.update(progress)
 
-        session.commit()
+        write_session.commit()
 
         if pbar is not None:
             pbar.finish()
@@ -116,6 +134,7 @@ class StatsCli(cli.BaseCli):
         else:
             database_config = dict(config.items('database'))
             db = get_engine(database_config)
+            replica_db = get_replica_engine(database_config)
 
             if args.stats is None:
                 stats = self.all_stats.keys()
@@ -128,5 +147,6 @@ class StatsCli(cli.BaseCli):
                         raise cli.CliError(msg.format(stat))
 
             for stat in stats:
-                session = get_session(db)
-                self.all_stats[stat](session)
+                read_session = get_session(replica_db)
+                write_session = get_session(db)
+                self.all_stats[stat](read_session, write_session)
@@ -0,0 +1,84 @@
+import time
+
+from rq import Connection, Queue
+
+import app.database
+import cli
+import worker
+from worker.warm import WarmWorker
+
+
+class WorkerBenchmarkCli(cli.BaseCli):
+    '''
+    Measure how many small jobs per second a single worker can run.
+
+    Each job makes a trivial request to the database, Redis, and Solr, like
+    the smallest real jobs do. The same jobs are run by a forking worker (the
+    default) and by a warm worker (run-worker.py --warm).
+    '''
+
+    QUEUE_NAME = 'benchmark'
+
+    def _get_args(self, arg_parser):
+        ''' Customize arguments. '''
+
+        arg_parser.add_argument(
+            '--jobs',
+            type=int,
+            default=200,
+            metavar='N',
+            help='Number of jobs to run in each mode. (Defaults to 200.)'
+        )
+
+        arg_parser.add_argument(
+            '--mode',
+            choices=('both', 'forking', 'warm'),
+            default='both',
+            help='Which worker to benchmark. (Defaults to both.)'
+        )
+
+    def _run(self, args, config):
+        ''' Main entry point. '''
+
+        redis = app.database.get_redis(dict(config.items('redis')))
+
+        # The forking worker must run first: the warm worker initializes the
+        # connection caches in this process, which forked children would
+        # inherit.
+        modes = []
+
+        if args.mode in ('both', 'forking'):
+            modes.append(('forking', worker.InstrumentedWorker))
+
+        if args.mode in ('both', 'warm'):
+            modes.append(('warm', WarmWorker))
+
+        with Connection(redis):
+            queue = Queue(WorkerBenchmarkCli.QUEUE_NAME)
+
+            try:
+                for name, worker_class in modes:
+                    elapsed = self._time_jobs(queue, worker_class, args.jobs)
+                    print('{}: {} jobs in {:.2f}s ({:.1f} jobs/sec)'.format(
+                        name, args.jobs, elapsed, args.jobs / elapsed))
+            finally:
+                queue.empty()
+                redis.srem('rq:queues', queue.key)
+
+    def _time_jobs(self, queue, worker_class, count):
+        ''' Enqueue ``count`` jobs and time a worker running them. '''
+
+        queue.empty()
+
+        for _ in range(count):
+            queue.enqueue('worker.benchmark.touch_connections')
+
+        w = worker_class([queue], exc_handler=worker.handle_exception)
+        start = time.perf_counter()
+        w.work(burst=True)
+        elapsed = time.perf_counter() - start
+
+        if len(queue) > 0:
+            raise cli.CliError('The worker did not finish all jobs.')
+
+        return elapsed
@@ -4,24 +4,20 @@ module.
 
 When this is done, you can do something like 'from model import Codename'
 instead of 'from model.codename import Codename'.
-'''
 
-import importlib
-import inspect
-import os
-import sys
+Models are imported explicitly (rather than discovered by listing this
+directory) so that importing this package is fast and predictable. When you
+add a model, import it here too.
+'''
 
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
-for file_ in os.listdir(os.path.dirname(__file__)):
-    name, ext = os.path.splitext(file_)
-
-    if ext != '.py':
-        continue
-
-    package_module = importlib.import_module("%s.%s" % (__package__, name))
-    for name, member in inspect.getmembers(package_module, inspect.isclass):
-        if issubclass(member, Base) and member is not Base:
-            setattr(sys.modules[__name__], name, member)
+from model.avatar import Avatar
+from model.configuration import Configuration
+from model.file import File
+from model.label import Label
+from model.post import Post
+from model.profile import Profile, ProfileNote, ProfileUsername
+from model.user import User
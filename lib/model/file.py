@@ -1,6 +1,7 @@
 import base64
 import binascii
 import hashlib
+import mimetypes
 import os
 
 from sqlalchemy import Column, ForeignKey, Integer, String
@@ -57,10 +58,36 @@ class File(Base):
             file_.write(content)
             file_.close()
 
+    def hash_hex(self):
+        ''' Return the file's SHA-256 hash as a hex string. '''
+
+        return binascii.hexlify(self.hash).decode('ascii')
+
+    def hash_name(self):
+        '''
+        Return a name for the file that is derived from its content.
+
+        The name is the hex hash followed by an extension that matches the
+        file's MIME type (if known), e.g. "e3b0c442...b855.jpg". It is used for
+        content-addressed URLs, which can be served without looking up the
+        File record.
+        '''
+
+        extension = None
+
+        if self.mime is not None:
+            mime = self.mime.split(';')[0].strip()
+            extension = mimetypes.guess_extension(mime)
+
+        return self.hash_hex() + (extension or '')
+
     def relpath(self):
         ''' Return path to the file relative to the data directory. '''
 
-        data_dir = app.config.get_path('data')
-        hash_ = binascii.hexlify(self.hash).decode('ascii')
+        return relpath_from_hash(self.hash_hex())
+
+
+def relpath_from_hash(hash_hex):
+    ''' Return path to a file relative to the data directory, given its hash. '''
 
-        return os.path.join(hash_[0], hash_[1], hash_[2:])
+    return os.path.join(hash_hex[0], hash_hex[1], hash_hex[2:])
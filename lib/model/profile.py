@@ -159,11 +159,24 @@ class Profile(Base):
                 ProfileUsername(username, start_date=now, end_date=now)
             )
 
-    def as_dict(self):
-        ''' Return dictionary representation of this profile. '''
+    def as_dict(self, labels=None, notes=None):
+        '''
+        Return dictionary representation of this profile.
+
+        Listings can pass in ``labels`` and ``notes`` that were loaded for a
+        whole page of profiles at once; otherwise they are loaded from this
+        profile's relationships (one query each).
+        '''
+
+        if labels is None:
+            labels = self.labels
+
+        if notes is None:
+            notes = self.notes
+
         # Sort labels by name
-        labels = [label.as_dict() for label in self.labels]
-        notes = [note.as_dict() for note in self.notes]
+        labels = [label.as_dict() for label in labels]
+        notes = [note.as_dict() for note in notes]
         sorted_labels = sorted(labels, key=lambda x: x['name'])
         sorted_notes = sorted(notes, key=lambda x: x['created_at'], reverse=True)
         return {
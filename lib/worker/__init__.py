@@ -3,18 +3,80 @@ This package contains workers that handle work placed on the message queues.
 '''
 
 import json
+import logging
+import time
+from urllib.parse import urlparse
+import weakref
 
+import requests
 import rq
 import scorched
+from sqlalchemy import event
 
 import app.config
 import app.database
+import app.failed_tasks
+import app.job_metrics
+import app.notify
 
 
 _config = None
 _db = None
 _redis = None
 _solr = None
+_sessions = weakref.WeakSet()
+_timer = None
+
+
+class InstrumentedWorker(rq.Worker):
+    '''
+    An RQ worker that times every job for the job metrics and indexes failed
+    jobs.
+
+    Timing starts when the worker picks up a job, before the job function
+    runs, so that a job's setup counts towards its run time and jobs that fail
+    early are measured too.
+    '''
+
+    def perform_job(self, job):
+        ''' Run a job, recording its metrics. '''
+
+        global _timer
+
+        _timer = app.job_metrics.JobTimer(job.enqueued_at, _solr_time())
+        success = super().perform_job(job)
+
+        # Jobs normally record metrics in finish_job() or handle_exception(),
+        # and this does nothing for them.
+        if success:
+            _record_metrics(job, 'finished')
+
+        return success
+
+    def move_to_failed_queue(self, job, *exc_info):
+        '''
+        Move a failed job to the failed queue, then add it to the index.
+
+        Indexing first would let a concurrent reconciliation remove the job
+        from the index before it reaches the queue.
+        '''
+
+        super().move_to_failed_queue(job, *exc_info)
+        app.failed_tasks.add(self.connection, job)
+
+
+def close_sessions():
+    '''
+    Close all database sessions opened by get_session().
+
+    Warm workers call this after each job, so that sessions that a job did not
+    close do not hold connections while the process runs further jobs.
+    '''
+
+    for session in list(_sessions):
+        session.close()
+
+    _sessions.clear()
 
 
 def finish_job():
@@ -26,13 +88,16 @@ def finish_job():
         job.meta['current'] = job.meta['total']
         job.save()
 
+    _record_metrics(job, 'finished')
+
     notification = json.dumps({
         'id': job.id,
         'queue': job.origin,
+        'profile_id': job.meta.get('profile_id'),
         'status': 'finished'
     })
 
-    get_redis().publish('worker', notification)
+    app.notify.publish(get_redis(), 'worker', notification)
 
 
 def get_config():
@@ -54,6 +119,8 @@ def get_db():
     if _db is None:
         db_config = dict(get_config().items('database'))
         _db = app.database.get_engine(db_config)
+        event.listen(_db, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(_db, 'after_cursor_execute', _after_cursor_execute)
 
     return _db
 
@@ -79,7 +146,10 @@ def get_redis():
 def get_session():
     ''' Get a database session (a.k.a. transaction). '''
 
-    return app.database.get_session(get_db())
+    session = app.database.get_session(get_db())
+    _sessions.add(session)
+
+    return session
 
 
 def get_solr():
@@ -100,19 +170,35 @@ def handle_exception(job, exc_type, exc_value, traceback):
 
     Note `return True` at the end of this function: this tells RQ to continue
     handling this exception. We only register this exception handler so that
-    we can send a notification to the client.
+    we can send a notification to the client (and record job metrics). The
+    failed job is indexed by `InstrumentedWorker.move_to_failed_queue()`.
     '''
 
+    _record_metrics(job, 'failed')
+
     notification = json.dumps({
         'id': job.id,
         'status': 'failed',
         'queue': job.origin,
+        'profile_id': job.meta.get('profile_id'),
     })
 
-    get_redis().publish('worker', notification)
+    app.notify.publish(get_redis(), 'worker', notification)
     return True
 
 
+def http_get(url, **kwargs):
+    ''' Make an HTTP GET request, timing it for job metrics. '''
+
+    return _http_request('get', url, **kwargs)
+
+
+def http_post(url, **kwargs):
+    ''' Make an HTTP POST request, timing it for job metrics. '''
+
+    return _http_request('post', url, **kwargs)
+
+
 def init_job(job, description, profile_id=None, type_=None):
     ''' Initialize job metadata. '''
 
@@ -125,9 +211,10 @@ def init_job(job, description, profile_id=None, type_=None):
         'id': job.id,
         'status': 'queued',
         'queue': job.origin,
+        'profile_id': job.meta.get('profile_id'),
     })
 
-    get_redis().publish('worker', notification)
+    app.notify.publish(get_redis(), 'worker', notification)
 
 
 def start_job(total=None):
@@ -144,9 +231,10 @@ def start_job(total=None):
         'id': job.id,
         'status': 'started',
         'queue': job.origin,
+        'profile_id': job.meta.get('profile_id'),
     })
 
-    get_redis().publish('worker', notification)
+    app.notify.publish(get_redis(), 'worker', notification)
 
 
 def update_job(current):
@@ -167,6 +255,85 @@ def update_job(current):
         'current': current,
         'progress': current / job.meta['total'],
         'queue': job.origin,
+        'profile_id': job.meta.get('profile_id'),
     })
 
-    get_redis().publish('worker', notification)
+    app.notify.publish(get_redis(), 'worker', notification)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    ''' Add a query's duration to the current job's database time. '''
+
+    start = conn.info['query_start'].pop()
+
+    if _timer is not None:
+        _timer.db_time += time.perf_counter() - start
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    ''' Note when a query starts. '''
+
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _http_request(method, url, **kwargs):
+    '''
+    Make an HTTP request, adding its duration to the current job and counting
+    it in the job metrics.
+    '''
+
+    start = time.perf_counter()
+    status = 'error'
+
+    try:
+        response = requests.request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        if _timer is not None:
+            _timer.http_time += time.perf_counter() - start
+
+        try:
+            app.job_metrics.record_http_request(get_redis(),
+                                                urlparse(url).hostname,
+                                                status)
+        except Exception:
+            logging.getLogger('worker').exception('Could not count HTTP'
+                                                  ' request.')
+
+
+def _record_metrics(job, status):
+    '''
+    Record the current job's measurements in the job metrics histograms.
+
+    Only the first call for a job has any effect.
+    '''
+
+    global _timer
+
+    if _timer is None:
+        return
+
+    timer = _timer
+    _timer = None
+    job_type = job.func_name.rsplit('.', 1)[-1]
+    retention = get_config().getint('job_metrics', 'retention')
+    measurements = timer.measurements(_solr_time(), job.meta.get('current'))
+
+    try:
+        app.job_metrics.record(get_redis(), job_type, status, measurements,
+                               retention)
+    except Exception:
+        # Metrics must never cause a job to fail.
+        logging.getLogger('worker').exception('Could not record job metrics.')
+
+
+def _solr_time():
+    ''' Return the total time this process has spent on Solr requests. '''
+
+    if _solr is None:
+        return 0.0
+
+    return _solr.conn.http_connection.stats()['wall_time']
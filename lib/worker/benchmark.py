@@ -0,0 +1,19 @@
+'''
+Jobs used to benchmark workers.
+
+These jobs do almost no work, but they use the same connections as real jobs,
+so they measure the fixed cost of running a job.
+'''
+
+import worker
+
+
+def touch_connections():
+    ''' Run a trivial query against the database, Redis, and Solr. '''
+
+    session = worker.get_session()
+    session.execute('SELECT 1')
+    session.close()
+
+    worker.get_redis().ping()
+    worker.get_solr().query('*:*').paginate(rows=0).execute()
@@ -20,6 +20,7 @@ def index_posts(post_ids):
         solr.add(app.index.make_post_doc(post, author))
 
     solr.commit()
+    app.index.bump_generation(worker.get_redis())
     worker.finish_job()
 
 
@@ -33,6 +34,7 @@ def index_profile(profile_id):
     profile = session.query(Profile).filter(Profile.id == profile_id).one()
     solr.add(app.index.make_profile_doc(profile))
     solr.commit()
+    app.index.bump_generation(worker.get_redis())
     worker.finish_job()
 
 
@@ -45,6 +47,7 @@ def delete_profile(profile_id):
     query = solr.Q(solr.Q(type_s='Profile') & solr.Q(profile_id_i=profile_id))
     solr.delete_by_query(query=query)
     solr.commit()
+    app.index.bump_generation(worker.get_redis())
     worker.finish_job()
 
 
@@ -57,4 +60,5 @@ def delete_profile_posts(profile_id):
     query = solr.Q(solr.Q(type_s='Post') & solr.Q(profile_id_i=profile_id))
     solr.delete_by_query(query=query)
     solr.commit()
+    app.index.bump_generation(worker.get_redis())
     worker.finish_job()
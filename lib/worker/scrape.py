@@ -8,12 +8,14 @@ import os
 import sys
 from urllib.parse import urlparse
 
-import requests
 import requests.exceptions
 from sqlalchemy.exc import IntegrityError
 
 import app.database
+import app.etag
+import app.file_cache
 import app.index
+import app.notify
 import app.queue
 from model import Avatar, File, Post, Profile, Label
 from model.profile import profile_join_self
@@ -63,7 +65,7 @@ def scrape_avatar(id_, site, url):
     # Otherwise, scrape the new Avatar and append to the profile
     if avatar is None:
 
-        response = requests.get(url)
+        response = worker.http_get(url)
         response.raise_for_status()
 
         if 'content-type' in response.headers:
@@ -77,12 +79,16 @@ def scrape_avatar(id_, site, url):
         profile.current_avatar = avatar
 
     db_session.commit()
+    app.file_cache.warm(worker.get_config(), redis, avatar.file)
+    app.file_cache.warm(worker.get_config(), redis, avatar.thumb_file)
     worker.finish_job()
 
-    redis.publish('avatar', json.dumps({
+    app.etag.bump_profile_version(redis, id_)
+    app.etag.bump_summary_generation(redis)
+    app.notify.publish(redis, 'avatar', json.dumps({
         'id': id_,
-        'thumb_url': '/api/file/' + str(avatar.thumb_file.id),
-        'url': '/api/file/' + str(avatar.file.id),
+        'thumb_url': '/api/file/' + avatar.thumb_file.hash_name(),
+        'url': '/api/file/' + avatar.file.hash_name(),
     }))
 
 
@@ -104,7 +110,10 @@ def scrape_profile(site, usernames, stub=False, labels={}):
             raise ScrapeException('No scraper exists for site: {}'.format(site))
 
         for profile in profiles:
-            redis.publish('profile', json.dumps(profile))
+            app.etag.bump_profile_version(redis, profile['id'])
+            app.notify.publish(redis, 'profile', json.dumps(profile))
+
+        app.etag.bump_summary_generation(redis)
 
         worker.finish_job()
 
@@ -123,7 +132,7 @@ def scrape_profile(site, usernames, stub=False, labels={}):
                                .format(site, response.status_code)
 
         message_str = json.dumps(message)
-        redis.publish('profile', message_str)
+        app.notify.publish(redis, 'profile', message_str)
         sys.stderr.write('{}\n'.format(message_str))
         sys.stderr.write('{}\n'.format(response.text))
 
@@ -133,7 +142,7 @@ def scrape_profile(site, usernames, stub=False, labels={}):
             'site': site,
             'error': se.message,
         }
-        redis.publish('profile', json.dumps(message))
+        app.notify.publish(redis, 'profile', json.dumps(message))
 
     except:
         message = {
@@ -141,7 +150,7 @@ def scrape_profile(site, usernames, stub=False, labels={}):
             'site': site,
             'error': 'Unknown error while fetching profile.',
         }
-        redis.publish('profile', json.dumps(message))
+        app.notify.publish(redis, 'profile', json.dumps(message))
         raise
 
 
@@ -163,7 +172,10 @@ def scrape_profile_by_id(site, upstream_ids, stub=False, labels={}):
             raise ScrapeException('No scraper exists for site: {}'.format(site))
 
         for profile in profiles:
-            redis.publish('profile', json.dumps(profile))
+            app.etag.bump_profile_version(redis, profile['id'])
+            app.notify.publish(redis, 'profile', json.dumps(profile))
+
+        app.etag.bump_summary_generation(redis)
 
         worker.finish_job()
 
@@ -179,7 +191,7 @@ def scrape_profile_by_id(site, upstream_ids, stub=False, labels={}):
 
 
         message_str = json.dumps(message)
-        redis.publish('profile', message_str)
+        app.notify.publish(redis, 'profile', message_str)
         sys.stderr.write('{}\n'.format(message_str))
         sys.stderr.write('{}\n'.format(response.text))
 
@@ -189,7 +201,7 @@ def scrape_profile_by_id(site, upstream_ids, stub=False, labels={}):
             'site': site,
             'error': se.message,
         }
-        redis.publish('profile', json.dumps(message))
+        app.notify.publish(redis, 'profile', json.dumps(message))
 
     except:
         message = {
@@ -197,7 +209,7 @@ def scrape_profile_by_id(site, upstream_ids, stub=False, labels={}):
             'site': site,
             'error': 'Unknown error while fetching profile.',
         }
-        redis.publish('profile', json.dumps(message))
+        app.notify.publish(redis, 'profile', json.dumps(message))
         raise
 
 
@@ -212,7 +224,7 @@ def scrape_instagram_account(username, stub=False):
     api_url = 'https://api.instagram.com/v1/users/search'
     params = {'q': username}
 
-    response = requests.get(
+    response = worker.http_get(
         api_url,
         params=params,
         proxies=proxies,
@@ -236,7 +248,7 @@ def scrape_instagram_account(username, stub=False):
     # Now make another request to get this user's profile data.
     api_url = 'https://api.instagram.com/v1/users/{}'.format(user_id)
 
-    response = requests.get(
+    response = worker.http_get(
         api_url,
         proxies=proxies,
         verify=False
@@ -286,7 +298,7 @@ def scrape_instagram_account_by_id(upstream_id, stub=False):
     # Instagram API request.
     api_url = 'https://api.instagram.com/v1/users/{}'.format(upstream_id)
 
-    response = requests.get(
+    response = worker.http_get(
         api_url,
         proxies=proxies,
         verify=False
@@ -376,7 +388,7 @@ def scrape_instagram_posts(id_, recent):
 
     worker.start_job(total=max_results)
     while results < max_results:
-        response = requests.get(
+        response = worker.http_get(
             url,
             params=params,
             proxies=proxies,
@@ -418,7 +430,7 @@ def scrape_instagram_posts(id_, recent):
             if 'images' in gram:
                 image_url = gram['images']['standard_resolution']['url']
                 name = os.path.basename(urlparse(image_url).path)
-                img_response = requests.get(image_url, verify=False)
+                img_response = worker.http_get(image_url, verify=False)
                 mime = img_response.headers['Content-type']
                 image = img_response.content
                 post.attachments.append(File(name, mime, image))
@@ -439,7 +451,8 @@ def scrape_instagram_posts(id_, recent):
 
     db.commit()
     worker.finish_job()
-    redis.publish('profile_posts', json.dumps({'id': id_}))
+    app.etag.bump_profile_version(redis, id_)
+    app.notify.publish(redis, 'profile_posts', json.dumps({'id': id_}))
     app.queue.schedule_index_posts(post_ids)
 
 
@@ -466,6 +479,7 @@ def scrape_instagram_relations(id_):
     friends_params = {}
     followers_params = {}
     total_results = max_results*2
+    related_ids = set()
 
     if profile is None:
         raise ValueError('No profile exists with id={}'.format(id_))
@@ -498,7 +512,7 @@ def scrape_instagram_relations(id_):
 
     while friends_results < max_results:
         # Get friends from Instagram API
-        friends_response = requests.get(
+        friends_response = worker.http_get(
             friends_url,
             params=friends_params,
             proxies=proxies,
@@ -531,6 +545,7 @@ def scrape_instagram_relations(id_):
 
                 related_profile.name = friend['full_name']
                 profile.friends.append(related_profile)
+                related_ids.add(related_profile.id)
                 friends_results += 1
                 worker.update_job(current=friends_results)
 
@@ -550,7 +565,7 @@ def scrape_instagram_relations(id_):
     # Get followers from Instagram API
     while followers_results < max_results:
         # Get friends from Instagram API
-        followers_response = requests.get(
+        followers_response = worker.http_get(
             followers_url,
             params=followers_params,
             proxies=proxies,
@@ -583,6 +598,7 @@ def scrape_instagram_relations(id_):
 
                 related_profile.name = follower['full_name']
                 profile.followers.append(related_profile)
+                related_ids.add(related_profile.id)
                 followers_results += 1
                 worker.update_job(current=friends_results + followers_results)
 
@@ -596,7 +612,11 @@ def scrape_instagram_relations(id_):
             break # No more results
 
     worker.finish_job()
-    redis.publish('profile_relations', json.dumps({'id': id_}))
+
+    # Related profiles gained a relation and may have a new name.
+    related_ids.add(id_)
+    app.etag.bump_profile_versions(redis, related_ids)
+    app.notify.publish(redis, 'profile_relations', json.dumps({'id': id_}))
 
 
 def scrape_twitter_account(usernames, stub=False, labels=None):
@@ -619,7 +639,7 @@ def scrape_twitter_account(usernames, stub=False, labels=None):
     api_url = 'https://api.twitter.com/1.1/users/lookup.json'
     payload = {'screen_name': ','.join(usernames)}
     headers = {'ACCEPT-ENCODING': None}
-    response = requests.post(
+    response = worker.http_post(
         api_url,
         data=payload,
         proxies=_get_proxies(db_session),
@@ -688,7 +708,7 @@ def scrape_twitter_account_by_id(upstream_ids, stub=False, labels={}):
     api_url = 'https://api.twitter.com/1.1/users/lookup.json'
     payload = {'user_id': ','.join(upstream_ids)}
     headers = {'ACCEPT-ENCODING': None}
-    response = requests.post(
+    response = worker.http_post(
         api_url,
         data=payload,
         proxies=_get_proxies(db_session),
@@ -795,7 +815,7 @@ def scrape_twitter_posts(id_, recent):
             params['max_id'] = str(max_id)
 
     while more_results:
-        response = requests.get(
+        response = worker.http_get(
             url,
             params=params,
             proxies=proxies,
@@ -869,7 +889,8 @@ def scrape_twitter_posts(id_, recent):
 
     db.commit()
     worker.finish_job()
-    redis.publish('profile_posts', json.dumps({'id': id_}))
+    app.etag.bump_profile_version(redis, id_)
+    app.notify.publish(redis, 'profile_posts', json.dumps({'id': id_}))
     app.queue.schedule_index_posts(post_ids)
 
 
@@ -933,7 +954,7 @@ def scrape_twitter_relations(id_):
     params['cursor'] = friends_cursor
 
     while friends_results < max_results:
-        friends_response = requests.get(
+        friends_response = worker.http_get(
             friends_url,
             params=params,
             proxies=proxies,
@@ -962,7 +983,7 @@ def scrape_twitter_relations(id_):
     params['cursor'] = followers_cursor
 
     while followers_results < max_results:
-        followers_response = requests.get(
+        followers_response = worker.http_get(
             followers_url,
             params=params,
             proxies=proxies,
@@ -991,6 +1012,8 @@ def scrape_twitter_relations(id_):
     user_ids = [(uid, 'friend') for uid in friends_ids] + \
                [(uid, 'follower') for uid in followers_ids]
     worker.start_job(total=len(user_ids))
+    related_ids = set()
+    repopulated = False
     chunk_size = 100
     for chunk_start in range(0, len(user_ids), chunk_size):
         chunk_end = chunk_start + chunk_size
@@ -998,7 +1021,7 @@ def scrape_twitter_relations(id_):
         chunk_lookup = {id_:relation for id_,relation in chunk}
 
         lookup_url = 'https://api.twitter.com/1.1/users/lookup.json'
-        lookup_response = requests.post(
+        lookup_response = worker.http_post(
             lookup_url,
             proxies=_get_proxies(db),
             verify=False,
@@ -1024,8 +1047,10 @@ def scrape_twitter_relations(id_):
                     .filter(Profile.site=='twitter') \
                     .filter(Profile.upstream_id==uid) \
                     .one()
+                repopulated = True
 
             _twitter_populate_profile(related_dict, related_profile)
+            related_ids.add(related_profile.id)
             relation = chunk_lookup[uid]
 
             if relation == 'friend':
@@ -1039,7 +1064,16 @@ def scrape_twitter_relations(id_):
 
     db.commit()
     worker.finish_job()
-    redis.publish('profile_relations', json.dumps({'id': id_}))
+
+    # Related profiles gained a relation, and existing ones were updated from
+    # the lookup, which can change what other profiles' relation listings show.
+    related_ids.add(id_)
+    app.etag.bump_profile_versions(redis, related_ids)
+
+    if repopulated:
+        app.etag.bump_summary_generation(redis)
+
+    app.notify.publish(redis, 'profile_relations', json.dumps({'id': id_}))
 
 def _get_proxies(db):
     """ Get a dictionary of proxy information from the app configuration. """
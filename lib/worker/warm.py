@@ -0,0 +1,29 @@
+'''
+A worker that runs jobs in its own process instead of forking.
+
+RQ's default worker forks a new process for each job, so the connections that
+this package caches (database, Redis, Solr) are opened again for every job.
+For small jobs, such as indexing a profile or fetching an avatar, that
+overhead costs more than the job itself. A warm worker keeps its connection
+pools for its whole life.
+
+The trade-off is isolation: a job that crashes the interpreter or leaks memory
+affects the worker itself. Run warm workers under a supervisor (see
+``bin/run-worker.py``) so that they are restarted if they die.
+'''
+
+from rq import SimpleWorker
+
+import worker
+
+
+class WarmWorker(worker.InstrumentedWorker, SimpleWorker):
+    ''' An RQ worker that executes jobs without forking. '''
+
+    def perform_job(self, *args, **kwargs):
+        ''' Run a job, then release any database sessions it left open. '''
+
+        try:
+            return super().perform_job(*args, **kwargs)
+        finally:
+            worker.close_sessions()
@@ -4,7 +4,9 @@ import 'dart:html';
 
 import 'package:angular/angular.dart';
 import 'package:quickpin/component/breadcrumbs.dart';
+import 'package:quickpin/component/pager.dart';
 import 'package:quickpin/component/title.dart';
+import 'package:quickpin/query_watcher.dart';
 import 'package:quickpin/rest_api.dart';
 import 'package:quickpin/sse.dart';
 
@@ -25,9 +27,11 @@ class BackgroundTasksComponent {
     bool loadingQueues = false;
     bool loadingWorkers = false;
     List<Map> failed;
+    Pager failedPager;
     List<Map> queues;
     List<Map> workers;
 
+    QueryWatcher _queryWatcher;
     Map<String, Map> _runningJobs;
 
     final RestApiController _api;
@@ -46,6 +50,11 @@ class BackgroundTasksComponent {
 
         // ...and remove event listeners when we leave this route.
         RouteHandle rh = this._rp.route.newHandle();
+        this._queryWatcher = new QueryWatcher(
+            rh,
+            ['page', 'rpp'],
+            this._fetchFailedTasks
+        );
         rh.onLeave.take(1).listen((e) {
             listeners.forEach((listener) => listener.cancel());
         });
@@ -56,30 +65,67 @@ class BackgroundTasksComponent {
             .then((_) => this._fetchFailedTasks());
     }
 
+    /// Handle a button press to remove all failed tasks.
+    void removeAllFailedTasks(Event event, dynamic data, Function resetButton) {
+        Map body = {'all': true};
+
+        this._api
+            .post('/api/tasks/failed/delete', body, needsAuth: true)
+            .then((response) => this._fetchFailedTasks())
+            .whenComplete(resetButton);
+    }
+
     /// Handle a button press to remove a single task.
     void removeFailedTask(Event event, String taskId, Function resetButton) {
         this._api
             .delete('/api/tasks/failed/$taskId', needsAuth: true)
+            .then((response) => this._fetchFailedTasks())
+            .whenComplete(resetButton);
+    }
+
+    /// Handle a button press to requeue all failed tasks.
+    void requeueAllFailedTasks(Event event, dynamic data,
+                               Function resetButton) {
+        Map body = {'all': true};
+
+        this._api
+            .post('/api/tasks/failed/requeue', body, needsAuth: true)
             .then((response) {
-                for (int i = 0; i < this.failed.length; i++) {
-                    if (this.failed[i]['id'] == taskId) {
-                        this.failed.removeAt(i);
-                        break;
-                    }
-                }
+                this._fetchFailedTasks().then((_) => this._fetchQueues());
+            })
+            .whenComplete(resetButton);
+    }
+
+    /// Handle a button press to requeue a single task.
+    void requeueFailedTask(Event event, String taskId, Function resetButton) {
+        Map body = {'ids': [taskId]};
+
+        this._api
+            .post('/api/tasks/failed/requeue', body, needsAuth: true)
+            .then((response) {
+                this._fetchFailedTasks().then((_) => this._fetchQueues());
             })
             .whenComplete(resetButton);
     }
 
-    /// Fetch failed task data.
+    /// Fetch a page of failed task data.
     Future _fetchFailedTasks() {
         Completer completer = new Completer();
         this.loadingFailedTasks = true;
+        Map urlArgs = {
+            'page': this._queryWatcher['page'] ?? '1',
+            'rpp': this._queryWatcher['rpp'] ?? '10',
+        };
 
         this._api
-            .get('/api/tasks/failed', needsAuth: true)
+            .get('/api/tasks/failed', urlArgs: urlArgs, needsAuth: true)
             .then((response) {
                 this.failed = response.data['failed'];
+                this.failedPager = new Pager(
+                    response.data['total_count'],
+                    int.parse(this._queryWatcher['page'] ?? '1'),
+                    resultsPerPage: int.parse(this._queryWatcher['rpp'] ?? '10')
+                );
             })
             .whenComplete(() {
                 this.loadingFailedTasks = false;
@@ -208,20 +208,17 @@ class ProfilePostsComponent extends Object
     /// Fetch failed post task data for this profile.
     Future _fetchFailedProfilePostsTasks() {
         Completer completer = new Completer();
-        List<Map> failed;
 
         this.api
-            .get('/api/tasks/failed', needsAuth: true)
+            .get('/api/tasks/failed', urlArgs: {
+                'profile_id': this.id,
+                'type': 'posts',
+                'rpp': '1',
+            }, needsAuth: true)
             .then((response) {
-                failed = response.data['failed'];
-                failed.forEach((failed_task) {
-                    if (int.parse(this.id) == failed_task['profile_id']) {
-                        if (failed_task['type'] == 'posts') {
-                            this.failedTasks = true;
-                        }
-                    }
-                });
-                
+                if (response.data['total_count'] > 0) {
+                    this.failedTasks = true;
+                }
             })
             .whenComplete(() {
                 completer.complete();
@@ -228,20 +228,17 @@ class ProfileRelationsComponent extends Object
     /// Fetch failed friends and followers task data for this profile.
     Future _fetchFailedProfileRelationsTasks() {
         Completer completer = new Completer();
-        List<Map> failed;
 
         this.api
-            .get('/api/tasks/failed', needsAuth: true)
+            .get('/api/tasks/failed', urlArgs: {
+                'profile_id': this.id,
+                'type': 'relations',
+                'rpp': '1',
+            }, needsAuth: true)
             .then((response) {
-                failed = response.data['failed'];
-                failed.forEach((failed_task) {
-                    if (int.parse(this.id) == failed_task['profile_id']) {
-                        if (failed_task['type'] == 'relations') {
-                            this.failedTasks = true;
-                        }
-                    }
-                });
-                
+                if (response.data['total_count'] > 0) {
+                    this.failedTasks = true;
+                }
             })
             .whenComplete(() {
                 completer.complete();
@@ -625,19 +625,17 @@ class ProfileComponent {
     /// Fetch failed task data for this profile.
     Future _fetchFailedProfileTasks() {
         Completer completer = new Completer();
-        List<Map> failed;
         this.loadingFailedTasks = true;
 
         this.api
-            .get('/api/tasks/failed', needsAuth: true)
+            .get('/api/tasks/failed', urlArgs: {
+                'profile_id': this.id.toString(),
+                'rpp': '1',
+            }, needsAuth: true)
             .then((response) {
-                failed = response.data['failed'];
-                failed.forEach((failed_task) {
-                    if (this.id == failed_task['profile_id']) {
-                        this.failedTasks = true;
-                    }
-                });
-
+                if (response.data['total_count'] > 0) {
+                    this.failedTasks = true;
+                }
             })
             .whenComplete(() {
                 this.loadingFailedTasks = false;
@@ -13,6 +13,7 @@ class SseController {
     Stream<Event> onProfilePosts;
     Stream<Event> onProfileRelations;
     Stream<Event> onProfileNotes;
+    Stream<Event> onReset;
     Stream<Event> onWorker;
 
     RestApiController _api;
@@ -34,7 +35,14 @@ class SseController {
         this.onProfilePosts = this._eventSource.on['profile_posts'];
         this.onProfileRelations = this._eventSource.on['profile_relations'];
         this.onProfileNotes = this._eventSource.on['profile_notes'];
+        this.onReset = this._eventSource.on['reset'];
         this.onWorker = this._eventSource.on['worker'];
+
+        // The server could not replay the events missed while reconnecting,
+        // so the page's data may be stale.
+        this.onReset.listen((Event e) {
+            window.location.reload();
+        });
     }
 }
 